@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Lib/cache
+
+Copyright 2017-2022 Nicolas BEGUIER
+Licensed under the Apache License, Version 2.0
+Written by Nicolas BEGUIER (nicolas_beguier@hotmail.com)
+
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class TtlCache():
+    """
+    Thread-safe LRU cache, entries expire after ttl seconds.
+    A ttl of 0 disables the cache.
+    """
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns the cached value, or None if it is missing or expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time() - entry[1] > self.ttl:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        """
+        Store a value, the least recently used entry is evicted if the
+        cache is full
+        """
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (value, time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Forget an entry, returns True if it was cached
+        """
+        with self.lock:
+            return self.entries.pop(key, None) is not None
+
+    def clear(self):
+        """
+        Forget every entry, returns the number of flushed entries
+        """
+        with self.lock:
+            size = len(self.entries)
+            self.entries.clear()
+            return size
+
+    def stats(self):
+        """
+        Returns the cache usage
+        """
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Lib/cluster
+
+Copyright 2017-2022 Nicolas BEGUIER
+Licensed under the Apache License, Version 2.0
+Written by Nicolas BEGUIER (nicolas_beguier@hotmail.com)
+
+"""
+# pylint: disable=broad-except
+
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from hmac import compare_digest, new as hmac_new
+import json
+from socket import gethostbyname, gethostname, getfqdn
+from threading import Event, Lock, Thread
+from time import perf_counter, time
+from urllib.parse import urlsplit
+
+# Third party library imports
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Seconds: older events are refused
+EVENT_MAX_AGE = 300
+SIGNATURE_HEADER = 'X-Cassh-Signature'
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+def sign_event(secret, body):
+    """
+    Returns the HMAC-SHA256 of an event body, with the cluster secret
+    """
+    return hmac_new(secret.encode(), body, sha256).hexdigest()
+
+def encode_event(secret, event):
+    """
+    Returns the body and headers of an event pushed to the cluster nodes
+    """
+    event = dict(event, timestamp=time())
+    body = json.dumps(event, sort_keys=True).encode()
+    return body, {'Content-Type': 'application/json', SIGNATURE_HEADER: sign_event(secret, body)}
+
+def decode_event(secret, body, signature):
+    """
+    Returns the event pushed by a cluster node, an error message and its
+    HTTP code: 401 for an invalid signature or an expired event, 400 for a
+    malformed one
+    """
+    if not signature or not compare_digest(sign_event(secret, body), signature):
+        return None, 'Error: invalid signature.', '401 Unauthorized'
+    try:
+        event = json.loads(body.decode())
+    except ValueError:
+        return None, 'Error: invalid event.', '400 Bad Request'
+    if not isinstance(event, dict) or not isinstance(event.get('timestamp'), (int, float)):
+        return None, 'Error: invalid event.', '400 Bad Request'
+    if abs(time() - event['timestamp']) > EVENT_MAX_AGE:
+        return None, 'Error: expired event.', '401 Unauthorized'
+    return event, None, None
+
+def is_local_node(node, port):
+    """
+    Returns True if the node URL is this server: same port, and a local
+    host name or address. A node behind a proxy is not recognized.
+    """
+    parsed = urlsplit(node)
+    try:
+        node_port = parsed.port or DEFAULT_PORTS.get(parsed.scheme)
+    except ValueError:
+        return False
+    if str(node_port) != str(port):
+        return False
+    if parsed.hostname in ('localhost', gethostname(), getfqdn()):
+        return True
+    try:
+        address = gethostbyname(parsed.hostname)
+        return address.startswith('127.') or address == gethostbyname(gethostname())
+    except (OSError, UnicodeError):
+        return False
+
+
+class PeerSessions():
+    """
+    One keep-alive session per peer (scheme://host:port), shared by every
+    thread of the process, with up to pool_size connections each.
+    Connection errors are retried up to retries times, with an exponential
+    backoff (2 * backoff, 4 * backoff... seconds after the first retry).
+    A request which reached the peer is never retried.
+    """
+    def __init__(self, headers, pool_size, retries, backoff):
+        self.headers = headers
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = Lock()
+        self.sessions = dict()
+
+    def session(self, url):
+        """
+        Returns the session of the peer of url
+        """
+        parsed = urlsplit(url)
+        peer = '%s://%s' % (parsed.scheme, parsed.netloc)
+        with self.lock:
+            session = self.sessions.get(peer)
+            if session is None:
+                session = Session()
+                session.headers.update(self.headers)
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.pool_size,
+                    max_retries=Retry(
+                        total=self.retries, connect=self.retries, read=0, redirect=0,
+                        status=0, backoff_factor=self.backoff,
+                        raise_on_status=False))
+                session.mount(peer, adapter)
+                self.sessions[peer] = session
+            return session
+
+    def close(self):
+        """
+        Close every connection
+        """
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions = dict()
+        for session in sessions:
+            session.close()
+
+
+class ClusterMonitor():
+    """
+    Background thread which probes every node of the cluster concurrently,
+    every interval seconds. probe(node) returns True when the node is alive.
+    /cluster/status answers from the last results, it never waits for a probe.
+    The same threads push events to the nodes.
+    """
+    def __init__(self, nodes, probe, interval):
+        self.nodes = [node for node in nodes if node]
+        self.probe = probe
+        self.interval = interval
+        self.event = Event()
+        self.lock = Lock()
+        self.thread = None
+        self.executor = None
+        self.nodes_status = {node: {
+            'status': 'UNKNOWN',
+            'last_check': None,
+            'last_seen': None,
+            'latency_ms': None,
+        } for node in self.nodes}
+
+    def start(self):
+        """
+        Start the monitor thread, if it is not running in this process
+        """
+        if not self.nodes:
+            return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            # Threads of a parent process are not running after a fork
+            self.executor = ThreadPoolExecutor(max_workers=2 * len(self.nodes))
+            self.thread = Thread(target=self.run, name='cassh-cluster-monitor', daemon=True)
+            self.thread.start()
+
+    def trigger(self):
+        """
+        Ask for a probe of every node, without waiting for it
+        """
+        self.event.set()
+
+    def broadcast(self, function, nodes=None):
+        """
+        Call function(node) for every node (or every node of nodes),
+        without waiting for it
+        """
+        self.start()
+        for node in self.nodes if nodes is None else nodes:
+            self.executor.submit(function, node)
+
+    def probe_node(self, node):
+        """
+        Probe a node and record its status
+        """
+        start = perf_counter()
+        try:
+            is_alive = self.probe(node)
+        except Exception as err:
+            print('Cluster probe of %s failed: %s' % (node, err))
+            is_alive = False
+        latency = perf_counter() - start
+        now = int(time())
+        with self.lock:
+            entry = self.nodes_status[node]
+            entry['last_check'] = now
+            entry['latency_ms'] = round(latency * 1000, 1)
+            if is_alive:
+                entry['status'] = 'OK'
+                entry['last_seen'] = now
+            else:
+                entry['status'] = 'KO'
+
+    def probe_all(self):
+        """
+        Probe every node concurrently, returns when all probes are done
+        """
+        list(self.executor.map(self.probe_node, self.nodes))
+
+    def run(self):
+        """
+        Monitor loop
+        """
+        while True:
+            try:
+                self.probe_all()
+            except RuntimeError:
+                # The executor is shut down when the interpreter exits
+                return
+            self.event.wait(self.interval)
+            self.event.clear()
+
+    def status(self):
+        """
+        Returns {node: {status, last_check, last_seen, latency_ms}}, status is
+        OK, KO or UNKNOWN before the first probe
+        """
+        with self.lock:
+            return {node: dict(entry) for node, entry in self.nodes_status.items()}
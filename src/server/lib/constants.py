@@ -18,6 +18,9 @@ STATES = {
     'PENDING': 2,
 }
 
+# PBKDF2-SHA256 iterations of the passwords kept in the authentication cache
+AUTH_CACHE_ITERATIONS = 20000
+
 PATTERN_EXPIRY = re_compile('^([0-9]+)+[dh]$')
 PATTERN_PRINCIPALS = re_compile(r'^([a-zA-Z-\d]+)$')
 PATTERN_REALNAME = re_compile(
@@ -29,13 +32,16 @@ PATTERN_USERNAME = re_compile("^([a-z]+)$")
 URLS = (
     '/admin/([a-z]+)', 'Admin',
     '/admin/([a-z]+)/principals', 'Principals',
+    '/admin/all/cache/memberof', 'MemberofCache',
     '/admin/all/principals/search', 'PrincipalsSearch',
     '/ca', 'Ca',
     '/client', 'Client',
     '/client/status', 'ClientStatus',
+    '/cluster/revoke', 'ClusterRevoke',
     '/cluster/status', 'ClusterStatus',
     '/health', 'Health',
     '/krl', 'Krl',
+    '/metrics', 'Metrics',
     '/ping', 'Ping',
     '/test_auth', 'TestAuth',
 )
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+Lib/httpd
+
+Copyright 2017-2022 Nicolas BEGUIER
+Licensed under the Apache License, Version 2.0
+Written by Nicolas BEGUIER (nicolas_beguier@hotmail.com)
+
+"""
+# pylint: disable=broad-except
+
+from os import close, fork, getpid, kill, pipe, read, waitpid, write, _exit
+from os import WEXITSTATUS, WIFEXITED, WNOHANG
+from signal import signal, SIGHUP, SIGINT, SIGTERM, SIG_DFL, SIG_IGN
+import sys
+from threading import Thread
+from time import sleep
+
+# Third party library imports
+from cheroot.wsgi import Server
+from cheroot.ssl.builtin import BuiltinSSLAdapter
+from web.httpserver import LogMiddleware, StaticMiddleware
+
+# Exit code of a worker which cannot listen, the master stops instead of
+# respawning it forever
+WORKER_BOOT_ERROR = 3
+
+
+def make_server(wsgi_func, server_opts, reuse_port=False):
+    """
+    Returns the cheroot server of a worker, configured with the [main] options
+    """
+    server = Server(
+        ('0.0.0.0', int(server_opts['port'])),
+        LogMiddleware(StaticMiddleware(wsgi_func)),
+        numthreads=server_opts['threads'],
+        request_queue_size=server_opts['backlog'],
+        timeout=server_opts['keepalive_timeout'],
+        shutdown_timeout=server_opts['shutdown_timeout'],
+        accepted_queue_size=server_opts['queue_size'],
+        reuse_port=reuse_port)
+    server.nodelay = True
+    if server_opts['ssl']:
+        server.ssl_adapter = BuiltinSSLAdapter(
+            certificate=server_opts['ssl_public_key'],
+            private_key=server_opts['ssl_private_key'])
+    return server
+
+def run_worker(wsgi_func, server_opts, on_start=None, reuse_port=False):
+    """
+    Serve until SIGTERM or SIGINT, then stop accepting connections and let
+    the in-flight requests finish within shutdown_timeout seconds.
+    on_start is called once the socket is bound, before the first request.
+    Returns an exit code.
+    """
+    server = make_server(wsgi_func, server_opts, reuse_port=reuse_port)
+    stoppers = list()
+
+    def stop(*_):
+        if stoppers:
+            return
+        # Stopping joins the worker threads, it must not block the serve loop
+        stoppers.append(Thread(target=server.stop, name='cassh-httpd-stop'))
+        stoppers[0].start()
+
+    signal(SIGTERM, stop)
+    signal(SIGINT, stop)
+    signal(SIGHUP, SIG_IGN)
+    try:
+        server.prepare()
+    except Exception as err_msg:
+        print('Error: cannot listen on port {}: {}'.format(server_opts['port'], err_msg))
+        return WORKER_BOOT_ERROR
+    print('[%s] %s://0.0.0.0:%s/ (%s threads)' % (
+        getpid(), 'https' if server.ssl_adapter else 'http', server_opts['port'],
+        server_opts['threads']))
+    if on_start is not None:
+        on_start()
+    server.serve()
+    for stopper in stoppers:
+        stopper.join()
+    return 0
+
+
+class Master():
+    """
+    Pre-fork master: every worker process listens on the same port
+    (SO_REUSEPORT) and the kernel balances the connections between them.
+        SIGTERM, SIGINT => graceful stop of every worker, then exit
+        SIGHUP          => graceful restart: new workers are started,
+                           then the old ones drain their in-flight requests
+    Dead workers are respawned.
+    """
+    def __init__(self, wsgi_func, server_opts, on_start=None):
+        self.wsgi_func = wsgi_func
+        self.server_opts = server_opts
+        self.on_start = on_start
+        self.workers = set()
+        self.retiring = set()
+        self.signals = list()
+
+    def spawn(self, wait_ready=False):
+        """
+        Fork a new worker. With wait_ready, returns once the worker is ready
+        to serve requests, or has exited.
+        """
+        ready_read, ready_write = pipe()
+        pid = fork()
+        if pid:
+            close(ready_write)
+            self.workers.add(pid)
+            if wait_ready:
+                read(ready_read, 1)
+            close(ready_read)
+            return
+        close(ready_read)
+        for signum in [SIGTERM, SIGINT, SIGHUP]:
+            signal(signum, SIG_DFL)
+
+        def on_start():
+            if self.on_start is not None:
+                self.on_start()
+            try:
+                write(ready_write, b'.')
+            except BrokenPipeError:
+                # The master is not waiting for this worker
+                pass
+            close(ready_write)
+
+        code = 1
+        try:
+            code = run_worker(self.wsgi_func, self.server_opts, on_start=on_start, reuse_port=True)
+        except Exception as err_msg:
+            print('Error: worker {} failed: {}'.format(getpid(), err_msg))
+        finally:
+            sys.stdout.flush()
+            _exit(code)
+
+    def stop_workers(self, pids):
+        """
+        Ask workers to stop gracefully
+        """
+        for pid in pids:
+            try:
+                kill(pid, SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reap(self):
+        """
+        Forget exited workers, returns True if one of them could not boot
+        """
+        boot_error = False
+        while self.workers:
+            try:
+                pid, status = waitpid(-1, WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            self.workers.discard(pid)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            if WIFEXITED(status) and WEXITSTATUS(status) == WORKER_BOOT_ERROR:
+                boot_error = True
+            else:
+                print('Worker {} exited (status {}), respawning'.format(pid, status))
+        return boot_error
+
+    def run(self):
+        """
+        Master loop, returns an exit code
+        """
+        signal(SIGTERM, lambda signum, _: self.signals.append(signum))
+        signal(SIGINT, lambda signum, _: self.signals.append(signum))
+        signal(SIGHUP, lambda signum, _: self.signals.append(signum))
+        print('[%s] Master, %s workers' % (getpid(), self.server_opts['workers']))
+        code = 0
+        while True:
+            if self.reap():
+                code = 1
+                break
+            if SIGTERM in self.signals or SIGINT in self.signals:
+                break
+            if SIGHUP in self.signals:
+                self.signals.remove(SIGHUP)
+                old_workers = set(self.workers)
+                # Old workers keep serving until the new ones are listening
+                for _ in range(self.server_opts['workers']):
+                    self.spawn(wait_ready=True)
+                self.retiring.update(old_workers)
+                self.stop_workers(old_workers)
+            while len(self.workers) - len(self.retiring) < self.server_opts['workers']:
+                self.spawn()
+            sleep(0.2)
+        self.retiring.update(self.workers)
+        self.stop_workers(list(self.workers))
+        while self.workers:
+            self.reap()
+            sleep(0.2)
+        return code
+
+
+def serve(wsgi_func, server_opts, on_start=None):
+    """
+    Serve wsgi_func with server_opts['workers'] processes of
+    server_opts['threads'] threads, returns an exit code.
+    on_start is called in each worker before the first request: process
+    resources (connection pools, background threads) are created there,
+    never inherited from the master.
+    """
+    if server_opts['workers'] <= 1:
+        return run_worker(wsgi_func, server_opts, on_start=on_start)
+    return Master(wsgi_func, server_opts, on_start=on_start).run()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Lib/krl
+
+Copyright 2017-2022 Nicolas BEGUIER
+Licensed under the Apache License, Version 2.0
+Written by Nicolas BEGUIER (nicolas_beguier@hotmail.com)
+
+"""
+# pylint: disable=broad-except
+
+from email.utils import formatdate, parsedate_to_datetime
+from hashlib import sha256
+from threading import Event, Lock, Thread
+
+
+class KrlCache():
+    """
+    Keep the last good KRL bytes in memory, with its ETag and Last-Modified
+    headers. The entry is replaced by the KRL builder after each swap.
+    """
+    def __init__(self):
+        self.entry = None
+
+    def get(self):
+        """
+        Returns the cached entry, or None if no KRL has been loaded yet
+        """
+        return self.entry
+
+    def set(self, content, version, modified):
+        """
+        Store the KRL content
+            version  => MAX(REVOCATION_DATE) included in the KRL
+            modified => epoch of the last KRL change
+        """
+        entry = {
+            'content': content,
+            'version': version,
+            'etag': '"%s"' % sha256(content).hexdigest(),
+            'last_modified': formatdate(modified, usegmt=True),
+            'modified': int(modified),
+        }
+        self.entry = entry
+        return entry
+
+
+class KrlBuilder():
+    """
+    Background thread which keeps the KRL up-to-date.
+    refresh is called every interval seconds, and as soon as trigger() is
+    called after a revocation, it returns an error message or None.
+    Only one refresh runs at a time, triggers received during a refresh
+    are merged into a single new run.
+    """
+    def __init__(self, refresh, interval):
+        self.refresh = refresh
+        self.interval = interval
+        self.event = Event()
+        self.lock = Lock()
+        self.thread = None
+
+    def start(self):
+        """
+        Start the builder thread, if it is not running in this process
+        """
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = Thread(target=self.run, name='cassh-krl-builder', daemon=True)
+            self.thread.start()
+
+    def trigger(self):
+        """
+        Ask for a KRL refresh, without waiting for it
+        """
+        self.start()
+        self.event.set()
+
+    def run(self):
+        """
+        Builder loop
+        """
+        while True:
+            self.event.wait(self.interval)
+            self.event.clear()
+            try:
+                message = self.refresh()
+            except Exception as err:
+                message = err
+            if message:
+                print('KRL refresh failed: {}'.format(message))
+
+
+def is_not_modified(entry, if_none_match, if_modified_since):
+    """
+    Returns True if the client copy of the KRL is up-to-date
+    """
+    if if_none_match is not None:
+        return entry['etag'] in [etag.strip() for etag in if_none_match.split(',')] \
+            or if_none_match.strip() == '*'
+    if if_modified_since is not None:
+        try:
+            return parsedate_to_datetime(if_modified_since).timestamp() >= entry['modified']
+        except (TypeError, ValueError):
+            return False
+    return False
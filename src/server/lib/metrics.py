@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+Lib/metrics
+
+In-process metrics, exposed in the Prometheus text format.
+
+Copyright 2017-2022 Nicolas BEGUIER
+Licensed under the Apache License, Version 2.0
+Written by Nicolas BEGUIER (nicolas_beguier@hotmail.com)
+
+"""
+
+from bisect import bisect_left
+from threading import Lock
+
+# Seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def format_labels(labelnames, labelvalues, *extra):
+    """
+    Returns the {name="value",...} part of a sample, extra are labels
+    already formatted as name="value",... (or empty)
+    """
+    labels = ['%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')) for name, value in zip(labelnames, labelvalues)]
+    labels.extend(labels_extra for labels_extra in extra if labels_extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(labels)
+
+def format_value(value):
+    """
+    Returns a sample value
+    """
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Counter():
+    """
+    Monotonic counter, by label values
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = Lock()
+        self.values = dict()
+
+    def inc(self, *labelvalues, amount=1):
+        """
+        Increment the counter of labelvalues
+        """
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def samples(self, extra=''):
+        """
+        Returns the lines of the samples, with the extra labels
+        """
+        with self.lock:
+            values = sorted(self.values.items())
+        return ['%s%s %s' % (self.name, format_labels(self.labelnames, labelvalues, extra),
+                             format_value(value)) for labelvalues, value in values]
+
+
+class Histogram():
+    """
+    Histogram of durations in seconds, by label values
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.lock = Lock()
+        # labelvalues => [count per bucket (not cumulative) + one for +Inf, sum]
+        self.values = dict()
+
+    def observe(self, value, *labelvalues):
+        """
+        Record a value
+        """
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labelvalues)
+            if entry is None:
+                entry = self.values[labelvalues] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self, extra=''):
+        """
+        Returns the lines of the samples, with the extra labels
+        """
+        with self.lock:
+            values = sorted((labelvalues, (list(counts), total))
+                            for labelvalues, (counts, total) in self.values.items())
+        lines = list()
+        for labelvalues, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %s' % (
+                    self.name,
+                    format_labels(self.labelnames, labelvalues, extra, 'le="%s"' % format_value(
+                        float(bound))),
+                    cumulative))
+            labels = format_labels(self.labelnames, labelvalues, extra)
+            lines.append('%s_sum%s %s' % (self.name, labels, format_value(total)))
+            lines.append('%s_count%s %s' % (self.name, labels, cumulative))
+        return lines
+
+
+class Gauge():
+    """
+    Gauge read at each scrape: function returns a number, or
+    {labelvalues tuple: number}. None values are skipped.
+    """
+    def __init__(self, name, documentation, function, labelnames=(), kind='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def samples(self, extra=''):
+        """
+        Returns the lines of the samples, with the extra labels
+        """
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return ['%s%s %s' % (self.name, format_labels(self.labelnames, labelvalues, extra),
+                             format_value(value))
+                for labelvalues, value in sorted(values.items()) if value is not None]
+
+
+class Registry():
+    """
+    Metrics of a process
+    """
+    def __init__(self):
+        self.metrics = list()
+
+    def register(self, metric):
+        """
+        Add a metric, returns it
+        """
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """
+        Returns a new counter
+        """
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        Returns a new histogram
+        """
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, function, labelnames=(), kind='gauge'):
+        """
+        Returns a new gauge, read from function at each scrape.
+        kind is 'counter' for values which are counted elsewhere.
+        """
+        return self.register(Gauge(name, documentation, function, labelnames, kind))
+
+    def render(self, labelnames=(), labelvalues=()):
+        """
+        Returns every metric in the Prometheus text format, labelnames and
+        labelvalues are added to every sample
+        """
+        extra = format_labels(labelnames, labelvalues)[1:-1]
+        lines = list()
+        for metric in self.metrics:
+            samples = metric.samples(extra)
+            if not samples:
+                continue
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
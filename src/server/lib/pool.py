@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Lib/pool
+
+Copyright 2017-2022 Nicolas BEGUIER
+Licensed under the Apache License, Version 2.0
+Written by Nicolas BEGUIER (nicolas_beguier@hotmail.com)
+
+"""
+# pylint: disable=broad-except,too-many-arguments
+
+from collections import deque
+from threading import Condition
+from time import time
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no resource can be checked out before the timeout
+    """
+
+
+class Pool():
+    """
+    Bounded and thread-safe pool of reusable resources (database or LDAP connections).
+        factory  => callable which creates a new resource
+        validate => callable which raises if the resource is not usable anymore,
+                    on resources idle for more than validate_interval seconds
+        dispose  => callable which closes a resource
+    """
+    def __init__(self, factory, validate=None, dispose=None, min_size=1, max_size=10, timeout=5,
+                 validate_interval=0):
+        self.factory = factory
+        self.validate = validate
+        self.validate_interval = validate_interval
+        self.dispose = dispose
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = deque()
+        self._size = 0
+        self._cond = Condition()
+
+    def fill(self):
+        """
+        Pre-open min_size resources, errors are ignored
+        """
+        created = list()
+        with self._cond:
+            missing = self.min_size - self._size
+            self._size += max(missing, 0)
+        for _ in range(max(missing, 0)):
+            try:
+                created.append(self.factory())
+            except Exception:
+                pass
+        with self._cond:
+            self._size -= max(missing, 0) - len(created)
+            self._idle.extend((resource, time()) for resource in created)
+            self._cond.notify_all()
+
+    def acquire(self):
+        """
+        Check out a resource, creating one if the pool is not full.
+        Raises PoolTimeout if the pool stays exhausted during timeout seconds.
+        """
+        deadline = time() + self.timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        raise PoolTimeout('Pool exhausted ({} in use)'.format(self._size))
+                    self._cond.wait(remaining)
+                if self._idle:
+                    resource, idle_since = self._idle.pop()
+                else:
+                    resource, idle_since = None, 0
+                    self._size += 1
+
+            if resource is None:
+                try:
+                    return self.factory()
+                except Exception:
+                    self._forget()
+                    raise
+
+            if self.validate is None or time() - idle_since < self.validate_interval:
+                return resource
+            try:
+                self.validate(resource)
+                return resource
+            except Exception:
+                # Stale resource, drop it and try again
+                self._close(resource)
+                self._forget()
+
+    def release(self, resource, discard=False):
+        """
+        Give back a resource to the pool, or close it if discard is True
+        """
+        if resource is None:
+            return
+        if discard:
+            self._close(resource)
+            self._forget()
+            return
+        with self._cond:
+            self._idle.append((resource, time()))
+            self._cond.notify()
+
+    def close(self):
+        """
+        Close every idle resource
+        """
+        with self._cond:
+            idle = [resource for resource, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for resource in idle:
+            self._close(resource)
+
+    def stats(self):
+        """
+        Returns the pool usage
+        """
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'max_size': self.max_size,
+            }
+
+    def _close(self, resource):
+        if self.dispose is None:
+            return
+        try:
+            self.dispose(resource)
+        except Exception:
+            pass
+
+    def _forget(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
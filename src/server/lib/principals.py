@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Lib/principals
+
+Copyright 2017-2022 Nicolas BEGUIER
+Licensed under the Apache License, Version 2.0
+Written by Nicolas BEGUIER (nicolas_beguier@hotmail.com)
+
+"""
+
+from threading import Lock
+from time import time
+
+
+class PrincipalsIndex():
+    """
+    In-memory index of the users principals (PRINCIPALS column merged with
+    the LDAP mapping principals), and the inverted index principal => users.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = Lock()
+        self.users = dict()
+        self.index = dict()
+        self.built = None
+
+    def is_stale(self):
+        """
+        Returns True if the index has never been built or is older than ttl seconds
+        """
+        return self.built is None or time() - self.built > self.ttl
+
+    def rebuild(self, users):
+        """
+        Replace the index with users, an iterable of (username, principals list)
+        """
+        new_users = dict()
+        new_index = dict()
+        for username, principals in users:
+            new_users[username] = tuple(principals)
+            for principal in principals:
+                new_index.setdefault(principal, set()).add(username)
+        with self.lock:
+            self.users = new_users
+            self.index = new_index
+            self.built = time()
+
+    def set_user(self, username, principals):
+        """
+        Add or update the principals of a user
+        """
+        with self.lock:
+            self._remove(username)
+            self.users[username] = tuple(principals)
+            for principal in principals:
+                self.index.setdefault(principal, set()).add(username)
+
+    def remove_user(self, username):
+        """
+        Remove a user from the index
+        """
+        with self.lock:
+            self._remove(username)
+
+    def all_principals(self):
+        """
+        Returns {username: principals list} of every user
+        """
+        with self.lock:
+            return {username: list(principals) for username, principals in self.users.items()}
+
+    def search(self, principals):
+        """
+        Returns {username: matching principals list} of the users which have
+        at least one of the principals
+        """
+        result = dict()
+        with self.lock:
+            for principal in principals:
+                for username in sorted(self.index.get(principal, ())):
+                    result.setdefault(username, list()).append(principal)
+        return result
+
+    def _remove(self, username):
+        for principal in self.users.pop(username, ()):
+            usernames = self.index.get(principal)
+            if usernames is None:
+                continue
+            usernames.discard(username)
+            if not usernames:
+                del self.index[principal]
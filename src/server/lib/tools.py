@@ -11,54 +11,131 @@ Written by Nicolas BEGUIER (nicolas_beguier@hotmail.com)
 # pylint: disable=broad-except,too-many-arguments,no-name-in-module
 
 from argparse import ArgumentParser
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from glob import glob
+from fcntl import flock, LOCK_EX, LOCK_UN
+from hashlib import pbkdf2_hmac
+from hmac import compare_digest
 import json
 from random import choice
 from shutil import copyfile
 from string import ascii_lowercase
-from tempfile import NamedTemporaryFile
-from os.path import isfile
-from os import remove
+from tempfile import mkstemp
+from subprocess import CalledProcessError
+from os.path import abspath, basename, dirname, getmtime, isfile
+from os import chmod, close, getpid, remove, replace, urandom
 import sys
-from time import time
+from threading import Lock
+from time import perf_counter, time
+from types import MappingProxyType
 from urllib.parse import unquote_plus
 
 # Third party library imports
 from configparser import ConfigParser, NoOptionError
-from ldap import initialize, NO_SUCH_OBJECT, SCOPE_SUBTREE
-from psycopg2 import connect, OperationalError, ProgrammingError
-from requests import Session
-from requests.exceptions import ConnectionError as req_ConnectionError
+from ldap import initialize, LDAPError, NO_SUCH_OBJECT, SCOPE_SUBTREE, SERVER_DOWN
+from ldap.filter import escape_filter_chars
+from psycopg2 import connect, DatabaseError, OperationalError, ProgrammingError
+from requests.exceptions import ConnectionError as req_ConnectionError, RequestException
 from web import data, ctx, header
 
 # Own library
-from ssh_utils import Authority
+from ssh_utils import Authority, get_fingerprint_from_string, get_krl_version, read_krl_version
+from ssh_utils import ssh_keygen_calls
+from ssh_utils.krl import read_krl, write_krl_from_keys
+from lib.cache import TtlCache
+from lib.cluster import ClusterMonitor, decode_event, encode_event, is_local_node, PeerSessions
+from lib.krl import is_not_modified, KrlBuilder, KrlCache
+from lib.metrics import Registry
+from lib.pool import Pool, PoolTimeout
+from lib.principals import PrincipalsIndex
 import lib.constants as constants
 
 # DEBUG
 # from pdb import set_trace as st
 
-def loadconfig(version='Unknown'):
+def parse_args():
     """
-    Config loader
+    Command line arguments parser
     """
     parser = ArgumentParser()
     parser.add_argument('-c', '--config', action='store', help='Configuration file')
     parser.add_argument(
         '-v', '--verbose', action='store_true', default=False,
         help='Add verbosity')
+    parser.add_argument(
+        '--check-key-hashes', action='store_true', default=False,
+        help='Verify stored SSH_KEY_HASH against SSH_KEY, then exit')
+    parser.add_argument(
+        '--fix-key-hashes', action='store_true', default=False,
+        help='Recompute wrong SSH_KEY_HASH from SSH_KEY, then exit')
+    parser.add_argument(
+        '--rebuild-krl', action='store_true', default=False,
+        help='Generate the KRL from scratch, then exit')
     args = parser.parse_args()
 
     if not args.config:
         parser.error('--config argument is required !')
+    return args
 
+def loadconfig(version='Unknown'):
+    """
+    Config loader
+    """
+    args = parse_args()
+    server_opts = read_config(args.config, verbose=args.verbose)
+    tooling = Tools(server_opts, constants.STATES, version)
+    return server_opts, args, tooling
+
+def read_config(config_source, verbose=False):
+    """
+    Returns the server options of a configuration file path,
+    or of a dict {section: {option: value}}
+    """
     config = ConfigParser()
-    config.read(args.config)
+    if isinstance(config_source, dict):
+        config.read_dict(config_source)
+    else:
+        config.read(config_source)
     server_opts = {}
     server_opts['ca'] = config.get('main', 'ca')
     server_opts['krl'] = config.get('main', 'krl')
     server_opts['port'] = config.get('main', 'port')
+    try:
+        server_opts['krl_refresh_interval'] = config.getint(
+            'main', 'krl_refresh_interval', fallback=10)
+    except ValueError:
+        print('Option reading error (main): krl_refresh_interval must be an integer')
+        sys.exit(1)
+
+    try:
+        server_opts['principals_index_ttl'] = config.getint(
+            'main', 'principals_index_ttl', fallback=60)
+    except ValueError:
+        print('Option reading error (main): principals_index_ttl must be an integer')
+        sys.exit(1)
+
+    try:
+        server_opts['workers'] = max(1, config.getint('main', 'workers', fallback=1))
+        server_opts['threads'] = max(1, config.getint('main', 'threads', fallback=10))
+        server_opts['queue_size'] = config.getint('main', 'queue_size', fallback=-1)
+        server_opts['keepalive_timeout'] = config.getint('main', 'keepalive_timeout', fallback=10)
+        server_opts['backlog'] = config.getint('main', 'backlog', fallback=5)
+        server_opts['shutdown_timeout'] = config.getint('main', 'shutdown_timeout', fallback=5)
+    except ValueError:
+        print('Option reading error (main): serving options must be integers')
+        sys.exit(1)
+
+    server_opts['sign_backend'] = config.get('main', 'sign_backend', fallback='ssh-keygen')
+    if server_opts['sign_backend'] not in ['ssh-keygen', 'native']:
+        print('Option reading error (main): %s not in ["ssh-keygen", "native"]' \
+            % (server_opts['sign_backend']))
+        sys.exit(1)
+
+    server_opts['krl_backend'] = config.get('main', 'krl_backend', fallback='ssh-keygen')
+    if server_opts['krl_backend'] not in ['ssh-keygen', 'native']:
+        print('Option reading error (main): %s not in ["ssh-keygen", "native"]' \
+            % (server_opts['krl_backend']))
+        sys.exit(1)
 
     try:
         server_opts['admin_db_failover'] = config.get('main', 'admin_db_failover')
@@ -66,7 +143,7 @@ def loadconfig(version='Unknown'):
         server_opts['admin_db_failover'] = False
     server_opts['ldap'] = False
     server_opts['ssl'] = False
-    server_opts['ldap_mapping'] = dict()
+    server_opts['ldap_mapping'] = MappingProxyType(dict())
 
     if config.has_section('postgres'):
         try:
@@ -74,8 +151,12 @@ def loadconfig(version='Unknown'):
             server_opts['db_name'] = config.get('postgres', 'dbname')
             server_opts['db_user'] = config.get('postgres', 'user')
             server_opts['db_password'] = config.get('postgres', 'password')
-        except NoOptionError:
-            if args.verbose:
+            server_opts['db_pool_min'] = config.getint('postgres', 'pool_min', fallback=1)
+            server_opts['db_pool_max'] = config.getint('postgres', 'pool_max', fallback=10)
+            server_opts['db_pool_timeout'] = config.getfloat(
+                'postgres', 'pool_timeout', fallback=5)
+        except (NoOptionError, ValueError):
+            if verbose:
                 print('Option reading error (postgres).')
             sys.exit(1)
 
@@ -104,7 +185,7 @@ def loadconfig(version='Unknown'):
                     % (server_opts['ldap_protocol']))
                 sys.exit(1)
         except NoOptionError:
-            if args.verbose:
+            if verbose:
                 print('Option reading error (ldap).')
             sys.exit(1)
         try:
@@ -119,13 +200,34 @@ def loadconfig(version='Unknown'):
             server_opts['ldap_filter_memberof_key'] = config.get('ldap', 'filter_memberof_key')
         except NoOptionError:
             server_opts['ldap_filter_memberof_key'] = 'memberOf'
+        try:
+            server_opts['ldap_pool_size'] = config.getint('ldap', 'pool_size', fallback=5)
+            server_opts['ldap_pool_timeout'] = config.getfloat('ldap', 'pool_timeout', fallback=5)
+            server_opts['ldap_pool_check_interval'] = config.getint(
+                'ldap', 'pool_check_interval', fallback=30)
+            server_opts['ldap_memberof_cache_ttl'] = config.getint(
+                'ldap', 'memberof_cache_ttl', fallback=0)
+            server_opts['ldap_memberof_cache_size'] = config.getint(
+                'ldap', 'memberof_cache_size', fallback=10000)
+            server_opts['ldap_memberof_chunk_size'] = max(1, config.getint(
+                'ldap', 'memberof_chunk_size', fallback=50))
+            server_opts['ldap_auth_cache_ttl'] = config.getint(
+                'ldap', 'auth_cache_ttl', fallback=0)
+            server_opts['ldap_auth_cache_size'] = config.getint(
+                'ldap', 'auth_cache_size', fallback=1000)
+        except ValueError:
+            print('Option reading error (ldap): pool, cache and chunk options must be numbers')
+            sys.exit(1)
         try:
             ldap_mapping_path = config.get('ldap', 'ldap_mapping_path')
             if isfile(ldap_mapping_path):
                 with open(ldap_mapping_path, 'r') as ldap_mapping_file:
-                    server_opts['ldap_mapping'] = json.loads(ldap_mapping_file.read())
-        except (NoOptionError, json.decoder.JSONDecodeError):
+                    server_opts['ldap_mapping'] = compile_ldap_mapping(
+                        json.loads(ldap_mapping_file.read()))
+        except NoOptionError:
             pass
+        except json.decoder.JSONDecodeError as err_msg:
+            print('Error: Invalid LDAP mapping configuration: {}'.format(err_msg))
 
     if config.has_section('ssl'):
         try:
@@ -133,7 +235,7 @@ def loadconfig(version='Unknown'):
             server_opts['ssl_private_key'] = config.get('ssl', 'private_key')
             server_opts['ssl_public_key'] = config.get('ssl', 'public_key')
         except NoOptionError:
-            if args.verbose:
+            if verbose:
                 print('Option reading error (ssl).')
             sys.exit(1)
 
@@ -147,19 +249,39 @@ def loadconfig(version='Unknown'):
             proto = 'https'
         server_opts['cluster'] = ['%s://localhost:%s' % (proto, server_opts['port'])]
 
+    try:
+        server_opts['cluster_probe_interval'] = max(1, config.getint(
+            'main', 'cluster_probe_interval', fallback=10))
+        server_opts['cluster_pool_size'] = max(1, config.getint(
+            'main', 'cluster_pool_size', fallback=10))
+        server_opts['cluster_retries'] = max(0, config.getint(
+            'main', 'cluster_retries', fallback=2))
+        server_opts['cluster_retry_backoff'] = config.getfloat(
+            'main', 'cluster_retry_backoff', fallback=0.1)
+    except ValueError:
+        print('Option reading error (main): cluster_probe_interval, cluster_pool_size, '
+              'cluster_retries and cluster_retry_backoff must be numbers')
+        sys.exit(1)
+
     try:
         server_opts['clustersecret'] = config.get('main', 'clustersecret')
     except NoOptionError:
         # Standalone mode
         server_opts['clustersecret'] = random_string(32)
 
+    try:
+        server_opts['server_timing'] = config.getboolean('main', 'server_timing', fallback=False)
+        server_opts['timing_log'] = config.getboolean('main', 'timing_log', fallback=False)
+    except ValueError:
+        print('Option reading error (main): server_timing and timing_log must be booleans')
+        sys.exit(1)
+
     try:
         server_opts['debug'] = bool(config.get('main', 'debug') != 'False')
     except NoOptionError:
         server_opts['debug'] = False
 
-    tooling = Tools(server_opts, constants.STATES, version)
-    return server_opts, args, tooling
+    return server_opts
 
 def get_ldap_conn(host, username, password, protocol, reuse=None):
     """
@@ -183,6 +305,56 @@ def get_ldap_conn(host, username, password, protocol, reuse=None):
         return False, 'Error: {}'.format(err_msg)
     return ldap_conn, None
 
+def ldap_validate(ldap_conn):
+    """
+    Raise if the LDAP connection is not usable anymore
+    """
+    ldap_conn.whoami_s()
+
+def ldap_dispose(ldap_conn):
+    """
+    Close an LDAP connection
+    """
+    ldap_conn.unbind_s()
+
+def search_memberof(realnames, server_options, ldap_conn):
+    """
+    Returns ({realname: list of memberOf groups}, set of ambiguous realnames)
+    with one LDAP search for every realname.
+    Unknown realnames are left out, ambiguous ones match several entries.
+    """
+    realname_key = server_options['ldap_filter_realname_key']
+    memberof_key = server_options['ldap_filter_memberof_key']
+    try:
+        output = ldap_conn.search_s(
+            server_options['ldap_bind_dn'],
+            SCOPE_SUBTREE,
+            filterstr='(|{})'.format(''.join(
+                '({}={})'.format(realname_key, escape_filter_chars(realname))
+                for realname in realnames)),
+            attrlist=[realname_key, memberof_key])
+    except NO_SUCH_OBJECT:
+        return dict(), set(realnames)
+    # LDAP equality matching is case insensitive
+    wanted = {realname.lower(): realname for realname in realnames}
+    memberships = dict()
+    ambiguous = set()
+    for ldap_dn, ldap_infos in output or list():
+        # Skip search references
+        if ldap_dn is None or not isinstance(ldap_infos, dict):
+            continue
+        list_membership = ldap_infos.get(memberof_key, list())
+        for value in ldap_infos.get(realname_key, list()):
+            realname = wanted.get(value.decode(errors='ignore').lower())
+            if realname is None:
+                continue
+            if realname in memberships:
+                ambiguous.add(realname)
+            memberships[realname] = list_membership
+    for realname in ambiguous:
+        del memberships[realname]
+    return memberships, ambiguous
+
 def get_memberof(realname, server_options, reuse=None):
     """
     Returns the list of memberOf groups
@@ -205,7 +377,8 @@ def get_memberof(realname, server_options, reuse=None):
             SCOPE_SUBTREE,
             filterstr='(&({}={}))'.format(
                 server_options['ldap_filter_realname_key'],
-                realname))
+                realname),
+            attrlist=[server_options['ldap_filter_memberof_key']])
     except NO_SUCH_OBJECT:
         return list(), 'Error: admin LDAP filter is incorrect (no such object).'
     if not isinstance(output, list) or not output:
@@ -222,63 +395,6 @@ def get_memberof(realname, server_options, reuse=None):
             return list(), 'Error: admin LDAP output is incorrect.'
     return list(), 'Error: admin LDAP filter is incorrect.'
 
-def ldap_authentification(server_options, admin=False):
-    """
-    Return True if user is well authentified
-        realname=xxxxx@domain.fr
-        password=xxxxx
-    It returns also a list of memberof
-    """
-    if not server_options['ldap']:
-        return True, 'OK'
-    credentials, message = data2map()
-    if message:
-        return False, response_render(message, http_code='400 Bad Request')
-    if 'realname' in credentials:
-        realname = unquote_plus(credentials['realname'])
-    else:
-        return False, 'Error: No realname option given.'
-    if 'password' in credentials:
-        password = unquote_plus(credentials['password'])
-    else:
-        return False, 'Error: No password option given.'
-    if password == '':
-        return False, 'Error: password is empty.'
-
-    # user login to validate password
-    ldap_conn, err_msg = get_ldap_conn(
-        server_options['ldap_host'],
-        '{}{}{}'.format(
-            server_options['ldap_username_prefix'],
-            realname,
-            server_options['ldap_username_suffix']),
-        password,
-        server_options['ldap_protocol'])
-    if err_msg:
-        return False, err_msg
-
-    # cassh service login
-    ldap_conn, err_msg = get_ldap_conn(
-        server_options['ldap_host'],
-        server_options['ldap_username'],
-        server_options['ldap_password'],
-        server_options['ldap_protocol'],
-        reuse=ldap_conn)
-    if err_msg:
-        return False, 'Error: wrong cassh ldap credentials'
-
-    list_membership, err_msg = get_memberof(
-        realname,
-        server_options,
-        reuse=ldap_conn)
-    if err_msg:
-        return False, err_msg
-
-    if admin:
-        if server_options['ldap_admin_cn'].encode() not in list_membership:
-            return False, 'Error: Not authorized.'
-    return True, 'OK'
-
 def validate_payload(key, value):
     """
     Return an error message if invalid input
@@ -286,7 +402,8 @@ def validate_payload(key, value):
     new_value = unquote_plus(value)
     count = 10
     while value != new_value and count > 0 and \
-        key in ['username', 'principals', 'add', 'remove', 'update', 'filter', 'realname']:
+        key in ['username', 'principals', 'add', 'remove', 'update', 'filter', 'realname',
+                'flush']:
         value = new_value
         new_value = unquote_plus(value)
         count -= 1
@@ -303,6 +420,8 @@ def validate_payload(key, value):
         for principal in value.split(','):
             if constants.PATTERN_PRINCIPALS.match(principal) is None:
                 err_msg = "Error: invalid principals."
+    elif key == 'flush' and value != 'all' and constants.PATTERN_REALNAME.match(value) is None:
+        err_msg = "Error: invalid flush."
     elif key == 'filter':
         if value != '':
             for principal in value.split(','):
@@ -339,31 +458,47 @@ def clean_principals_output(sql_result, username, shell=False):
         return sql_result
     return sql_result.split(',')
 
+def compile_ldap_mapping(ldap_mapping):
+    """
+    Returns the LDAP mapping as a read-only {group DN (bytes): tuple of principals}.
+    Invalid entries are reported once, and left out.
+    """
+    compiled = dict()
+    if not isinstance(ldap_mapping, dict):
+        print('Error: Invalid LDAP mapping configuration: not a JSON object')
+        return MappingProxyType(compiled)
+    for user_group_cn, ldap_mapping_principals in ldap_mapping.items():
+        if not isinstance(ldap_mapping_principals, list):
+            print('Error: Invalid LDAP mapping configuration: group={}, not a list'.format(
+                user_group_cn))
+            continue
+        principals = list()
+        for principal in ldap_mapping_principals:
+            # URL-encoded principals are unquoted to be validated, as payloads are
+            if not isinstance(principal, str) or validate_payload('principals', principal):
+                print('Error: Invalid LDAP mapping configuration: group={}, principals={}'.format(
+                    user_group_cn, principal))
+                continue
+            principals.append(principal)
+        compiled[user_group_cn.encode()] = tuple(principals)
+    return MappingProxyType(compiled)
+
 def truncate_principals(custom_principals, list_membership, server_options):
     """
     Returns custom_principals without LDAP principals
     """
     if not custom_principals:
         return ''
+    ldap_mapping = server_options['ldap_mapping']
+    if not ldap_mapping:
+        return custom_principals
     principals = custom_principals.split(',')
-    if not server_options['ldap_mapping']:
-        return ','.join(principals)
     for user_group_cn in list_membership:
-        user_group_cn_decoded = user_group_cn.decode(errors='ignore')
-        if user_group_cn_decoded not in server_options['ldap_mapping']:
-            continue
-        ldap_mapping_principals = server_options['ldap_mapping'][user_group_cn_decoded]
-        for principal in ldap_mapping_principals:
-            err_msg = validate_payload('principals', principal)
-            if err_msg:
-                print('Error: Invalid LDAP mapping configuration: err={}, principals={}'.format(
-                    err_msg, principal))
-                continue
+        for principal in ldap_mapping.get(user_group_cn, ()):
             if principal in principals:
                 principals.remove(principal)
     # Remove duplicates
-    principals = list(dict.fromkeys(principals))
-    return ','.join(principals)
+    return ','.join(dict.fromkeys(principals))
 
 def merge_principals(custom_principals, list_membership, server_options):
     """
@@ -371,24 +506,14 @@ def merge_principals(custom_principals, list_membership, server_options):
     """
     if not custom_principals:
         return ''
+    ldap_mapping = server_options['ldap_mapping']
+    if not ldap_mapping:
+        return custom_principals
     principals = custom_principals.split(',')
-    if not server_options['ldap_mapping']:
-        return ','.join(principals)
     for user_group_cn in list_membership:
-        user_group_cn_decoded = user_group_cn.decode(errors='ignore')
-        if user_group_cn_decoded not in server_options['ldap_mapping']:
-            continue
-        ldap_mapping_principals = server_options['ldap_mapping'][user_group_cn_decoded]
-        for principal in ldap_mapping_principals:
-            err_msg = validate_payload('principals', principal)
-            if err_msg:
-                print('Error: Invalid LDAP mapping configuration: err={}, principals={}'.format(
-                    err_msg, principal))
-                continue
-            principals.append(principal)
+        principals.extend(ldap_mapping.get(user_group_cn, ()))
     # Remove duplicates
-    principals = list(dict.fromkeys(principals))
-    return ','.join(principals)
+    return ','.join(dict.fromkeys(principals))
 
 def get_pubkey(username, pg_conn, key_n=0):
     """
@@ -447,6 +572,15 @@ def pretty_ssh_key_hash(pubkey_fingerprint):
 
     return {'bits': key_bits, 'hash': key_hash, 'auth_type': auth_type, 'rate': rate}
 
+def pg_validate(pg_conn):
+    """
+    Cheap liveness query used when a connection is checked out from the pool
+    """
+    cur = pg_conn.cursor()
+    cur.execute("""SELECT 1""")
+    cur.close()
+    pg_conn.rollback()
+
 def random_string(string_length=10):
     """Generate a random string of fixed length """
     letters = ascii_lowercase
@@ -460,6 +594,34 @@ def response_render(message, http_code='200 OK', content_type='text/plain'):
     ctx.status = http_code
     return message
 
+def server_timing(timings, duration):
+    """
+    Returns the Server-Timing header of the request stages, in milliseconds
+    """
+    metrics = ['%s;dur=%.1f' % (name, seconds * 1000) for name, seconds in timings.items()]
+    metrics.append('total;dur=%.1f' % (duration * 1000))
+    return ', '.join(metrics)
+
+def timing_log(handler_name, timings, duration):
+    """
+    Returns the JSON log line of a request, durations in milliseconds
+    """
+    auth = ctx.get('cassh_auth') or {}
+    payload = auth.get('payload') or {}
+    # isoformat(timespec='milliseconds') needs Python 3.6
+    now = datetime.now()
+    return json.dumps({
+        'time': now.strftime('%Y-%m-%dT%H:%M:%S') + '.%03d' % (now.microsecond // 1000),
+        'method': ctx.method,
+        'path': ctx.path,
+        'handler': handler_name,
+        'status': int(ctx.status.split(' ', 1)[0]),
+        'realname': auth.get('realname'),
+        'username': payload.get('username'),
+        'duration_ms': round(duration * 1000, 1),
+        'stages_ms': {name: round(seconds * 1000, 1) for name, seconds in timings.items()},
+    }, sort_keys=True)
+
 def str2date(string):
     """
     change xd => seconds
@@ -503,34 +665,477 @@ class Tools():
             'SERVER_VERSION': version,
         }
         self.req_timeout = 2
+        self.create_peer_sessions()
+        # Load SSH CA
+        if server_opts['sign_backend'] == 'native':
+            # Optional requirement, only needed by the native backend
+            try:
+                from ssh_utils.cert import NativeAuthority # pylint: disable=import-outside-toplevel
+            except ImportError as err:
+                print('Error: sign_backend = native needs the cryptography package: %s' % err)
+                sys.exit(1)
+            self.authority = NativeAuthority(server_opts['ca'], server_opts['krl'])
+        else:
+            self.authority = Authority(server_opts['ca'], server_opts['krl'])
+        # Threads of this process, krl_write_lock() also locks out the other workers
+        self.krl_lock = Lock()
+        # get_krl_state() of the KRL in krl_cache
+        self.krl_loaded_state = None
+        self.krl_cache = KrlCache()
+        self.principals_index = PrincipalsIndex(server_opts['principals_index_ttl'])
+        self.krl_builder = KrlBuilder(self.refresh_krl, server_opts['krl_refresh_interval'])
+        # Cluster nodes to push events to, see remote_nodes()
+        self.cluster_remote_nodes = None
+        self.cluster_monitor = ClusterMonitor(
+            server_opts['cluster'], self.ping_node, server_opts['cluster_probe_interval'])
+        self.start_lock = Lock()
+        self.started_pid = None
+        # Pools inherited from the parent process are never used nor closed
+        self.forked_pools = list()
+        self.memberof_cache = None
+        self.auth_cache = None
+        if server_opts['ldap']:
+            self.memberof_cache = TtlCache(
+                server_opts['ldap_memberof_cache_ttl'],
+                server_opts['ldap_memberof_cache_size'])
+            self.auth_cache = TtlCache(
+                server_opts['ldap_auth_cache_ttl'],
+                server_opts['ldap_auth_cache_size'])
+            self.auth_salt = urandom(16)
+        self.create_pools()
+        self.krl_revoked_keys = None
+        self.init_metrics()
+
+    def init_metrics(self):
+        """
+        Register the metrics exposed on /metrics
+        """
+        self.metrics = Registry()
+        self.requests_total = self.metrics.counter(
+            'cassh_requests_total', 'HTTP requests', ['handler', 'method', 'code'])
+        self.request_duration = self.metrics.histogram(
+            'cassh_request_duration_seconds', 'HTTP requests duration', ['handler', 'method'])
+        self.stage_duration = self.metrics.histogram(
+            'cassh_stage_duration_seconds',
+            'Duration of the request stages (ldap_auth, ldap_memberof, db_connect, db, '
+            'fingerprint, sign)',
+            ['stage'])
+        self.krl_rebuild_duration = self.metrics.histogram(
+            'cassh_krl_rebuild_duration_seconds', 'Duration of the KRL generation from scratch',
+            buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300))
+        self.metrics.gauge(
+            'cassh_ssh_keygen_calls_total', 'ssh-keygen subprocesses',
+            lambda: {(action,): count for action, count in ssh_keygen_calls().items()},
+            ['action'], kind='counter')
+        self.metrics.gauge(
+            'cassh_krl_revoked_keys', 'Revoked keys in the REVOCATION table',
+            lambda: self.krl_revoked_keys)
+        self.metrics.gauge(
+            'cassh_krl_version', 'Version of the served KRL (last REVOCATION_DATE)',
+            lambda: (self.krl_cache.get() or {}).get('version'))
+        for stat in ['size', 'idle', 'in_use', 'max_size']:
+            self.metrics.gauge(
+                'cassh_pool_%s' % stat, 'Connection pool %s' % stat.replace('_', ' '),
+                lambda stat=stat: {
+                    (name,): pool.stats()[stat] for name, pool in [
+                        ('postgres', self.pg_pool), ('ldap', self.ldap_pool)]
+                    if pool is not None},
+                ['pool'])
+        for stat, kind in [('size', 'gauge'), ('hits', 'counter'), ('misses', 'counter')]:
+            self.metrics.gauge(
+                'cassh_cache_%s%s' % (stat, '_total' if kind == 'counter' else ''),
+                'Cache %s' % stat,
+                lambda stat=stat: {
+                    (name,): cache.stats()[stat] for name, cache in [
+                        ('memberof', self.memberof_cache), ('auth', self.auth_cache)]
+                    if cache is not None},
+                ['cache'], kind=kind)
+        self.metrics.gauge(
+            'cassh_cluster_node_up', 'Last probe of the cluster node succeeded',
+            lambda: {(node,): int(entry['status'] == 'OK')
+                     for node, entry in self.cluster_monitor.status().items()
+                     if entry['last_check'] is not None},
+            ['node'])
+        self.metrics.gauge(
+            'cassh_principals_index_users', 'Users in the principals index',
+            lambda: len(self.principals_index.users))
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage of the request, for the metrics and, when
+        server_timing or timing_log is enabled, for the request breakdown
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            duration = perf_counter() - start
+            self.stage_duration.observe(duration, name)
+            timings = ctx.get('cassh_timings')
+            if timings is not None:
+                timings[name] = timings.get(name, 0) + duration
+
+    def create_peer_sessions(self):
+        """
+        Create the keep-alive sessions shared by all requests to the cluster nodes
+        """
+        self.peer_sessions = PeerSessions(
+            self.req_headers,
+            self.server_opts['cluster_pool_size'],
+            self.server_opts['cluster_retries'],
+            self.server_opts['cluster_retry_backoff'])
+
+    def create_pools(self):
+        """
+        Create the postgres and LDAP connection pools, connections are
+        opened on demand or by start()
+        """
+        server_opts = self.server_opts
+        self.pg_pool = None
+        if 'db_host' in server_opts:
+            self.pg_pool = Pool(
+                self.pg_connect,
+                validate=pg_validate,
+                dispose=lambda pg_conn: pg_conn.close(),
+                min_size=server_opts['db_pool_min'],
+                max_size=server_opts['db_pool_max'],
+                timeout=server_opts['db_pool_timeout'])
+        self.ldap_pool = None
+        if server_opts['ldap']:
+            self.ldap_pool = Pool(
+                self.ldap_connect,
+                validate=ldap_validate,
+                dispose=ldap_dispose,
+                min_size=1,
+                max_size=server_opts['ldap_pool_size'],
+                timeout=server_opts['ldap_pool_timeout'],
+                validate_interval=server_opts['ldap_pool_check_interval'])
+
+    def start(self):
+        """
+        Open the connection pools, start the KRL builder and the cluster
+        monitor, once per process.
+        After a fork, the pools are created again: connections of the parent
+        process are never shared.
+        """
+        if self.started_pid == getpid():
+            return
+        with self.start_lock:
+            if self.started_pid == getpid():
+                return
+            if self.started_pid is not None:
+                self.forked_pools.extend([self.pg_pool, self.ldap_pool, self.peer_sessions])
+                self.create_pools()
+                self.create_peer_sessions()
+            self.started_pid = getpid()
+            if self.pg_pool is not None:
+                self.pg_pool.fill()
+            if self.ldap_pool is not None:
+                self.ldap_pool.fill()
+            self.krl_builder.trigger()
+            self.cluster_monitor.start()
+
+    def ldap_connect(self):
+        """
+        Returns a new LDAP connection bound as the cassh service account
+        """
+        ldap_conn, err_msg = get_ldap_conn(
+            self.server_opts['ldap_host'],
+            self.server_opts['ldap_username'],
+            self.server_opts['ldap_password'],
+            self.server_opts['ldap_protocol'])
+        if err_msg:
+            raise LDAPError(err_msg)
+        return ldap_conn
+
+    def ldap_connection(self):
+        """
+        Return an LDAP connection bound as the cassh service account, checked
+        out from the pool. It must be given back with ldap_release.
+        It must never be rebound as another user.
+        """
+        try:
+            return self.ldap_pool.acquire(), None
+        except LDAPError:
+            return None, 'Error: wrong cassh ldap credentials'
+        except PoolTimeout:
+            return None, 'Error: no LDAP connection available'
+
+    def ldap_release(self, ldap_conn, discard=False):
+        """
+        Give back an LDAP connection to the pool
+        """
+        self.ldap_pool.release(ldap_conn, discard=discard)
+
+    def ldap_call(self, function):
+        """
+        Call function(ldap_conn) with a pooled LDAP connection.
+        A connection closed by the server is dropped, and the call is
+        retried once with a new connection.
+        Returns (function result, error message)
+        """
+        for _ in range(2):
+            ldap_conn, err_msg = self.ldap_connection()
+            if ldap_conn is None:
+                return None, err_msg
+            discard = True
+            try:
+                result = function(ldap_conn)
+                discard = False
+                return result, None
+            except SERVER_DOWN:
+                continue
+            finally:
+                self.ldap_release(ldap_conn, discard=discard)
+        return None, 'Error: LDAP server is down'
+
+    def get_memberof(self, realname):
+        """
+        Returns the list of memberOf groups, with a pooled LDAP connection.
+        Successful lookups are cached during memberof_cache_ttl seconds.
+        """
+        if not self.server_opts['ldap']:
+            return list(), None
+        list_membership = self.memberof_cache.get(realname)
+        if list_membership is not None:
+            return list_membership, None
+        with self.stage('ldap_memberof'):
+            result, err_msg = self.ldap_call(
+                lambda ldap_conn: get_memberof(realname, self.server_opts, reuse=ldap_conn))
+        if err_msg:
+            return list(), err_msg
+        list_membership, err_msg = result
+        if not err_msg:
+            self.memberof_cache.set(realname, list_membership)
+        return list_membership, err_msg
 
-    def cluster_alived(self):
+    def get_memberof_list(self, realnames):
         """
-        This function returns a subset of pingeable node
+        Returns {realname: list of memberOf groups} for every realname, with
+        one LDAP search per chunk of memberof_chunk_size realnames.
+        Realnames which are unknown, ambiguous or in error get no group.
         """
-        alive_nodes = list()
-        dead_nodes = list()
-        if not self.server_opts['cluster'] or \
-            self.server_opts['cluster'] == ['']:
-            return alive_nodes, dead_nodes
-        for node in self.server_opts['cluster']:
-            req = self.get("%s/ping" % node)
-            if req is not None and req.text == 'pong':
-                alive_nodes.append(node)
+        if not self.server_opts['ldap']:
+            return {realname: list() for realname in realnames}
+        memberships = dict()
+        missing = list()
+        for realname in dict.fromkeys(realnames):
+            if not realname:
+                memberships[realname] = list()
+                continue
+            list_membership = self.memberof_cache.get(realname)
+            if list_membership is None:
+                missing.append(realname)
             else:
-                dead_nodes.append(node)
-        return alive_nodes, dead_nodes
+                memberships[realname] = list_membership
+        chunk_size = self.server_opts['ldap_memberof_chunk_size']
+        for index in range(0, len(missing), chunk_size):
+            chunk = missing[index:index + chunk_size]
+            with self.stage('ldap_memberof'):
+                result, err_msg = self.ldap_call(
+                    lambda ldap_conn, chunk=chunk: search_memberof(
+                        chunk, self.server_opts, ldap_conn))
+            if err_msg:
+                print(err_msg)
+                result = (dict(), set(chunk))
+            found, ambiguous = result
+            for realname in chunk:
+                memberships[realname] = found.get(realname, list())
+                if realname not in ambiguous:
+                    self.memberof_cache.set(realname, memberships[realname])
+        return memberships
+
+    def auth_context(self):
+        """
+        Returns the authentication of the current request, computed once
+        and kept in web.ctx for every handler:
+            payload  => parsed POST data, None if invalid
+            realname => LDAP realname
+            is_auth  => True if the user is well authentified
+            memberof => list of memberOf groups
+            is_admin => True if the user is a member of admin_cn
+            message  => payload or authentication error message
+        """
+        auth = ctx.get('cassh_auth')
+        if auth is None:
+            with self.stage('ldap_auth'):
+                auth = self.authenticate()
+            ctx.cassh_auth = auth
+        return auth
+
+    def authenticate(self):
+        """
+        Parse the POST data and authenticate the user against the LDAP
+            realname=xxxxx@domain.fr
+            password=xxxxx
+        """
+        payload, message = data2map()
+        auth = {
+            'payload': payload,
+            'realname': None,
+            'is_auth': False,
+            'memberof': list(),
+            'is_admin': False,
+            'message': message,
+        }
+        if not self.server_opts['ldap']:
+            auth.update(is_auth=True, is_admin=True, message=message or 'OK')
+            return auth
+        if message:
+            return auth
+        if 'realname' in payload:
+            realname = unquote_plus(payload['realname'])
+        else:
+            auth['message'] = 'Error: No realname option given.'
+            return auth
+        if 'password' in payload:
+            password = unquote_plus(payload['password'])
+        else:
+            auth['message'] = 'Error: No password option given.'
+            return auth
+        if password == '':
+            auth['message'] = 'Error: password is empty.'
+            return auth
+        auth['realname'] = realname
+
+        # Recent successful authentication with the same password
+        password_hash = None
+        if self.auth_cache.ttl > 0:
+            password_hash = pbkdf2_hmac(
+                'sha256',
+                password.encode('utf-8'),
+                self.auth_salt + realname.encode('utf-8'),
+                constants.AUTH_CACHE_ITERATIONS)
+            cached = self.auth_cache.get(realname)
+            if cached is not None and compare_digest(cached[0], password_hash):
+                auth.update(
+                    is_auth=True,
+                    memberof=cached[1],
+                    is_admin=self.server_opts['ldap_admin_cn'].encode() in cached[1],
+                    message='OK')
+                return auth
+
+        # user login to validate password, on a short-lived connection
+        ldap_conn, err_msg = get_ldap_conn(
+            self.server_opts['ldap_host'],
+            '{}{}{}'.format(
+                self.server_opts['ldap_username_prefix'],
+                realname,
+                self.server_opts['ldap_username_suffix']),
+            password,
+            self.server_opts['ldap_protocol'])
+        if err_msg:
+            auth['message'] = err_msg
+            return auth
+        try:
+            ldap_conn.unbind_s()
+        except LDAPError:
+            pass
+
+        # cassh service login
+        list_membership, err_msg = self.get_memberof(realname)
+        if err_msg:
+            auth['message'] = err_msg
+            return auth
+
+        auth.update(
+            is_auth=True,
+            memberof=list_membership,
+            is_admin=self.server_opts['ldap_admin_cn'].encode() in list_membership,
+            message='OK')
+        if password_hash is not None:
+            self.auth_cache.set(realname, (password_hash, list_membership))
+        return auth
+
+    def forget_user(self, realname):
+        """
+        Drop the cached authentication and memberOf groups of a realname,
+        after a revocation or a deletion
+        """
+        if not self.server_opts['ldap'] or not realname:
+            return
+        self.auth_cache.delete(realname)
+        self.memberof_cache.delete(realname)
+
+    def ldap_authentification(self, admin=False):
+        """
+        Return True if user is well authentified, and an admin if admin is True.
+        It returns also an error message.
+        """
+        auth = self.auth_context()
+        if not auth['is_auth']:
+            return False, auth['message']
+        if admin and not auth['is_admin']:
+            return False, 'Error: Not authorized.'
+        return True, 'OK'
+
+    def request_payload(self):
+        """
+        Returns the parsed POST data of the current request and an error message
+        """
+        auth = self.auth_context()
+        if auth['payload'] is None:
+            return None, auth['message']
+        return auth['payload'], None
+
+    def check_key_hashes(self, fix=False):
+        """
+        Verify that every SSH_KEY_HASH matches its SSH_KEY, and rewrite
+        the wrong ones if fix is True.
+        Returns the number of remaining mismatches.
+        """
+        pg_conn, message = self.pg_connection()
+        if pg_conn is None:
+            print(message)
+            return 1
+        cur = pg_conn.cursor()
+        cur.execute('SELECT NAME, SSH_KEY, SSH_KEY_HASH FROM USERS')
+        users = cur.fetchall()
+        mismatches = 0
+        for username, pubkey, pubkey_hash in users:
+            pubkey_fingerprint = get_fingerprint_from_string(pubkey or '')
+            if pubkey_fingerprint == pubkey_hash:
+                continue
+            if pubkey_fingerprint == 'Unknown':
+                print('%s: public key unprocessable, nothing done' % username)
+                mismatches += 1
+            elif fix:
+                cur.execute(
+                    """
+                    UPDATE USERS SET SSH_KEY_HASH=(%s) WHERE NAME=(%s)
+                    """, (pubkey_fingerprint, username))
+                print('%s: fixed %s => %s' % (username, pubkey_hash, pubkey_fingerprint))
+            else:
+                print('%s: mismatch %s != %s' % (username, pubkey_hash, pubkey_fingerprint))
+                mismatches += 1
+        pg_conn.commit()
+        cur.close()
+        self.pg_release(pg_conn)
+        print('%s users checked, %s mismatches' % (len(users), mismatches))
+        return 1 if mismatches else 0
+
+    def cluster_status(self):
+        """
+        Returns the last probe of each node of the cluster
+        """
+        self.cluster_monitor.start()
+        return self.cluster_monitor.status()
+
+    def ping_node(self, node):
+        """
+        Returns True if the node answers to /ping
+        """
+        req = self.get("%s/ping" % node)
+        return req is not None and req.text == 'pong'
 
     def get(self, url):
         """
-        Rebuilt GET function for CASSH purpose
+        Rebuilt GET function for CASSH purpose, the response body is read
+        and the connection is given back to the peer session
         """
-        session = Session()
         try:
-            req = session.get(url,
-                              headers=self.req_headers,
-                              timeout=self.req_timeout,
-                              stream=True)
+            req = self.peer_sessions.session(url).get(url, timeout=self.req_timeout)
         except req_ConnectionError:
             print('Connection error : %s' % url)
             req = None
@@ -538,60 +1143,299 @@ class Tools():
 
     def get_last_krl(self):
         """
-        Generates or returns a KRL file
+        Returns the last good KRL from memory, it never waits for a build.
+        Answers 304 Not Modified to conditional requests of an up-to-date client.
         """
-        pg_conn, message = self.pg_connection()
-        if pg_conn is None:
-            return response_render(message, http_code='503 Service Unavailable')
-        cur = pg_conn.cursor()
-        cur.execute(
-            """
-            SELECT MAX(REVOCATION_DATE) FROM REVOCATION
-            """)
-        last_timestamp = cur.fetchone()
-        if not last_timestamp[0]:
-            return response_render(
-                open(self.server_opts['krl'], 'rb'),
-                content_type='application/octet-stream')
+        entry = self.krl_cache.get()
+        if entry is None:
+            entry = self.load_krl()
+            self.krl_builder.trigger()
+            if entry is None:
+                return response_render(
+                    'Error : KRL is not available yet',
+                    http_code='503 Service Unavailable')
+        header('ETag', entry['etag'])
+        header('Last-Modified', entry['last_modified'])
+        if is_not_modified(
+                entry,
+                ctx.env.get('HTTP_IF_NONE_MATCH'),
+                ctx.env.get('HTTP_IF_MODIFIED_SINCE')):
+            return response_render('', http_code='304 Not Modified')
+        return response_render(
+            entry['content'],
+            content_type='application/octet-stream')
 
-        last_krl = '%s.%s' % (self.server_opts['krl'], last_timestamp[0])
+    def load_krl(self):
+        """
+        Read the current KRL file and keep it in memory.
+        Returns the cache entry, or None if there is no valid KRL file.
+        """
+        # Read first: a KRL swapped in meanwhile is loaded again by refresh_krl
+        krl_state = self.get_krl_state()
+        try:
+            with open(self.server_opts['krl'], 'rb') as krl_file:
+                content = krl_file.read()
+        except OSError:
+            return None
+        version = read_krl_version(content)
+        if version is None:
+            return None
+        self.krl_loaded_state = krl_state
+        modified = version or getmtime(self.server_opts['krl'])
+        return self.krl_cache.set(content, version, modified)
 
-        # Check if the KRL is up-to-date
-        if not isfile(last_krl):
-            ca_ssh = Authority(self.server_opts['ca'], last_krl)
-            ca_ssh.generate_empty_krl()
+    def get_krl_state(self):
+        """
+        Returns (version, revoked keys) of the current KRL. Revocations of the
+        same second share the version, so the revoked keys are counted in a
+        state file next to the KRL: None when it is missing or out-of-date.
+        """
+        version = get_krl_version(self.server_opts['krl'])
+        try:
+            with open(self.server_opts['krl'] + '.state', 'r') as state_file:
+                state_version, revoked_keys = (int(value) for value in state_file.read().split())
+        except (OSError, ValueError):
+            return version, None
+        if state_version != version:
+            return version, None
+        return version, revoked_keys
+
+    def write_krl_state(self, version, revoked_keys):
+        """
+        Swap in the state file of a KRL which was just swapped in
+        """
+        state_tmp = self.krl_tempfile()
+        with open(state_tmp, 'w') as state_file:
+            state_file.write('%s %s\n' % (version, revoked_keys))
+        replace(state_tmp, self.server_opts['krl'] + '.state')
 
+    @contextmanager
+    def krl_write_lock(self):
+        """
+        Serialize the KRL updates between the threads and the worker
+        processes, with an exclusive lock on a file next to the KRL
+        """
+        with self.krl_lock:
+            with open(self.server_opts['krl'] + '.lock', 'a') as lock_file:
+                flock(lock_file, LOCK_EX)
+                try:
+                    yield
+                finally:
+                    flock(lock_file, LOCK_UN)
+
+    def krl_tempfile(self):
+        """
+        Returns a new temporary file next to the KRL, to be swapped in
+        atomically with os.replace
+        """
+        krl_fd, krl_tmp = mkstemp(
+            dir=dirname(abspath(self.server_opts['krl'])),
+            prefix='.%s.' % basename(self.server_opts['krl']))
+        close(krl_fd)
+        chmod(krl_tmp, 0o644)
+        return krl_tmp
+
+    def refresh_krl(self, force=False):
+        """
+        Bring the KRL up-to-date with the REVOCATION table: it is generated
+        from scratch in a temporary file, then swapped in.
+        The KRL is up-to-date when its version is MAX(REVOCATION_DATE) and
+        it has COUNT(*) revoked keys, nothing is done then, unless force
+        is True.
+        Returns an error message, or None.
+        """
+        pg_conn, message = self.pg_connection()
+        if pg_conn is None:
+            return message
+        with self.krl_write_lock():
+            try:
+                cur = pg_conn.cursor()
+                with self.stage('db'):
+                    cur.execute(
+                        """
+                        SELECT MAX(REVOCATION_DATE), COUNT(*) FROM REVOCATION
+                        """)
+                    last_timestamp, self.krl_revoked_keys = cur.fetchone()
+                last_timestamp = last_timestamp or 0
+                cur.close()
+                if force or self.get_krl_state() != (last_timestamp, self.krl_revoked_keys):
+                    message = self.write_krl(pg_conn, last_timestamp)
+            finally:
+                self.pg_release(pg_conn)
+            if self.krl_cache.get() is None or self.krl_loaded_state != self.get_krl_state():
+                self.load_krl()
+        return message
+
+    def write_krl(self, pg_conn, version):
+        """
+        Generates the KRL from scratch with every revoked key, and swap it in.
+        Returns an error message, or None.
+        """
+        start = perf_counter()
+        krl_tmp = self.krl_tempfile()
+        # Server-side cursor: revoked keys are streamed, not loaded in memory
+        cur = pg_conn.cursor(name='cassh_krl_rebuild')
+        cur.itersize = 2000
+        # Rows are then fetched while ssh-keygen reads them, in krl_rebuild_duration
+        with self.stage('db'):
             cur.execute('SELECT SSH_KEY FROM REVOCATION')
-            pubkeys = cur.fetchall()
+        revoked_keys = [0]
 
-            if not pubkeys or not pubkeys[0]:
-                cur.close()
-                pg_conn.close()
-                return response_render(
-                    open(self.server_opts['krl'], 'rb'),
-                    content_type='application/octet-stream')
+        def pubkeys():
+            for row in cur:
+                revoked_keys[0] += 1
+                yield row[0]
+        try:
+            if self.server_opts['krl_backend'] == 'native':
+                _, invalid = write_krl_from_keys(krl_tmp, pubkeys(), version=version)
+            else:
+                _, invalid = Authority(self.server_opts['ca'], krl_tmp).generate_krl_from_keys(
+                    pubkeys(), version=version)
+        except (CalledProcessError, OSError):
+            remove(krl_tmp)
+            return 'Error : KRL generation failed'
+        finally:
+            cur.close()
+        if invalid:
+            print('Warning: %s revoked keys are unprocessable' % invalid)
+        replace(krl_tmp, self.server_opts['krl'])
+        # Unprocessable keys are counted too, like COUNT(*) does
+        self.write_krl_state(version, revoked_keys[0])
+        self.krl_rebuild_duration.observe(perf_counter() - start)
+        return None
 
-            for pubkey in pubkeys:
-                with NamedTemporaryFile(delete=False) as tmp_pubkey:
-                    tmp_pubkey.write(bytes(pubkey[0], 'utf-8'))
-                ca_ssh.update_krl(tmp_pubkey.name)
-            remove(tmp_pubkey.name)
+    def append_to_krl(self, krl_tmp, pubkeys, version):
+        """
+        Write in krl_tmp the current KRL with pubkeys revoked too, with
+        ssh-keygen or natively (krl_backend).
+        Raises CalledProcessError, OSError or ValueError on failure.
+        """
+        if self.server_opts['krl_backend'] != 'native':
+            copyfile(self.server_opts['krl'], krl_tmp)
+            Authority(self.server_opts['ca'], krl_tmp).revoke_public_keys(
+                pubkeys, version=version)
+            return
+        krl = read_krl(self.server_opts['krl'])
+        krl.version = version
+        for pubkey in pubkeys:
+            try:
+                krl.revoke_public_key(pubkey)
+            except ValueError:
+                print('Warning: revoked key is unprocessable')
+        krl.write(krl_tmp)
 
-            copyfile(last_krl, self.server_opts['krl'])
+    def is_revoked(self, pubkey):
+        """
+        Returns True if the current KRL revokes pubkey
+        """
+        if self.server_opts['krl_backend'] != 'native':
+            return Authority(self.server_opts['ca'], self.server_opts['krl']).is_revoked(pubkey)
+        try:
+            return read_krl(self.server_opts['krl']).is_revoked(pubkey)
+        except (OSError, ValueError):
+            return False
 
-        # Clean old files
-        old_files = glob('%s*' % self.server_opts['krl'])
-        old_files.remove(self.server_opts['krl'])
-        old_files.remove(last_krl)
-        for old_file in old_files:
-            remove(old_file)
+    def revoke_keys(self, pubkeys, previous_state, last_state):
+        """
+        Add revoked keys to a copy of the current KRL (append_to_krl), then
+        swap it in.
+            previous_state => (MAX(REVOCATION_DATE), COUNT(*)) before this revocation
+            last_state     => (MAX(REVOCATION_DATE), COUNT(*)) after this revocation
+        Nothing is done when the current KRL is in last_state, or already
+        revokes them. If it is not in previous_state (an other revocation in
+        the same second, revocations pushed out of order...), the KRL is
+        generated from scratch instead.
+        """
+        previous_state = (previous_state[0] or 0, previous_state[1])
+        last_state = (last_state[0] or 0, last_state[1])
+        with self.krl_write_lock():
+            krl_state = self.get_krl_state()
+            if krl_state == last_state:
+                return
+            if krl_state != previous_state:
+                # Already revoked by a KRL ahead of this revocation
+                if all(self.is_revoked(pubkey) for pubkey in pubkeys):
+                    return
+            else:
+                krl_tmp = self.krl_tempfile()
+                try:
+                    self.append_to_krl(krl_tmp, pubkeys, last_state[0])
+                except (CalledProcessError, OSError, ValueError):
+                    remove(krl_tmp)
+                else:
+                    replace(krl_tmp, self.server_opts['krl'])
+                    self.write_krl_state(*last_state)
+                    self.load_krl()
+                    return
+        # Not under krl_write_lock(), refresh_krl takes it
+        message = self.refresh_krl(force=True)
+        if message:
+            print(message)
 
-        cur.close()
-        pg_conn.close()
+    def push_revocation(self, username, realname, pubkey, previous_state, last_state):
+        """
+        Send a revocation to every other node of the cluster, signed with
+        the clustersecret, without waiting for them
+        """
+        body, headers = encode_event(self.server_opts['clustersecret'], {
+            'username': username,
+            'realname': realname,
+            'pubkey': pubkey,
+            'previous_state': previous_state,
+            'last_state': last_state,
+        })
+
+        def push(node):
+            try:
+                req = self.post('%s/cluster/revoke' % node, body, headers=headers)
+            except RequestException as err:
+                req = None
+                print('Revocation push to %s failed: %s' % (node, err))
+            if req is not None and req.status_code != 200:
+                print('Revocation push to %s failed: %s %s' % (node, req.status_code, req.text))
+        self.cluster_monitor.broadcast(push, self.remote_nodes())
+
+    def remote_nodes(self):
+        """
+        Returns the nodes of the cluster, except this server (localhost:port
+        by default), resolved at the first call
+        """
+        if self.cluster_remote_nodes is None:
+            self.cluster_remote_nodes = [
+                node for node in self.cluster_monitor.nodes
+                if not is_local_node(node, self.server_opts['port'])]
+        return self.cluster_remote_nodes
 
-        return response_render(
-            open(self.server_opts['krl'], 'rb'),
-            content_type='application/octet-stream')
+    def apply_revocation(self, body, signature):
+        """
+        Apply a revocation sent by a node of the cluster: the revoked user is
+        forgotten by the caches, and the key is added to the current KRL.
+        Returns an error message and its HTTP code, or (None, None).
+        """
+        event, err_msg, http_code = decode_event(
+            self.server_opts['clustersecret'], body, signature)
+        if err_msg:
+            return err_msg, http_code
+        try:
+            username = event['username']
+            realname = event['realname']
+            pubkey = event['pubkey']
+            # (MAX(REVOCATION_DATE), COUNT(*)), the date is null before a first revocation
+            previous_date, previous_count = event['previous_state']
+            last_date, last_count = event['last_state']
+        except (KeyError, TypeError, ValueError):
+            return 'Error: invalid revocation.', '400 Bad Request'
+        if not all(isinstance(value, int) for value in (previous_count, last_date, last_count)):
+            return 'Error: invalid revocation.', '400 Bad Request'
+        if not isinstance(pubkey, str) or \
+            validate_payload('username', username) or \
+            (realname and validate_payload('realname', realname)):
+            return 'Error: invalid revocation.', '400 Bad Request'
+        self.forget_user(realname)
+        # Nothing is done if the KRL is in last_state (revoked by this node, or
+        # by the KRL builder), it is rebuilt if it is not in previous_state
+        self.revoke_keys([pubkey], (previous_date, previous_count), (last_date, last_count))
+        return None, None
 
     def list_keys(self, username=None, realname=None):
         """
@@ -603,66 +1447,93 @@ class Tools():
         cur = pg_conn.cursor()
         is_list = False
 
-        if realname is not None:
-            cur.execute('SELECT * FROM USERS WHERE REALNAME=(%s)', (realname,))
-            result = cur.fetchone()
-        elif username is not None:
-            cur.execute('SELECT * FROM USERS WHERE NAME=(%s)', (username,))
-            result = cur.fetchone()
-        else:
-            cur.execute('SELECT * FROM USERS')
-            result = cur.fetchall()
-            is_list = True
+        with self.stage('db'):
+            if realname is not None:
+                cur.execute('SELECT * FROM USERS WHERE REALNAME=(%s)', (realname,))
+                result = cur.fetchone()
+            elif username is not None:
+                cur.execute('SELECT * FROM USERS WHERE NAME=(%s)', (username,))
+                result = cur.fetchone()
+            else:
+                cur.execute('SELECT * FROM USERS')
+                result = cur.fetchall()
+                is_list = True
         cur.close()
-        pg_conn.close()
+        self.pg_release(pg_conn)
         return self.sql_to_json(result, is_list=is_list)
 
-    def pg_connection(self):
+    def pg_connect(self):
         """
-        Return a connection to the db.
+        Open a new connection to the db, used by the connection pool.
         """
         dbname = self.server_opts['db_name']
         user = self.server_opts['db_user']
         host = self.server_opts['db_host']
         password = self.server_opts['db_password']
-        message = ''
+        pg_conn = connect("dbname='%s' user='%s' host='%s' password='%s'"\
+            % (dbname, user, host, password))
         try:
-            pg_conn = connect("dbname='%s' user='%s' host='%s' password='%s'"\
-                % (dbname, user, host, password))
-        except OperationalError:
-            return None, 'Error : Server cannot connect to database'
+            cur = pg_conn.cursor()
+            cur.execute("""SELECT 1 FROM USERS LIMIT 1""")
+            cur.close()
+            pg_conn.rollback()
+        except ProgrammingError:
+            # Not handed out by the pool yet: closed, never given back to it
+            pg_conn.close()
+            raise
+        return pg_conn
+
+    def pg_connection(self):
+        """
+        Return a connection to the db, checked out from the pool.
+        It must be given back with pg_release.
+        """
+        message = ''
         try:
-            pg_conn.cursor().execute("""SELECT * FROM USERS""")
+            with self.stage('db_connect'):
+                pg_conn = self.pg_pool.acquire()
         except ProgrammingError:
             return None, 'Error : Server cannot connect to table in database'
+        except (OperationalError, PoolTimeout):
+            return None, 'Error : Server cannot connect to database'
         return pg_conn, message
 
-    def post(self, url, payload):
+    def pg_release(self, pg_conn):
+        """
+        Give back a connection to the pool.
+        Uncommitted changes are rolled back, broken connections are dropped.
+        """
+        if pg_conn is None:
+            return
+        try:
+            pg_conn.rollback()
+        except DatabaseError:
+            self.pg_pool.release(pg_conn, discard=True)
+            return
+        self.pg_pool.release(pg_conn, discard=bool(pg_conn.closed))
+
+    def post(self, url, payload, headers=None):
         """
-        Rebuilt POST function for CASSH purpose
+        Rebuilt POST function for CASSH purpose, the response body is read
+        and the connection is given back to the peer session
         """
-        session = Session()
         try:
-            req = session.post(url,
-                               data=payload,
-                               headers=self.req_headers,
-                               timeout=self.req_timeout)
+            req = self.peer_sessions.session(url).post(
+                url, data=payload, headers=headers, timeout=self.req_timeout)
         except req_ConnectionError:
             print('Connection error : %s' % url)
             req = None
         return req
 
-    def sign_key(self, tmp_pubkey_name, username, expiry, principals, db_cursor=None):
+    def sign_key(self, pubkey, username, expiry, principals, db_cursor=None):
         """
         Sign a key and return cert_contents
         """
-        # Load SSH CA
-        ca_ssh = Authority(self.server_opts['ca'], self.server_opts['krl'])
-
         # Sign the key
         try:
-            cert_contents = ca_ssh.sign_public_user_key(\
-                tmp_pubkey_name, username, '+'+expiry, principals)
+            with self.stage('sign'):
+                cert_contents = self.authority.sign_public_key(\
+                    pubkey, username, '+'+expiry, principals)
             if db_cursor is not None:
                 db_cursor.execute('UPDATE USERS SET STATE=0, EXPIRATION=(%s) WHERE NAME=(%s)', \
                     (time() + str2date(expiry), username))
@@ -670,50 +1541,75 @@ class Tools():
             cert_contents = 'Error : signing key'
         return cert_contents
 
+    def rebuild_principals_index(self):
+        """
+        Rebuild the principals index from the database and the LDAP mapping.
+        Returns an error message, or None.
+        """
+        pg_conn, message = self.pg_connection()
+        if pg_conn is None:
+            return message
+        cur = pg_conn.cursor()
+        cur.execute(
+            """
+            SELECT NAME,PRINCIPALS,REALNAME FROM USERS
+            """)
+        all_principals = [row for row in cur.fetchall() if isinstance(row[1], str)]
+        cur.close()
+        self.pg_release(pg_conn)
+        memberships = self.get_memberof_list([row[2] for row in all_principals])
+        self.principals_index.rebuild(
+            (name, merge_principals(
+                custom_principals,
+                memberships[realname],
+                self.server_opts).split(','))
+            for name, custom_principals, realname in all_principals)
+        return None
+
+    def update_principals_index(self, username, custom_principals, realname):
+        """
+        Update the principals of a user in the index
+        """
+        list_membership, _ = self.get_memberof(realname)
+        self.principals_index.set_user(username, merge_principals(
+            custom_principals,
+            list_membership,
+            self.server_opts).split(','))
+
     def sql_to_json(self, result, is_list=False):
         """
         This function prettify a sql result into json
         """
         if result is None:
             return None
-        ldap_conn = None
-        if self.server_opts['ldap']:
-            ldap_conn, _ = get_ldap_conn(
-                self.server_opts['ldap_host'],
-                self.server_opts['ldap_username'],
-                self.server_opts['ldap_password'],
-                self.server_opts['ldap_protocol'])
         if is_list:
+            memberships = self.get_memberof_list([res[1] for res in result])
+            with self.stage('render'):
+                d_result = {}
+                for res in result:
+                    d_sub_result = {}
+                    d_sub_result['username'] = res[0]
+                    d_sub_result['realname'] = res[1]
+                    d_sub_result['status'] = self.states[res[2]]
+                    d_sub_result['expiration'] = datetime.fromtimestamp(res[3]).strftime(
+                        '%Y-%m-%d %H:%M:%S')
+                    d_sub_result['ssh_key_hash'] = pretty_ssh_key_hash(res[4])
+                    d_sub_result['expiry'] = res[6]
+                    full_principals = merge_principals(
+                        res[7], memberships[res[1]], self.server_opts)
+                    d_sub_result['principals'] = clean_principals_output(full_principals, res[0])
+                    d_result[res[0]] = d_sub_result
+                return json.dumps(d_result, indent=4, sort_keys=True)
+        list_membership, _ = self.get_memberof(result[1])
+        with self.stage('render'):
             d_result = {}
-            for res in result:
-                d_sub_result = {}
-                d_sub_result['username'] = res[0]
-                d_sub_result['realname'] = res[1]
-                d_sub_result['status'] = self.states[res[2]]
-                d_sub_result['expiration'] = datetime.fromtimestamp(res[3]).strftime(
-                    '%Y-%m-%d %H:%M:%S')
-                d_sub_result['ssh_key_hash'] = pretty_ssh_key_hash(res[4])
-                d_sub_result['expiry'] = res[6]
-                list_membership, _ = get_memberof(
-                    res[1],
-                    self.server_opts,
-                    reuse=ldap_conn)
-                full_principals = merge_principals(res[7], list_membership, self.server_opts)
-                d_sub_result['principals'] = clean_principals_output(full_principals, res[0])
-                d_result[res[0]] = d_sub_result
+            d_result['username'] = result[0]
+            d_result['realname'] = result[1]
+            d_result['status'] = self.states[result[2]]
+            d_result['expiration'] = datetime.fromtimestamp(result[3]).strftime(
+                '%Y-%m-%d %H:%M:%S')
+            d_result['ssh_key_hash'] = pretty_ssh_key_hash(result[4])
+            d_result['expiry'] = result[6]
+            full_principals = merge_principals(result[7], list_membership, self.server_opts)
+            d_result['principals'] = clean_principals_output(full_principals, result[0])
             return json.dumps(d_result, indent=4, sort_keys=True)
-        d_result = {}
-        d_result['username'] = result[0]
-        d_result['realname'] = result[1]
-        d_result['status'] = self.states[result[2]]
-        d_result['expiration'] = datetime.fromtimestamp(result[3]).strftime(
-            '%Y-%m-%d %H:%M:%S')
-        d_result['ssh_key_hash'] = pretty_ssh_key_hash(result[4])
-        d_result['expiry'] = result[6]
-        list_membership, _ = get_memberof(
-            result[1],
-            self.server_opts,
-            reuse=ldap_conn)
-        full_principals = merge_principals(result[7], list_membership, self.server_opts)
-        d_result['principals'] = clean_principals_output(full_principals, result[0])
-        return json.dumps(d_result, indent=4, sort_keys=True)
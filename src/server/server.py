@@ -12,18 +12,19 @@ Written by Nicolas BEGUIER (nicolas_beguier@hotmail.com)
 # pylint: disable=too-many-nested-blocks,arguments-differ,W1113
 
 from json import dumps
-from os import remove
-from tempfile import NamedTemporaryFile
+from os import environ, getpid
+from re import compile as re_compile
+import sys
+from time import perf_counter
 from urllib.parse import unquote_plus
 
 # Third party library imports
-from cheroot.server import HTTPServer
-from cheroot.ssl.builtin import BuiltinSSLAdapter
 import web
 
 # Own library
-from ssh_utils import get_fingerprint
+from ssh_utils import get_fingerprint_from_string
 import lib.constants as constants
+import lib.httpd as httpd
 import lib.tools as tools
 
 # DEBUG
@@ -31,7 +32,15 @@ import lib.tools as tools
 
 VERSION = '2.3.1'
 
-SERVER_OPTS, ARGS, TOOLS = tools.loadconfig(version=VERSION)
+
+class RequestTools():
+    """
+    Tools of the application serving the current request
+    """
+    def __getattr__(self, name):
+        return getattr(web.ctx.cassh_tools, name)
+
+TOOLS = RequestTools()
 
 class Admin():
     """
@@ -45,11 +54,11 @@ class Admin():
             status=true/false => Display status
         """
         # LDAP authentication
-        is_admin_auth, message = tools.ldap_authentification(SERVER_OPTS, admin=True)
+        is_admin_auth, message = TOOLS.ldap_authentification(admin=True)
         if not is_admin_auth:
             return tools.response_render(message, http_code='401 Unauthorized')
 
-        payload, message = tools.data2map()
+        payload, message = TOOLS.request_payload()
         if message:
             return tools.response_render(message, http_code='400 Bad Request')
 
@@ -68,68 +77,86 @@ class Admin():
         cur = pg_conn.cursor()
 
         if username == 'all' and do_status:
+            cur.close()
+            TOOLS.pg_release(pg_conn)
             return tools.response_render(
                 TOOLS.list_keys(),
                 content_type='application/json')
 
         # Search if key already exists
-        cur.execute(
-            """
-            SELECT STATE FROM USERS WHERE NAME=(%s)
-            """, (username,))
-        user_state = cur.fetchone()
+        with TOOLS.stage('db'):
+            cur.execute(
+                """
+                SELECT STATE,REALNAME FROM USERS WHERE NAME=(%s)
+                """, (username,))
+            user_state = cur.fetchone()
         # If user dont exist
         if user_state is None:
             cur.close()
-            pg_conn.close()
+            TOOLS.pg_release(pg_conn)
             message = 'User does not exists.'
         elif do_revoke:
-            cur.execute(
-                """
-                UPDATE USERS SET STATE=1 WHERE NAME=(%s)
-                """, (username,))
-            pg_conn.commit()
-            pubkey = tools.get_pubkey(username, pg_conn)
-            cur.execute(
-                """
-                SELECT 1 FROM REVOCATION WHERE SSH_KEY=(%s)
-                """, (pubkey,))
-            if cur.fetchone() is None:
+            with TOOLS.stage('db'):
                 cur.execute(
                     """
-                    INSERT INTO REVOCATION VALUES ((%s), (%s), (%s))
-                    """, (pubkey, tools.timestamp(), username))
+                    UPDATE USERS SET STATE=1 WHERE NAME=(%s)
+                    """, (username,))
                 pg_conn.commit()
+            TOOLS.forget_user(user_state[1])
+            with TOOLS.stage('db'):
+                pubkey = tools.get_pubkey(username, pg_conn)
+                cur.execute(
+                    """
+                    SELECT 1 FROM REVOCATION WHERE SSH_KEY=(%s)
+                    """, (pubkey,))
+                is_revoked = cur.fetchone() is not None
+            if not is_revoked:
+                with TOOLS.stage('db'):
+                    cur.execute('SELECT MAX(REVOCATION_DATE), COUNT(*) FROM REVOCATION')
+                    previous_state = cur.fetchone()
+                    cur.execute(
+                        """
+                        INSERT INTO REVOCATION VALUES ((%s), (%s), (%s))
+                        """, (pubkey, tools.timestamp(), username))
+                    cur.execute('SELECT MAX(REVOCATION_DATE), COUNT(*) FROM REVOCATION')
+                    last_state = cur.fetchone()
+                    pg_conn.commit()
+                TOOLS.revoke_keys([pubkey], previous_state, last_state)
+                TOOLS.push_revocation(username, user_state[1], pubkey, previous_state, last_state)
                 message = 'Revoke user={}.'.format(username)
             else:
                 message = 'user {} already revoked.'.format(username)
             cur.close()
-            pg_conn.close()
+            TOOLS.pg_release(pg_conn)
         # Display status
         elif do_status:
+            cur.close()
+            TOOLS.pg_release(pg_conn)
             return tools.response_render(
                 TOOLS.list_keys(username=username),
                 content_type='application/json')
         # If user is in PENDING state
         elif user_state[0] == constants.STATES['PENDING']:
-            cur.execute(
-                """
-                UPDATE USERS SET STATE=0 WHERE NAME=(%s)
-                """, (username,))
-            pg_conn.commit()
+            with TOOLS.stage('db'):
+                cur.execute(
+                    """
+                    UPDATE USERS SET STATE=0 WHERE NAME=(%s)
+                    """, (username,))
+                pg_conn.commit()
             cur.close()
-            pg_conn.close()
+            TOOLS.pg_release(pg_conn)
             message = 'Active user=%s. SSH Key active but need to be signed.' % username
         # If user is in REVOKED state
         elif user_state[0] == constants.STATES['REVOKED']:
-            cur.execute('UPDATE USERS SET STATE=0 WHERE NAME=(%s)', (username,))
-            pg_conn.commit()
+            with TOOLS.stage('db'):
+                cur.execute('UPDATE USERS SET STATE=0 WHERE NAME=(%s)', (username,))
+                pg_conn.commit()
             cur.close()
-            pg_conn.close()
+            TOOLS.pg_release(pg_conn)
             message = 'Active user=%s. SSH Key active but need to be signed.' % username
         else:
             cur.close()
-            pg_conn.close()
+            TOOLS.pg_release(pg_conn)
             message = 'user=%s already active. Nothing done.' % username
         return tools.response_render(message)
 
@@ -140,19 +167,19 @@ class Admin():
             key=value => Set the key value. Keys are in status output.
         """
         # LDAP authentication
-        is_admin_auth, message = tools.ldap_authentification(SERVER_OPTS, admin=True)
+        is_admin_auth, message = TOOLS.ldap_authentification(admin=True)
         if not is_admin_auth:
             return tools.response_render(message, http_code='401 Unauthorized')
 
+        payload, message = TOOLS.request_payload()
+        if message:
+            return tools.response_render(message, http_code='400 Bad Request')
+
         pg_conn, message = TOOLS.pg_connection()
         if pg_conn is None:
             return tools.response_render(message, http_code='503 Service Unavailable')
         cur = pg_conn.cursor()
 
-        payload, message = tools.data2map()
-        if message:
-            return tools.response_render(message, http_code='400 Bad Request')
-
         for key, value in payload.items():
             if key == 'expiry':
                 cur.execute(
@@ -161,9 +188,11 @@ class Admin():
                     """, (value, username))
                 pg_conn.commit()
                 cur.close()
-                pg_conn.close()
+                TOOLS.pg_release(pg_conn)
                 return tools.response_render(
                     'OK: %s=%s for %s' % (key, value, username))
+        cur.close()
+        TOOLS.pg_release(pg_conn)
         return tools.response_render('WARNING: No key found...')
 
     def DELETE(self, username):
@@ -172,7 +201,7 @@ class Admin():
         /admin/<username>
         """
         # LDAP authentication
-        is_admin_auth, message = tools.ldap_authentification(SERVER_OPTS, admin=True)
+        is_admin_auth, message = TOOLS.ldap_authentification(admin=True)
         if not is_admin_auth:
             return tools.response_render(message, http_code='401 Unauthorized')
 
@@ -182,13 +211,18 @@ class Admin():
         cur = pg_conn.cursor()
 
         # Search if key already exists
-        cur.execute(
-            """
-            DELETE FROM USERS WHERE NAME=(%s)
-            """, (username,))
-        pg_conn.commit()
+        with TOOLS.stage('db'):
+            cur.execute(
+                """
+                DELETE FROM USERS WHERE NAME=(%s) RETURNING REALNAME
+                """, (username,))
+            deleted_users = cur.fetchall()
+            pg_conn.commit()
         cur.close()
-        pg_conn.close()
+        TOOLS.pg_release(pg_conn)
+        for deleted_user in deleted_users:
+            TOOLS.forget_user(deleted_user[0])
+            TOOLS.principals_index.remove_user(username)
         return tools.response_render('OK')
 
 
@@ -201,7 +235,7 @@ class Ca():
         Return ca.
         """
         return tools.response_render(
-            open(SERVER_OPTS['ca'] + '.pub', 'rb'),
+            open(TOOLS.server_opts['ca'] + '.pub', 'rb'),
             content_type='application/octet-stream')
 
 class ClientStatus():
@@ -214,11 +248,11 @@ class ClientStatus():
         /client/status
         """
         # LDAP authentication
-        is_auth, message = tools.ldap_authentification(SERVER_OPTS)
+        is_auth, message = TOOLS.ldap_authentification()
         if not is_auth:
             return tools.response_render(message, http_code='401 Unauthorized')
 
-        payload, message = tools.data2map()
+        payload, message = TOOLS.request_payload()
         if message:
             return tools.response_render(message, http_code='400 Bad Request')
 
@@ -248,22 +282,19 @@ class Client():
             admin_force=true|false
         """
         # LDAP authentication
-        is_auth, message = tools.ldap_authentification(SERVER_OPTS)
-        if not is_auth:
-            return tools.response_render(message, http_code='401 Unauthorized')
+        auth = TOOLS.auth_context()
+        if not auth['is_auth']:
+            return tools.response_render(auth['message'], http_code='401 Unauthorized')
 
         # Check if user is an admin and want to force signature when db fail
         force_sign = False
+        is_admin_auth = auth['is_admin']
 
-        # LDAP ADMIN authentication
-        is_admin_auth, message = tools.ldap_authentification(
-            SERVER_OPTS, admin=True)
-
-        payload, message = tools.data2map()
+        payload, message = TOOLS.request_payload()
         if message:
             return tools.response_render(message, http_code='400 Bad Request')
 
-        if is_admin_auth and SERVER_OPTS['admin_db_failover'] \
+        if is_admin_auth and TOOLS.server_opts['admin_db_failover'] \
             and 'admin_force' in payload and payload['admin_force'].lower() == 'true':
             force_sign = True
 
@@ -294,12 +325,10 @@ class Client():
             return tools.response_render(
                 'Error: No pubkey given.',
                 http_code='400 Bad Request')
-        with NamedTemporaryFile(delete=False) as tmp_pubkey:
-            tmp_pubkey.write(bytes(pubkey, 'utf-8'))
 
-        pubkey_fingerprint = get_fingerprint(tmp_pubkey.name)
+        with TOOLS.stage('fingerprint'):
+            pubkey_fingerprint = get_fingerprint_from_string(pubkey)
         if pubkey_fingerprint == 'Unknown':
-            remove(tmp_pubkey.name)
             return tools.response_render(
                 'Error : Public key unprocessable',
                 http_code='422 Unprocessable Entity')
@@ -307,38 +336,34 @@ class Client():
         pg_conn, message = TOOLS.pg_connection()
         # Admin force signature case
         if pg_conn is None and force_sign:
-            cert_contents = TOOLS.sign_key(tmp_pubkey.name, username, '+12h', username)
-            remove(tmp_pubkey.name)
+            cert_contents = TOOLS.sign_key(pubkey, username, '+12h', username)
             return tools.response_render(cert_contents, content_type='application/octet-stream')
         # Check if db is up
         if pg_conn is None:
-            remove(tmp_pubkey.name)
             return tools.response_render(message, http_code='503 Service Unavailable')
         cur = pg_conn.cursor()
 
         # Search if user already exists
-        cur.execute(
-            """
-            SELECT NAME,REALNAME,STATE,EXPIRY,PRINCIPALS,SSH_KEY FROM USERS
-            WHERE NAME=lower(%s)
-            """, (username,))
-        user = cur.fetchone()
+        with TOOLS.stage('db'):
+            cur.execute(
+                """
+                SELECT NAME,REALNAME,STATE,EXPIRY,PRINCIPALS,SSH_KEY_HASH FROM USERS
+                WHERE NAME=lower(%s)
+                """, (username,))
+            user = cur.fetchone()
         if user is None:
             cur.close()
-            pg_conn.close()
-            remove(tmp_pubkey.name)
+            TOOLS.pg_release(pg_conn)
             return tools.response_render(
                 'Error : User absent, please create an account.',
                 http_code='400 Bad Request')
 
-        # Get database key fingerprint
-        with NamedTemporaryFile(delete=False) as db_pubkey:
-            db_pubkey.write(bytes(user[5], 'utf-8'))
-        db_pubkey_fingerprint = get_fingerprint(db_pubkey.name)
-        remove(db_pubkey.name)
+        # Database key fingerprint, stored by Client.PUT
+        db_pubkey_fingerprint = user[5]
 
-        if db_pubkey_fingerprint == 'Unknown':
-            remove(tmp_pubkey.name)
+        if not db_pubkey_fingerprint or db_pubkey_fingerprint == 'Unknown':
+            cur.close()
+            TOOLS.pg_release(pg_conn)
             return tools.response_render(
                 'Error : Public key from database unprocessable',
                 http_code='422 Unprocessable Entity')
@@ -347,8 +372,7 @@ class Client():
             realname != user[1] or \
             db_pubkey_fingerprint != pubkey_fingerprint:
             cur.close()
-            pg_conn.close()
-            remove(tmp_pubkey.name)
+            TOOLS.pg_release(pg_conn)
             return tools.response_render(
                 'Error : (username, realname, pubkey) triple mismatch.',
                 http_code='401 Unauthorized')
@@ -356,24 +380,24 @@ class Client():
         status = user[2]
         expiry = user[3]
         custom_principals = tools.clean_principals_output(user[4], username, shell=True)
-        list_membership, _ = tools.get_memberof(
-            realname,
-            SERVER_OPTS)
-        full_principals = tools.merge_principals(custom_principals, list_membership, SERVER_OPTS)
+        if auth['realname'] == realname:
+            list_membership = auth['memberof']
+        else:
+            list_membership, _ = TOOLS.get_memberof(realname)
+        full_principals = tools.merge_principals(
+            custom_principals, list_membership, TOOLS.server_opts)
 
         if status > 0:
             cur.close()
-            pg_conn.close()
-            remove(tmp_pubkey.name)
+            TOOLS.pg_release(pg_conn)
             return tools.response_render("Status: %s" % constants.STATES[user[2]])
 
         cert_contents = TOOLS.sign_key(
-            tmp_pubkey.name, username, expiry, full_principals, db_cursor=cur)
+            pubkey, username, expiry, full_principals, db_cursor=cur)
 
-        remove(tmp_pubkey.name)
         pg_conn.commit()
         cur.close()
-        pg_conn.close()
+        TOOLS.pg_release(pg_conn)
         return tools.response_render(
             cert_contents,
             content_type='application/octet-stream')
@@ -386,11 +410,11 @@ class Client():
             realname=xxxxx@domain.fr => This LDAP/AD user.
         """
         # LDAP authentication
-        is_auth, message = tools.ldap_authentification(SERVER_OPTS)
+        is_auth, message = TOOLS.ldap_authentification()
         if not is_auth:
             return tools.response_render(message, http_code='401 Unauthorized')
 
-        payload, message = tools.data2map()
+        payload, message = TOOLS.request_payload()
         if message:
             return tools.response_render(message, http_code='400 Bad Request')
 
@@ -426,70 +450,86 @@ class Client():
             return tools.response_render(
                 'Error: No pubkey given.',
                 http_code='400 Bad Request')
-        with NamedTemporaryFile(delete=False) as tmp_pubkey:
-            tmp_pubkey.write(bytes(pubkey, 'utf-8'))
 
-        pubkey_fingerprint = get_fingerprint(tmp_pubkey.name)
+        with TOOLS.stage('fingerprint'):
+            pubkey_fingerprint = get_fingerprint_from_string(pubkey)
         if pubkey_fingerprint == 'Unknown':
-            remove(tmp_pubkey.name)
             return tools.response_render(
                 'Error : Public key unprocessable',
                 http_code='422 Unprocessable Entity')
 
         pg_conn, message = TOOLS.pg_connection()
         if pg_conn is None:
-            remove(tmp_pubkey.name)
             return tools.response_render(message, http_code='503 Service Unavailable')
         cur = pg_conn.cursor()
 
         # Search if key already exists
-        cur.execute(
-            """
-            SELECT 1 FROM USERS WHERE NAME=(%s)
-            """, (username,))
-        user = cur.fetchone()
-        # CREATE NEW USER
-        if user is None:
+        with TOOLS.stage('db'):
             cur.execute(
                 """
-                INSERT INTO USERS VALUES ((%s), (%s), (%s), (%s), (%s), (%s), (%s), (%s))
-                """, (
-                    username, realname, constants.STATES['PENDING'],
-                    0, pubkey_fingerprint, pubkey, '+12h', username))
-            pg_conn.commit()
+                SELECT 1 FROM USERS WHERE NAME=(%s)
+                """, (username,))
+            user = cur.fetchone()
+        # CREATE NEW USER
+        if user is None:
+            with TOOLS.stage('db'):
+                cur.execute(
+                    """
+                    INSERT INTO USERS VALUES ((%s), (%s), (%s), (%s), (%s), (%s), (%s), (%s))
+                    """, (
+                        username, realname, constants.STATES['PENDING'],
+                        0, pubkey_fingerprint, pubkey, '+12h', username))
+                pg_conn.commit()
             cur.close()
-            pg_conn.close()
-            remove(tmp_pubkey.name)
+            TOOLS.pg_release(pg_conn)
+            TOOLS.update_principals_index(username, username, realname)
             return tools.response_render(
                 'Create user=%s. Pending request.' % username,
                 http_code='201 Created')
         # Check if realname is the same
-        cur.execute(
-            """
-            SELECT 1 FROM USERS WHERE NAME=(%s) AND REALNAME=lower((%s))
-            """, (username, realname))
-        if cur.fetchone() is None:
+        with TOOLS.stage('db'):
+            cur.execute(
+                """
+                SELECT 1 FROM USERS WHERE NAME=(%s) AND REALNAME=lower((%s))
+                """, (username, realname))
+            is_mismatch = cur.fetchone() is None
+        if is_mismatch:
             pg_conn.commit()
             cur.close()
-            pg_conn.close()
-            remove(tmp_pubkey.name)
+            TOOLS.pg_release(pg_conn)
             return tools.response_render(
                 'Error : (username, realname) couple mismatch.',
                 http_code='401 Unauthorized')
         # Update entry into database
-        cur.execute(
-            """
-            UPDATE USERS
-            SET SSH_KEY=(%s),SSH_KEY_HASH=(%s), STATE=(%s), EXPIRATION=0
-            WHERE NAME=(%s)
-            """, (pubkey, pubkey_fingerprint, constants.STATES['PENDING'], username))
-        pg_conn.commit()
+        with TOOLS.stage('db'):
+            cur.execute(
+                """
+                UPDATE USERS
+                SET SSH_KEY=(%s),SSH_KEY_HASH=(%s), STATE=(%s), EXPIRATION=0
+                WHERE NAME=(%s)
+                """, (pubkey, pubkey_fingerprint, constants.STATES['PENDING'], username))
+            pg_conn.commit()
         cur.close()
-        pg_conn.close()
-        remove(tmp_pubkey.name)
+        TOOLS.pg_release(pg_conn)
         return tools.response_render('Update user=%s. Pending request.' % username)
 
 
+class ClusterRevoke():
+    """
+    ClusterRevoke main class.
+    """
+    def POST(self):
+        """
+        /cluster/revoke
+        Revocation pushed by a node of the cluster, signed with the clustersecret
+        """
+        message, http_code = TOOLS.apply_revocation(
+            web.data(), web.ctx.env.get('HTTP_X_CASSH_SIGNATURE'))
+        if message:
+            return tools.response_render(message, http_code=http_code)
+        return tools.response_render('OK')
+
+
 class ClusterStatus():
     """
     ClusterStatus main class.
@@ -498,14 +538,8 @@ class ClusterStatus():
         """
         /cluster/status
         """
-        message = dict()
-        alive_nodes, dead_nodes = TOOLS.cluster_alived()
-        for node in alive_nodes:
-            message.update({node: {'status': 'OK'}})
-        for node in dead_nodes:
-            message.update({node: {'status': 'KO'}})
         return tools.response_render(
-            dumps(message),
+            dumps(TOOLS.cluster_status()),
             content_type='application/json')
 
 
@@ -536,6 +570,58 @@ class Krl():
         return TOOLS.get_last_krl()
 
 
+class Metrics():
+    """
+    Class Metrics, Prometheus metrics of this process.
+    """
+    def GET(self):
+        """
+        Return the metrics in the Prometheus text format.
+        Each worker process has its own metrics, labelled with its pid.
+        """
+        return tools.response_render(
+            TOOLS.metrics.render(('worker',), (getpid(),)),
+            content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class MemberofCache():
+    """
+    Class MemberofCache, LDAP memberOf lookups cache.
+    """
+    def POST(self):
+        """
+        Display the cache statistics, or flush it.
+        /admin/all/cache/memberof
+            flush=all|<realname> => Flush every entry, or one realname
+        """
+        # LDAP authentication
+        is_admin_auth, message = TOOLS.ldap_authentification(admin=True)
+        if not is_admin_auth:
+            return tools.response_render(message, http_code='401 Unauthorized')
+
+        if TOOLS.memberof_cache is None:
+            return tools.response_render(
+                'Error: LDAP is disabled',
+                http_code='400 Bad Request')
+
+        payload, message = TOOLS.request_payload()
+        if message:
+            return tools.response_render(message, http_code='400 Bad Request')
+
+        if 'flush' not in payload:
+            return tools.response_render(
+                dumps(TOOLS.memberof_cache.stats()),
+                content_type='application/json')
+
+        flush = unquote_plus(payload['flush'])
+        if flush == 'all':
+            return tools.response_render(
+                'OK: {} entries flushed'.format(TOOLS.memberof_cache.clear()))
+        if TOOLS.memberof_cache.delete(flush):
+            return tools.response_render('OK: {} flushed'.format(flush))
+        return tools.response_render('OK: {} was not cached'.format(flush))
+
+
 class Ping():
     """
     Class Ping
@@ -556,16 +642,11 @@ class Principals():
         Manage user principals
         """
         # LDAP authentication
-        is_admin_auth, message = tools.ldap_authentification(SERVER_OPTS, admin=True)
+        is_admin_auth, message = TOOLS.ldap_authentification(admin=True)
         if not is_admin_auth:
             return tools.response_render(message, http_code='401 Unauthorized')
 
-        pg_conn, message = TOOLS.pg_connection()
-        if pg_conn is None:
-            return tools.response_render(message, http_code='503 Service Unavailable')
-        cur = pg_conn.cursor()
-
-        payload, message = tools.data2map()
+        payload, message = TOOLS.request_payload()
         if message:
             return tools.response_render(message, http_code='400 Bad Request')
 
@@ -577,17 +658,23 @@ class Principals():
                 '[ERROR] Unknown action',
                 http_code='400 Bad Request')
 
+        pg_conn, message = TOOLS.pg_connection()
+        if pg_conn is None:
+            return tools.response_render(message, http_code='503 Service Unavailable')
+        cur = pg_conn.cursor()
+
         # Search if username exists
         values = {'username': username}
-        cur.execute(
-            """
-            SELECT NAME,PRINCIPALS,REALNAME FROM USERS WHERE NAME=(%(username)s)
-            """, values)
-        user = cur.fetchone()
+        with TOOLS.stage('db'):
+            cur.execute(
+                """
+                SELECT NAME,PRINCIPALS,REALNAME FROM USERS WHERE NAME=(%(username)s)
+                """, values)
+            user = cur.fetchone()
         # If user dont exist
         if user is None:
             cur.close()
-            pg_conn.close()
+            TOOLS.pg_release(pg_conn)
             return tools.response_render(
                 "ERROR: {} doesn't exist".format(username),
                 http_code='400 Bad Request')
@@ -598,6 +685,8 @@ class Principals():
             if key == 'add':
                 for principal in value.split(','):
                     if constants.PATTERN_PRINCIPALS.match(principal) is None:
+                        cur.close()
+                        TOOLS.pg_release(pg_conn)
                         return tools.response_render(
                             "Error: principal doesn't match pattern {}".format(
                                 constants.PATTERN_PRINCIPALS.pattern),
@@ -610,6 +699,8 @@ class Principals():
                 principals = values['principals'].split(',')
                 for principal in value.split(','):
                     if constants.PATTERN_PRINCIPALS.match(principal) is None:
+                        cur.close()
+                        TOOLS.pg_release(pg_conn)
                         return tools.response_render(
                             "Error: principal doesn't match pattern {}".format(
                                 constants.PATTERN_PRINCIPALS.pattern),
@@ -620,6 +711,8 @@ class Principals():
             elif key == 'update':
                 for principal in value.split(','):
                     if constants.PATTERN_PRINCIPALS.match(principal) is None:
+                        cur.close()
+                        TOOLS.pg_release(pg_conn)
                         return tools.response_render(
                             "Error: principal doesn't match pattern {}".format(
                                 constants.PATTERN_PRINCIPALS.pattern),
@@ -628,27 +721,27 @@ class Principals():
             elif key == 'purge':
                 values['principals'] = username
 
-        list_membership, _ = tools.get_memberof(
-            user[2],
-            SERVER_OPTS)
+        list_membership, _ = TOOLS.get_memberof(user[2])
         values['principals'] = tools.truncate_principals(
             values['principals'],
             list_membership,
-            SERVER_OPTS)
+            TOOLS.server_opts)
 
-        cur.execute(
-            """
-            UPDATE USERS SET PRINCIPALS=(%(principals)s) WHERE NAME=(%(username)s)
-            """, values)
-        pg_conn.commit()
+        with TOOLS.stage('db'):
+            cur.execute(
+                """
+                UPDATE USERS SET PRINCIPALS=(%(principals)s) WHERE NAME=(%(username)s)
+                """, values)
+            pg_conn.commit()
         cur.close()
-        pg_conn.close()
+        TOOLS.pg_release(pg_conn)
 
         # Add LDAP principals
         values['principals'] = tools.merge_principals(
             values['principals'],
             list_membership,
-            SERVER_OPTS)
+            TOOLS.server_opts)
+        TOOLS.principals_index.set_user(username, values['principals'].split(','))
 
         return tools.response_render(
             "OK: {} principals are '{}'".format(username, values['principals']))
@@ -663,16 +756,11 @@ class PrincipalsSearch():
         Search user's principals by filter
         """
         # LDAP authentication
-        is_admin_auth, message = tools.ldap_authentification(SERVER_OPTS, admin=True)
+        is_admin_auth, message = TOOLS.ldap_authentification(admin=True)
         if not is_admin_auth:
             return tools.response_render(message, http_code='401 Unauthorized')
 
-        pg_conn, message = TOOLS.pg_connection()
-        if pg_conn is None:
-            return tools.response_render(message, http_code='503 Service Unavailable')
-        cur = pg_conn.cursor()
-
-        payload, message = tools.data2map()
+        payload, message = TOOLS.request_payload()
         if message:
             return tools.response_render(message, http_code='400 Bad Request')
 
@@ -681,55 +769,17 @@ class PrincipalsSearch():
                 '[ERROR] Unknown action',
                 http_code='400 Bad Request')
 
-        cur.execute(
-            """
-            SELECT NAME,PRINCIPALS,REALNAME FROM USERS
-            """)
-        all_principals = cur.fetchall()
-        pg_conn.commit()
-        cur.close()
-        pg_conn.close()
-
-        if SERVER_OPTS['ldap']:
-            ldap_conn, _ = tools.get_ldap_conn(
-                SERVER_OPTS['ldap_host'],
-                SERVER_OPTS['ldap_username'],
-                SERVER_OPTS['ldap_password'],
-                SERVER_OPTS['ldap_protocol'])
-
-        result = dict()
+        if 'rebuild' in payload and payload['rebuild'].lower() == 'true' \
+            or TOOLS.principals_index.is_stale():
+            message = TOOLS.rebuild_principals_index()
+            if message:
+                return tools.response_render(message, http_code='503 Service Unavailable')
 
-        for key, value in payload.items():
-            value = unquote_plus(value)
-            if key == 'filter' and value == '':
-                for name, custom_principals, realname in all_principals:
-                    if not isinstance(custom_principals, str):
-                        continue
-                    list_membership, _ = tools.get_memberof(
-                        realname,
-                        SERVER_OPTS,
-                        reuse=ldap_conn)
-                    result[name] = tools.merge_principals(
-                        custom_principals,
-                        list_membership,
-                        SERVER_OPTS).split(',')
-            elif key == 'filter':
-                for principal in value.split(','):
-                    for name, custom_principals, realname in all_principals:
-                        if not isinstance(custom_principals, str):
-                            continue
-                        list_membership, _ = tools.get_memberof(
-                            realname,
-                            SERVER_OPTS,
-                            reuse=ldap_conn)
-                        principals = tools.merge_principals(
-                            custom_principals,
-                            list_membership,
-                            SERVER_OPTS).split(',')
-                        if principal in principals:
-                            if name not in result:
-                                result[name] = list()
-                            result[name].append(principal)
+        value = unquote_plus(payload['filter'])
+        if value == '':
+            result = TOOLS.principals_index.all_principals()
+        else:
+            result = TOOLS.principals_index.search(value.split(','))
 
         return tools.response_render(dumps(result))
 
@@ -742,7 +792,7 @@ class TestAuth():
         Test authentication
         """
         # LDAP authentication
-        is_auth, message = tools.ldap_authentification(SERVER_OPTS)
+        is_auth, message = TOOLS.ldap_authentification()
         if not is_auth:
             return tools.response_render(message, http_code='401 Unauthorized')
         return tools.response_render('OK')
@@ -751,21 +801,94 @@ class MyApplication(web.application):
     """
     Can change port or other stuff
     """
-    def run(self, port=int(SERVER_OPTS['port']), *middleware):
+    def __init__(self, tooling):
+        super().__init__(constants.URLS, globals(), autoreload=False)
+        self.tools = tooling
+        # Handler class of each URL pattern, to label the metrics
+        self.handler_names = [
+            (re_compile(r'^%s\Z' % pattern), name) for pattern, name in self.mapping]
+        self.add_processor(self.tools_processor)
+
+    def handler_name(self, path):
+        """
+        Returns the handler class name of a path, NotFound if none
+        """
+        for pattern, name in self.handler_names:
+            if pattern.match(path):
+                return name
+        return 'NotFound'
+
+    def tools_processor(self, handler):
+        """
+        Give the handlers the Tools of this application,
+        pools and background threads are started at the first request.
+        Requests are counted and timed by handler class, and optionnaly
+        broken down by stage in a Server-Timing header and a JSON log line.
+        """
+        web.ctx.cassh_tools = self.tools
+        self.tools.start()
+        handler_name = self.handler_name(web.ctx.path)
+        server_opts = self.tools.server_opts
+        if server_opts['server_timing'] or server_opts['timing_log']:
+            web.ctx.cassh_timings = dict()
+        start = perf_counter()
+        try:
+            result = handler()
+        except web.HTTPError:
+            raise
+        except Exception:
+            web.ctx.status = '500 Internal Server Error'
+            raise
+        finally:
+            duration = perf_counter() - start
+            self.tools.request_duration.observe(duration, handler_name, web.ctx.method)
+            self.tools.requests_total.inc(
+                handler_name, web.ctx.method, web.ctx.status.split(' ', 1)[0])
+            if server_opts['server_timing']:
+                web.header('Server-Timing', tools.server_timing(
+                    web.ctx.cassh_timings, duration))
+            if server_opts['timing_log']:
+                print(tools.timing_log(handler_name, web.ctx.cassh_timings, duration))
+        return result
+
+    def run(self, *middleware):
         func = self.wsgifunc(*middleware)
-        return web.httpserver.runsimple(func, ('0.0.0.0', port))
+        return httpd.serve(func, self.tools.server_opts, on_start=self.tools.start)
+
+def create_app(config=None):
+    """
+    WSGI application factory.
+    config is a configuration file path, or a dict {section: {option: value}},
+    the path is read from the CASSH_CONFIG environment variable by default.
+    Nothing is started before the first request, so the application can be
+    created before a pre-fork WSGI server forks its workers.
+    """
+    if config is None:
+        config = environ.get('CASSH_CONFIG')
+        if not config:
+            raise ValueError('Error: no configuration, CASSH_CONFIG is not set')
+    server_opts = tools.read_config(config)
+    web.config.debug = server_opts['debug']
+    return MyApplication(tools.Tools(server_opts, constants.STATES, VERSION)).wsgifunc()
 
 if __name__ == "__main__":
-    if SERVER_OPTS['ssl']:
-        HTTPServer.ssl_adapter = BuiltinSSLAdapter(
-            certificate=SERVER_OPTS['ssl_public_key'],
-            private_key=SERVER_OPTS['ssl_private_key'])
+    ARGS = tools.parse_args()
+    SERVER_OPTS = tools.read_config(ARGS.config, verbose=ARGS.verbose)
+    APP = MyApplication(tools.Tools(SERVER_OPTS, constants.STATES, VERSION))
+    # One-shot maintenance commands
+    if ARGS.check_key_hashes or ARGS.fix_key_hashes:
+        sys.exit(APP.tools.check_key_hashes(fix=ARGS.fix_key_hashes))
+    if ARGS.rebuild_krl:
+        MESSAGE = APP.tools.refresh_krl(force=True)
+        if MESSAGE:
+            print(MESSAGE)
+        sys.exit(1 if MESSAGE else 0)
     if ARGS.verbose:
         print('SSL: %s' % SERVER_OPTS['ssl'])
         print('LDAP: %s' % SERVER_OPTS['ldap'])
         print('Admin DB Failover: %s' % SERVER_OPTS['admin_db_failover'])
-    APP = MyApplication(constants.URLS, globals(), autoreload=False)
+        print('Workers: %s x %s threads' % (SERVER_OPTS['workers'], SERVER_OPTS['threads']))
     web.config.debug = SERVER_OPTS['debug']
     if SERVER_OPTS['debug']:
         print('Debug mode on')
-    APP.run()
+    sys.exit(APP.run())
@@ -8,16 +8,45 @@ Written by Nicolas BEGUIER (nicolas_beguier@hotmail.com)
 
 """
 
+from collections import Counter
 from os import remove
+from struct import unpack_from
 from subprocess import check_output, CalledProcessError
+from tempfile import NamedTemporaryFile
+from threading import Lock
+
+# Own library
+from ssh_utils.pubkey import fingerprint_sha512, normalize_public_key, parse_public_key
+
+# Certificate key types: ssh-rsa-cert-v01@openssh.com...
+CERT_KEY_TYPE_SUFFIX = '-cert-v01@openssh.com'
+
+# ssh-keygen calls of this process, by action
+SSH_KEYGEN_CALLS = Counter()
+SSH_KEYGEN_CALLS_LOCK = Lock()
+
+def ssh_keygen(action, args):
+    """
+    Run ssh-keygen with args, returns its output.
+    action (fingerprint, sign, krl) is only used to count the calls.
+    """
+    with SSH_KEYGEN_CALLS_LOCK:
+        SSH_KEYGEN_CALLS[action] += 1
+    return check_output(['ssh-keygen'] + args)
+
+def ssh_keygen_calls():
+    """
+    Returns {action: ssh-keygen calls count} of this process
+    """
+    with SSH_KEYGEN_CALLS_LOCK:
+        return dict(SSH_KEYGEN_CALLS)
 
 def get_fingerprint(public_key_filename):
     """
-    Returns a key fingerprint
+    Returns a key fingerprint, computed by ssh-keygen
     """
     try:
-        fingerprint = ' '.join(check_output([
-            'ssh-keygen',
+        fingerprint = ' '.join(ssh_keygen('fingerprint', [
             '-l',
             '-E', 'sha512',
             '-f', public_key_filename]).decode('utf-8').split('\n')[0].split()[:2])
@@ -25,6 +54,54 @@ def get_fingerprint(public_key_filename):
         fingerprint = 'Unknown'
     return fingerprint
 
+def get_fingerprint_from_string(public_key):
+    """
+    Returns a key fingerprint from a public key string, without ssh-keygen
+    except for certificates.
+    Same output as get_fingerprint: "<bits> SHA512:<hash>"
+    """
+    try:
+        _, key_bits, key_blob, _ = parse_public_key(public_key)
+    except ValueError:
+        if CERT_KEY_TYPE_SUFFIX not in public_key:
+            return 'Unknown'
+        # Certificates are not parsed in-process: fingerprinted by ssh-keygen
+        with NamedTemporaryFile(mode='w', delete=False) as tmp_pubkey:
+            tmp_pubkey.write(public_key)
+        try:
+            return get_fingerprint(tmp_pubkey.name)
+        finally:
+            remove(tmp_pubkey.name)
+    return '{} {}'.format(key_bits, fingerprint_sha512(key_blob))
+
+def read_krl_version(krl_contents):
+    """
+    Returns the version number stored in a KRL header, or None if the
+    contents are not a KRL
+    """
+    if len(krl_contents) < 20 or krl_contents[:8] != b'SSHKRL\n\x00':
+        return None
+    return unpack_from('>Q', krl_contents, 12)[0]
+
+def get_krl_version(krl_filename):
+    """
+    Returns the version number of a KRL file, or None if the file is
+    missing or is not a KRL
+    """
+    try:
+        with open(krl_filename, 'rb') as krl_file:
+            return read_krl_version(krl_file.read(20))
+    except OSError:
+        return None
+
+def krl_version_option(version):
+    """
+    Returns the ssh-keygen option setting the KRL version number
+    """
+    if version is None:
+        return []
+    return ['-z', str(version)]
+
 def get_cert_contents(public_key_filename):
     """
     Print cert
@@ -49,8 +126,7 @@ class Authority():
         """
         Sign public key
         """
-        check_output([
-            'ssh-keygen',
+        ssh_keygen('sign', [
             '-s', self.ca_key,
             '-I', username,
             '-V', duration,
@@ -58,23 +134,85 @@ class Authority():
             public_key_filename])
         return get_cert_contents(public_key_filename)
 
-    def generate_empty_krl(self):
+    def sign_public_key(self, public_key, username, duration, principals):
+        """
+        Sign a public key given as a string
+        """
+        with NamedTemporaryFile(delete=False) as tmp_pubkey:
+            tmp_pubkey.write(bytes(public_key, 'utf-8'))
+        try:
+            return self.sign_public_user_key(tmp_pubkey.name, username, duration, principals)
+        finally:
+            remove(tmp_pubkey.name)
+
+    def generate_empty_krl(self, version=None):
         """
         Generates an empty KRL file.
         """
-        check_output([
-            'ssh-keygen',
+        ssh_keygen('krl', [
             '-k',
-            '-f', self.krl])
+            '-f', self.krl] + krl_version_option(version))
+
+    def generate_krl_from_keys(self, public_keys, version=None):
+        """
+        Generates the KRL file revoking every key of the public_keys iterable,
+        in one ssh-keygen call. Keys are streamed to a KRL specification file,
+        invalid keys are skipped.
+        Returns (number of revoked keys, number of invalid keys).
+        """
+        revoked = invalid = 0
+        with NamedTemporaryFile(mode='w', delete=False) as krl_spec:
+            for public_key in public_keys:
+                try:
+                    krl_spec.write(normalize_public_key(public_key or '') + '\n')
+                except ValueError:
+                    invalid += 1
+                    continue
+                revoked += 1
+        try:
+            if not revoked:
+                self.generate_empty_krl(version=version)
+            else:
+                ssh_keygen('krl', [
+                    '-k',
+                    '-f', self.krl,
+                    '-s', self.ca_key] + krl_version_option(version) + [krl_spec.name])
+        finally:
+            remove(krl_spec.name)
+        return revoked, invalid
 
-    def update_krl(self, public_key_filename):
+    def update_krl(self, public_key_filename, version=None):
         """
         Update KRL by revoking key.
         """
-        check_output([
-            'ssh-keygen',
+        ssh_keygen('krl', [
             '-k',
             '-f', self.krl,
             '-u',
-            '-s', self.ca_key,
-            public_key_filename])
+            '-s', self.ca_key] + krl_version_option(version) + [public_key_filename])
+
+    def is_revoked(self, public_key):
+        """
+        Returns True if the KRL revokes the key given as a string.
+        """
+        with NamedTemporaryFile(delete=False) as tmp_pubkey:
+            tmp_pubkey.write(bytes(public_key.strip() + '\n', 'utf-8'))
+        try:
+            ssh_keygen('krl', ['-Q', '-f', self.krl, tmp_pubkey.name])
+        except CalledProcessError as err:
+            return b'REVOKED' in (err.output or b'')
+        finally:
+            remove(tmp_pubkey.name)
+        return False
+
+    def revoke_public_keys(self, public_keys, version=None):
+        """
+        Update KRL by revoking several keys given as strings, in one ssh-keygen call.
+        """
+        with NamedTemporaryFile(delete=False) as tmp_pubkeys:
+            for public_key in public_keys:
+                tmp_pubkeys.write(bytes(public_key.strip() + '\n', 'utf-8'))
+        try:
+            self.update_krl(tmp_pubkeys.name, version=version)
+        finally:
+            remove(tmp_pubkeys.name)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+ssh_utils cert lib
+
+OpenSSH certificates signed in memory, without ssh-keygen.
+
+Copyright 2017-2022 Nicolas BEGUIER
+Licensed under the Apache License, Version 2.0
+Written by Nicolas BEGUIER (nicolas_beguier@hotmail.com)
+
+"""
+
+from base64 import b64encode
+from re import compile as re_compile
+from time import time
+
+# Third party library imports, optional requirement (sign_backend = native)
+# pylint: disable=import-error
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from cryptography.hazmat.primitives.serialization.ssh import (
+    load_ssh_private_key, load_ssh_public_key, SSHCertificateBuilder, SSHCertificateType)
+# pylint: enable=import-error
+
+# Own library
+from ssh_utils import Authority
+from ssh_utils.pubkey import parse_public_key, read_string
+
+PATTERN_TIMESPEC = re_compile('([0-9]+)([smhdw]?)')
+TIMESPEC_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+# Public key types signed in memory, others are given to ssh-keygen
+NATIVE_KEY_TYPES = ['RSA', 'ECDSA', 'ED25519']
+
+# Same default extensions as ssh-keygen -s
+DEFAULT_EXTENSIONS = [
+    b'permit-X11-forwarding',
+    b'permit-agent-forwarding',
+    b'permit-port-forwarding',
+    b'permit-pty',
+    b'permit-user-rc',
+]
+
+def load_ca_key(ca_key):
+    """
+    Returns the CA private key, in OpenSSH or PEM format
+    """
+    with open(ca_key, 'rb') as ca_key_file:
+        ca_key_contents = ca_key_file.read()
+    if b'OPENSSH PRIVATE KEY' in ca_key_contents:
+        return load_ssh_private_key(ca_key_contents, password=None)
+    return load_pem_private_key(ca_key_contents, password=None)
+
+def parse_duration(duration):
+    """
+    Returns seconds from a relative ssh-keygen time spec: +12h, +1d, +1w2d...
+    """
+    timespec = duration.lstrip('+').lower()
+    position = 0
+    seconds = 0
+    while position < len(timespec):
+        match = PATTERN_TIMESPEC.match(timespec, position)
+        if match is None or match.end() == position:
+            raise ValueError('Invalid duration: {}'.format(duration))
+        seconds += int(match.group(1)) * TIMESPEC_UNITS[match.group(2)]
+        position = match.end()
+    if not seconds:
+        raise ValueError('Invalid duration: {}'.format(duration))
+    return seconds
+
+
+class NativeAuthority(Authority):
+    """
+    Authority which builds certificates in memory.
+    The CA private key is loaded once. DSA and security keys are still
+    signed by ssh-keygen.
+    """
+    def __init__(self, ca_key, krl):
+        super().__init__(ca_key, krl)
+        self.ca_private_key = load_ca_key(ca_key)
+
+    def sign_public_key(self, public_key, username, duration, principals):
+        """
+        Sign a public key given as a string, returns the certificate line
+        """
+        key_type, _, key_blob, comment = parse_public_key(public_key)
+        if key_type not in NATIVE_KEY_TYPES:
+            return super().sign_public_key(public_key, username, duration, principals)
+        raw_key_type, _ = read_string(key_blob, 0)
+        user_key = load_ssh_public_key(raw_key_type + b' ' + b64encode(key_blob))
+
+        valid_principals = [p.encode() for p in principals.split(',') if p]
+        if not valid_principals:
+            raise ValueError('Refuse to sign a certificate valid for all principals')
+
+        # Same validity as ssh-keygen -V +<duration>
+        now = int(time())
+        builder = SSHCertificateBuilder() \
+            .public_key(user_key) \
+            .serial(0) \
+            .type(SSHCertificateType.USER) \
+            .key_id(username.encode()) \
+            .valid_principals(valid_principals) \
+            .valid_after(now - now % 60 - 60) \
+            .valid_before(now + parse_duration(duration))
+        for extension in DEFAULT_EXTENSIONS:
+            builder = builder.add_extension(extension, b'')
+        cert = builder.sign(self.ca_private_key).public_bytes().decode('utf-8')
+        if comment:
+            cert += ' ' + comment
+        return cert + '\n'
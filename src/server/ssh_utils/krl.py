@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""
+ssh_utils krl lib
+
+OpenSSH Key Revocation List reader and writer, without ssh-keygen.
+Format described in PROTOCOL.krl of OpenSSH.
+
+Copyright 2017-2022 Nicolas BEGUIER
+Licensed under the Apache License, Version 2.0
+Written by Nicolas BEGUIER (nicolas_beguier@hotmail.com)
+
+"""
+
+from hashlib import sha256
+from struct import pack, unpack_from
+from time import time
+
+# Own library
+from ssh_utils.pubkey import parse_public_key, read_string
+
+KRL_MAGIC = b'SSHKRL\n\x00'
+KRL_FORMAT_VERSION = 1
+# format version, KRL version, generated date, flags
+KRL_HEADER_FORMAT = '>IQQQ'
+KRL_HEADER_SIZE = 28
+
+KRL_SECTION_CERTIFICATES = 1
+KRL_SECTION_EXPLICIT_KEY = 2
+KRL_SECTION_FINGERPRINT_SHA256 = 5
+
+KRL_SECTION_CERT_SERIAL_LIST = 0x20
+KRL_SECTION_CERT_KEY_ID = 0x23
+
+def ssh_string(value):
+    """
+    Returns value as an SSH string
+    """
+    return pack('>I', len(value)) + value
+
+def ssh_section(section_type, section_data):
+    """
+    Returns a KRL section
+    """
+    return pack('B', section_type) + ssh_string(section_data)
+
+def read_strings(blob):
+    """
+    Returns the list of SSH strings filling blob
+    """
+    strings = list()
+    offset = 0
+    while offset < len(blob):
+        value, offset = read_string(blob, offset)
+        strings.append(value)
+    return strings
+
+def read_sections(blob, offset):
+    """
+    Returns the list of (section type, section data) of blob from offset
+    """
+    sections = list()
+    while offset < len(blob):
+        section_type = blob[offset]
+        section_data, offset = read_string(blob, offset + 1)
+        sections.append((section_type, section_data))
+    return sections
+
+
+class Krl():
+    """
+    Key Revocation List, built in memory.
+    Keys and hashes are sorted like ssh-keygen does, so a KRL revoking
+    the same public keys is identical to the ssh-keygen one.
+    """
+    def __init__(self, version=0, comment=''):
+        self.version = version
+        self.comment = comment
+        self.keys = set()
+        self.sha256s = set()
+        # CA key blob => (set of serials, set of key IDs)
+        self.certs = dict()
+
+    def revoke_key(self, key_blob):
+        """
+        Revoke a public key blob
+        """
+        self.keys.add(key_blob)
+
+    def revoke_key_sha256(self, key_blob):
+        """
+        Revoke a public key by its SHA256 hash, which is shorter than
+        an explicit RSA key
+        """
+        self.sha256s.add(sha256(key_blob).digest())
+
+    def revoke_public_key(self, public_key, hashed=False):
+        """
+        Revoke the first valid key of a public key string.
+        Raises ValueError if there is no valid key.
+        """
+        _, _, key_blob, _ = parse_public_key(public_key)
+        if hashed:
+            self.revoke_key_sha256(key_blob)
+        else:
+            self.revoke_key(key_blob)
+
+    def revoke_cert_serial(self, ca_blob, serial):
+        """
+        Revoke certificates signed by the CA key blob, by serial
+        """
+        if serial <= 0:
+            raise ValueError('Certificate serial must be positive')
+        self.certs.setdefault(ca_blob, (set(), set()))[0].add(serial)
+
+    def revoke_cert_key_id(self, ca_blob, key_id):
+        """
+        Revoke certificates signed by the CA key blob, by key ID
+        """
+        if not key_id:
+            raise ValueError('Certificate key ID must not be empty')
+        self.certs.setdefault(ca_blob, (set(), set()))[1].add(key_id)
+
+    def to_bytes(self, generated_date=None):
+        """
+        Returns the KRL binary contents
+        """
+        if generated_date is None:
+            generated_date = int(time())
+        krl = [
+            KRL_MAGIC,
+            pack(KRL_HEADER_FORMAT, KRL_FORMAT_VERSION, self.version, generated_date, 0),
+            ssh_string(b''),
+            ssh_string(self.comment.encode('utf-8')),
+        ]
+        for ca_blob, (serials, key_ids) in self.certs.items():
+            section = [ssh_string(ca_blob), ssh_string(b'')]
+            if serials:
+                section.append(ssh_section(
+                    KRL_SECTION_CERT_SERIAL_LIST,
+                    b''.join(pack('>Q', serial) for serial in sorted(serials))))
+            if key_ids:
+                section.append(ssh_section(
+                    KRL_SECTION_CERT_KEY_ID,
+                    b''.join(ssh_string(key_id.encode('utf-8')) for key_id in sorted(key_ids))))
+            krl.append(ssh_section(KRL_SECTION_CERTIFICATES, b''.join(section)))
+        if self.keys:
+            krl.append(ssh_section(
+                KRL_SECTION_EXPLICIT_KEY,
+                b''.join(ssh_string(key_blob) for key_blob in sorted(self.keys))))
+        if self.sha256s:
+            krl.append(ssh_section(
+                KRL_SECTION_FINGERPRINT_SHA256,
+                b''.join(ssh_string(key_hash) for key_hash in sorted(self.sha256s))))
+        return b''.join(krl)
+
+    def write(self, krl_filename):
+        """
+        Write the KRL file
+        """
+        with open(krl_filename, 'wb') as krl_file:
+            krl_file.write(self.to_bytes())
+
+    def is_revoked(self, public_key):
+        """
+        Returns True if the first valid key of a public key string is revoked,
+        as a key or by its SHA256 hash.
+        Raises ValueError if there is no valid key.
+        """
+        _, _, key_blob, _ = parse_public_key(public_key)
+        return key_blob in self.keys or sha256(key_blob).digest() in self.sha256s
+
+    @classmethod
+    def from_bytes(cls, contents):
+        """
+        Returns the Krl of KRL binary contents, written by this module or by
+        ssh-keygen. Raises ValueError if it is invalid, or if it has sections
+        this module does not write (serial ranges, signatures...).
+        """
+        if not contents.startswith(KRL_MAGIC) or \
+            len(contents) < len(KRL_MAGIC) + KRL_HEADER_SIZE:
+            raise ValueError('not a KRL')
+        format_version, version, _, _ = unpack_from(
+            KRL_HEADER_FORMAT, contents, len(KRL_MAGIC))
+        if format_version != KRL_FORMAT_VERSION:
+            raise ValueError('unsupported KRL format version')
+        # Reserved string, then comment
+        _, offset = read_string(contents, len(KRL_MAGIC) + KRL_HEADER_SIZE)
+        comment, offset = read_string(contents, offset)
+        krl = cls(version=version, comment=comment.decode('utf-8'))
+        for section_type, section_data in read_sections(contents, offset):
+            if section_type == KRL_SECTION_EXPLICIT_KEY:
+                krl.keys.update(read_strings(section_data))
+            elif section_type == KRL_SECTION_FINGERPRINT_SHA256:
+                krl.sha256s.update(read_strings(section_data))
+            elif section_type == KRL_SECTION_CERTIFICATES:
+                krl.read_certificates(section_data)
+            else:
+                raise ValueError('unsupported KRL section %s' % section_type)
+        return krl
+
+    def read_certificates(self, section_data):
+        """
+        Add the revoked serials and key IDs of a certificates section
+        """
+        ca_blob, offset = read_string(section_data, 0)
+        # Reserved string
+        _, offset = read_string(section_data, offset)
+        serials, key_ids = self.certs.setdefault(ca_blob, (set(), set()))
+        for section_type, subsection_data in read_sections(section_data, offset):
+            if section_type == KRL_SECTION_CERT_SERIAL_LIST and not len(subsection_data) % 8:
+                serials.update(unpack_from('>Q', subsection_data, index)[0]
+                               for index in range(0, len(subsection_data), 8))
+            elif section_type == KRL_SECTION_CERT_KEY_ID:
+                key_ids.update(key_id.decode('utf-8') for key_id in read_strings(subsection_data))
+            else:
+                raise ValueError('unsupported KRL certificates section %s' % section_type)
+
+
+def read_krl(krl_filename):
+    """
+    Returns the Krl of a KRL file, see Krl.from_bytes
+    """
+    with open(krl_filename, 'rb') as krl_file:
+        return Krl.from_bytes(krl_file.read())
+
+
+def write_krl_from_keys(krl_filename, public_keys, version=0, hashed=False):
+    """
+    Writes the KRL file revoking every key of the public_keys iterable,
+    in one pass. Same result as ssh_utils.Authority.generate_krl_from_keys.
+    Returns (revoked keys count, invalid keys count)
+    """
+    krl = Krl(version=version)
+    revoked = 0
+    invalid = 0
+    for public_key in public_keys:
+        try:
+            krl.revoke_public_key(public_key, hashed=hashed)
+        except ValueError:
+            invalid += 1
+            continue
+        revoked += 1
+    krl.write(krl_filename)
+    return revoked, invalid
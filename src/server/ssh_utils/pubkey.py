@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+ssh_utils pubkey lib
+
+OpenSSH public key wire format parser, without ssh-keygen.
+
+Copyright 2017-2022 Nicolas BEGUIER
+Licensed under the Apache License, Version 2.0
+Written by Nicolas BEGUIER (nicolas_beguier@hotmail.com)
+
+"""
+
+from base64 import b64decode, b64encode
+from binascii import Error as b64Error
+from hashlib import sha512
+from struct import unpack_from
+
+# Same limits as OpenSSH
+RSA_MIN_MODULUS_SIZE = 1024
+BIGNUM_MAX_BYTES = 16384 // 8
+ED25519_PK_SIZE = 32
+
+# (field size in bits, prime, b) of y^2 = x^3 - 3x + b
+EC_CURVES = {
+    b'nistp256': (
+        256,
+        2**256 - 2**224 + 2**192 + 2**96 - 1,
+        0x5ac635d8aa3a93e7b3ebbd55769886bc651d06b0cc53b0f63bce3c3e27d2604b),
+    b'nistp384': (
+        384,
+        2**384 - 2**128 - 2**96 + 2**32 - 1,
+        int('b3312fa7e23ee7e4988e056be3f82d19181d9c6efe814112'
+            '0314088f5013875ac656398d8a2ed19d2a85c8edd3ec2aef', 16)),
+    b'nistp521': (
+        521,
+        2**521 - 1,
+        int('0051953eb9618e1c9a1f929a21a0b68540eea2da725b99b315f3b8b4'
+            '89918ef109e156193951ec7e937b1652c0bd3bb1bf073573df883d2c'
+            '34f1ef451fd46b503f00', 16)),
+}
+
+# key type => label displayed by ssh-keygen
+KEY_TYPES = {
+    b'ssh-rsa': 'RSA',
+    b'ssh-dss': 'DSA',
+    b'ecdsa-sha2-nistp256': 'ECDSA',
+    b'ecdsa-sha2-nistp384': 'ECDSA',
+    b'ecdsa-sha2-nistp521': 'ECDSA',
+    b'ssh-ed25519': 'ED25519',
+    b'sk-ecdsa-sha2-nistp256@openssh.com': 'ECDSA-SK',
+    b'sk-ssh-ed25519@openssh.com': 'ED25519-SK',
+}
+
+
+def read_string(blob, offset):
+    """
+    Returns an SSH string and the next offset
+    """
+    if offset + 4 > len(blob):
+        raise ValueError('truncated string length')
+    length, = unpack_from('>I', blob, offset)
+    offset += 4
+    if offset + length > len(blob):
+        raise ValueError('truncated string')
+    return blob[offset:offset + length], offset + length
+
+def read_mpint(blob, offset):
+    """
+    Returns a positive SSH mpint and the next offset
+    """
+    value, offset = read_string(blob, offset)
+    if value and value[0] & 0x80:
+        raise ValueError('negative mpint')
+    value = value.lstrip(b'\x00')
+    if len(value) > BIGNUM_MAX_BYTES:
+        raise ValueError('mpint too large')
+    return int.from_bytes(value, 'big'), offset
+
+def check_ec_point(curve_name, point):
+    """
+    Raise ValueError if point is not a valid public point of the curve
+    """
+    bits, prime, coef_b = EC_CURVES[curve_name]
+    size = (bits + 7) // 8
+    if len(point) != 1 + 2 * size or point[0] != 4:
+        raise ValueError('invalid ec point encoding')
+    pt_x = int.from_bytes(point[1:1 + size], 'big')
+    pt_y = int.from_bytes(point[1 + size:], 'big')
+    if pt_x >= prime or pt_y >= prime:
+        raise ValueError('ec point out of range')
+    if (pt_y * pt_y - (pt_x * pt_x * pt_x - 3 * pt_x + coef_b)) % prime:
+        raise ValueError('ec point not on curve')
+    # Same sanity check as sshkey_ec_validate_public
+    if pt_x.bit_length() <= bits // 2 or pt_y.bit_length() <= bits // 2:
+        raise ValueError('ec point coordinates too small')
+    return bits
+
+def parse_key_blob(key_blob):
+    """
+    Returns (key_type, key_bits) from a raw public key blob
+    """
+    key_type, offset = read_string(key_blob, 0)
+    if key_type not in KEY_TYPES:
+        raise ValueError('unsupported key type')
+
+    if key_type == b'ssh-rsa':
+        _, offset = read_mpint(key_blob, offset)
+        modulus, offset = read_mpint(key_blob, offset)
+        key_bits = modulus.bit_length()
+        if key_bits < RSA_MIN_MODULUS_SIZE:
+            raise ValueError('rsa modulus too small')
+    elif key_type == b'ssh-dss':
+        prime, offset = read_mpint(key_blob, offset)
+        for _ in range(3):
+            _, offset = read_mpint(key_blob, offset)
+        key_bits = prime.bit_length()
+    elif key_type in (b'ssh-ed25519', b'sk-ssh-ed25519@openssh.com'):
+        public_key, offset = read_string(key_blob, offset)
+        if len(public_key) != ED25519_PK_SIZE:
+            raise ValueError('invalid ed25519 key size')
+        key_bits = 256
+    else:
+        curve_name, offset = read_string(key_blob, offset)
+        if not key_type.split(b'@')[0].endswith(b'-' + curve_name):
+            raise ValueError('curve mismatch')
+        point, offset = read_string(key_blob, offset)
+        key_bits = check_ec_point(curve_name, point)
+
+    if key_type.startswith(b'sk-'):
+        # Security key application
+        _, offset = read_string(key_blob, offset)
+
+    if offset != len(key_blob):
+        raise ValueError('trailing data in key blob')
+    return key_type, key_bits
+
+def parse_key_line(line):
+    """
+    Returns (key_type, key_bits, key_blob, comment) from a "<type> <base64> [comment]" string
+    """
+    fields = line.split(None, 2)
+    if len(fields) < 2:
+        raise ValueError('not a public key')
+    try:
+        key_blob = b64decode(fields[1], validate=True)
+    except b64Error:
+        raise ValueError('invalid base64') from None
+    key_type, key_bits = parse_key_blob(key_blob)
+    if fields[0].encode() != key_type:
+        raise ValueError('key type mismatch')
+    comment = fields[2].strip() if len(fields) > 2 else ''
+    return key_type, key_bits, key_blob, comment
+
+def skip_options(line):
+    """
+    Returns the line without its authorized_keys options
+    """
+    in_quote = False
+    index = 0
+    while index < len(line):
+        if line[index] in ' \t' and not in_quote:
+            return line[index:].lstrip(' \t')
+        if line.startswith('\\"', index):
+            index += 1
+        elif line[index] == '"':
+            in_quote = not in_quote
+        index += 1
+    return ''
+
+def parse_public_key(public_key):
+    """
+    Returns (key_type, key_bits, key_blob, comment) of the first valid key in an
+    OpenSSH public key string, like ssh-keygen -l does.
+    key_type is the label displayed by ssh-keygen (RSA, ECDSA, ED25519, DSA...)
+    Raises ValueError if there is no valid key.
+    """
+    for line in public_key.splitlines():
+        line = line.lstrip(' \t')
+        if not line or line.startswith('#'):
+            continue
+        for candidate in (line, skip_options(line)):
+            try:
+                key_type, key_bits, key_blob, comment = parse_key_line(candidate)
+            except ValueError:
+                continue
+            return KEY_TYPES[key_type], key_bits, key_blob, comment
+    raise ValueError('not a public key')
+
+def normalize_public_key(public_key):
+    """
+    Returns the first valid key of a public key string as "<type> <base64>",
+    Raises ValueError if there is no valid key.
+    """
+    _, _, key_blob, _ = parse_public_key(public_key)
+    raw_key_type, _ = read_string(key_blob, 0)
+    return '{} {}'.format(raw_key_type.decode('ascii'), b64encode(key_blob).decode('ascii'))
+
+def fingerprint_sha512(key_blob):
+    """
+    Returns the SHA512 fingerprint of a key blob, as ssh-keygen -E sha512
+    """
+    return 'SHA512:' + b64encode(sha512(key_blob).digest()).decode('ascii').rstrip('=')
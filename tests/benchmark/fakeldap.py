@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+"""
+Minimal in-process LDAPv3 server, enough for cassh: simple bind, search with
+and / or / not / equality / present filters, Who am I? and unbind.
+It is a load test stand-in, not a directory.
+
+Usage: python tests/benchmark/fakeldap.py [--port 3389] [--latency 0]
+"""
+
+from argparse import ArgumentParser
+from socketserver import BaseRequestHandler, ThreadingTCPServer
+from time import sleep
+
+# LDAP operations
+BIND_REQUEST = 0x60
+BIND_RESPONSE = 0x61
+UNBIND_REQUEST = 0x42
+SEARCH_REQUEST = 0x63
+SEARCH_RESULT_ENTRY = 0x64
+SEARCH_RESULT_DONE = 0x65
+ABANDON_REQUEST = 0x50
+EXTENDED_REQUEST = 0x77
+EXTENDED_RESPONSE = 0x78
+
+# Filters
+FILTER_AND = 0xa0
+FILTER_OR = 0xa1
+FILTER_NOT = 0xa2
+FILTER_EQUALITY = 0xa3
+FILTER_PRESENT = 0x87
+
+SUCCESS = 0
+PROTOCOL_ERROR = 2
+UNWILLING_TO_PERFORM = 53
+INVALID_CREDENTIALS = 49
+
+WHOAMI_OID = b'1.3.6.1.4.1.4203.1.11.3'
+
+def encode(tag, value):
+    """
+    Returns a BER TLV
+    """
+    length = len(value)
+    if length < 0x80:
+        return bytes([tag, length]) + value
+    length_bytes = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([tag, 0x80 | len(length_bytes)]) + length_bytes + value
+
+def encode_int(tag, value):
+    """
+    Returns a BER INTEGER or ENUMERATED
+    """
+    return encode(tag, value.to_bytes(max(1, (value.bit_length() + 8) // 8), 'big', signed=True))
+
+def decode(data):
+    """
+    Returns the list of (tag, value) of concatenated BER TLVs
+    """
+    items = list()
+    offset = 0
+    while offset < len(data):
+        tag = data[offset]
+        length = data[offset + 1]
+        offset += 2
+        if length & 0x80:
+            length_size = length & 0x7f
+            length = int.from_bytes(data[offset:offset + length_size], 'big')
+            offset += length_size
+        items.append((tag, data[offset:offset + length]))
+        offset += length
+    return items
+
+def ldap_result(tag, message_id, result_code, message=b'', extra=b''):
+    """
+    Returns an LDAP response message
+    """
+    return encode(0x30, encode_int(0x02, message_id) + encode(
+        tag, encode_int(0x0a, result_code) + encode(0x04, b'') + encode(0x04, message) + extra))
+
+
+class Directory():
+    """
+    Users entries: dn => {attribute lowercase name: (name, list of bytes values)}
+    and passwords: dn => password
+    """
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.entries = dict()
+        self.passwords = dict()
+
+    def add(self, ldap_dn, attributes, password=None):
+        """
+        Add an entry, attributes is {name: list of str values}
+        """
+        self.entries[ldap_dn.lower()] = (ldap_dn, {
+            name.lower(): (name, [value.encode() for value in values])
+            for name, values in attributes.items()})
+        if password is not None:
+            self.passwords[ldap_dn.lower()] = password.encode()
+
+    def bind(self, ldap_dn, password):
+        """
+        Returns True if the credentials are valid
+        """
+        return self.passwords.get(ldap_dn.decode(errors='ignore').lower()) == password \
+            and password != b''
+
+    def match(self, attributes, ldap_filter):
+        """
+        Returns True if the entry attributes match the BER filter
+        """
+        tag, value = ldap_filter
+        if tag == FILTER_AND:
+            return all(self.match(attributes, item) for item in decode(value))
+        if tag == FILTER_OR:
+            return any(self.match(attributes, item) for item in decode(value))
+        if tag == FILTER_NOT:
+            return not self.match(attributes, decode(value)[0])
+        if tag == FILTER_EQUALITY:
+            (_, name), (_, wanted) = decode(value)
+            _, values = attributes.get(name.decode().lower(), (None, list()))
+            return wanted.lower() in [item.lower() for item in values]
+        if tag == FILTER_PRESENT:
+            return value.decode().lower() in attributes
+        return False
+
+    def search(self, base, ldap_filter, attrlist):
+        """
+        Returns the list of (dn, [(name, values)]) in base matching the filter
+        """
+        base = base.decode(errors='ignore').lower()
+        results = list()
+        for key, (ldap_dn, attributes) in self.entries.items():
+            if not key.endswith(base) or not self.match(attributes, ldap_filter):
+                continue
+            if attrlist:
+                wanted = [name.decode().lower() for name in attrlist]
+                results.append((ldap_dn, [
+                    attributes[name] for name in wanted if name in attributes]))
+            else:
+                results.append((ldap_dn, list(attributes.values())))
+        return results
+
+
+class LdapHandler(BaseRequestHandler):
+    """
+    One LDAP connection
+    """
+    def read_message(self):
+        """
+        Returns the next LDAP message bytes, or None when the connection is closed
+        """
+        header = self.recv_exactly(2)
+        if header is None:
+            return None
+        length = header[1]
+        if length & 0x80:
+            length_bytes = self.recv_exactly(length & 0x7f)
+            if length_bytes is None:
+                return None
+            length = int.from_bytes(length_bytes, 'big')
+        return self.recv_exactly(length)
+
+    def recv_exactly(self, size):
+        """
+        Returns size bytes, or None when the connection is closed
+        """
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def handle(self):
+        directory = self.server.directory
+        bound_dn = b''
+        while True:
+            message = self.read_message()
+            if message is None:
+                return
+            items = decode(message)
+            message_id = int.from_bytes(items[0][1], 'big', signed=True)
+            operation, value = items[1]
+            if operation == UNBIND_REQUEST:
+                return
+            if operation == ABANDON_REQUEST:
+                continue
+            if directory.latency:
+                sleep(directory.latency)
+            if operation == BIND_REQUEST:
+                _, (_, name), (_, password) = decode(value)[:3]
+                if directory.bind(name, password):
+                    bound_dn = name
+                    response = ldap_result(BIND_RESPONSE, message_id, SUCCESS)
+                else:
+                    bound_dn = b''
+                    response = ldap_result(
+                        BIND_RESPONSE, message_id, INVALID_CREDENTIALS, b'Invalid credentials')
+            elif operation == SEARCH_REQUEST:
+                fields = decode(value)
+                base, ldap_filter, attrlist = fields[0][1], fields[6], fields[7][1]
+                response = b''
+                for ldap_dn, attributes in directory.search(
+                        base, ldap_filter, [name for _, name in decode(attrlist)]):
+                    response += encode(0x30, encode_int(0x02, message_id) + encode(
+                        SEARCH_RESULT_ENTRY, encode(0x04, ldap_dn.encode()) + encode(
+                            0x30, b''.join(encode(0x30, encode(0x04, name.encode()) + encode(
+                                0x31, b''.join(encode(0x04, item) for item in values)))
+                                           for name, values in attributes))))
+                response += ldap_result(SEARCH_RESULT_DONE, message_id, SUCCESS)
+            elif operation == EXTENDED_REQUEST and decode(value)[0][1] == WHOAMI_OID:
+                response = ldap_result(
+                    EXTENDED_RESPONSE, message_id, SUCCESS,
+                    extra=encode(0x8b, b'dn:' + bound_dn if bound_dn else b''))
+            else:
+                response = ldap_result(
+                    operation + 1, message_id, UNWILLING_TO_PERFORM, b'Not implemented')
+            self.request.sendall(response)
+
+
+class FakeLdapServer(ThreadingTCPServer):
+    """
+    Threaded LDAP server on host:port, serving directory
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, directory):
+        super().__init__(address, LdapHandler)
+        self.directory = directory
+
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser()
+    PARSER.add_argument('--port', type=int, default=3389, help='Listen port')
+    PARSER.add_argument('--latency', type=float, default=0, help='Seconds added to each operation')
+    ARGS = PARSER.parse_args()
+    DIRECTORY = Directory(latency=ARGS.latency)
+    DIRECTORY.add('cn=cassh,dc=example,dc=org', {'cn': ['cassh']}, password='cassh')
+    DIRECTORY.add('cn=admin,ou=groups,dc=example,dc=org', {'cn': ['admin']})
+    DIRECTORY.add(
+        'cn=admin.user,dc=example,dc=org',
+        {'mail': ['admin@example.org'], 'memberOf': ['cn=admin,ou=groups,dc=example,dc=org']},
+        password='admin')
+    print('Listening on 127.0.0.1:%s, bind as cn=cassh,dc=example,dc=org / cassh' % ARGS.port)
+    FakeLdapServer(('127.0.0.1', ARGS.port), DIRECTORY).serve_forever()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+Benchmark public key fingerprinting:
+ssh-keygen subprocess (get_fingerprint) vs in-process parser (get_fingerprint_from_string)
+
+Usage: python tests/benchmark/fingerprint.py [iterations]
+"""
+
+from os.path import join
+from subprocess import check_output
+import sys
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from time import perf_counter
+
+sys.path.insert(0, 'src/server')
+
+# Own library
+from ssh_utils import get_fingerprint, get_fingerprint_from_string
+
+KEY_TYPES = [
+    ['-t', 'rsa', '-b', '2048'],
+    ['-t', 'rsa', '-b', '4096'],
+    ['-t', 'ecdsa', '-b', '256'],
+    ['-t', 'ecdsa', '-b', '521'],
+    ['-t', 'ed25519'],
+    ['-t', 'dsa'],
+]
+
+def generate_keys(tmp_dir):
+    """
+    Returns a list of (name, public key) generated by ssh-keygen, and a
+    certificate of the last key (fingerprinted by ssh-keygen)
+    """
+    pubkeys = list()
+    for index, key_type in enumerate(KEY_TYPES):
+        key_path = join(tmp_dir, 'key%s' % index)
+        check_output(['ssh-keygen', '-q', '-N', '', '-C', 'bench', '-f', key_path] + key_type)
+        with open(key_path + '.pub', 'r') as pubkey_file:
+            pubkeys.append((' '.join(key_type[1:]), pubkey_file.read()))
+    ca_path = join(tmp_dir, 'ca')
+    check_output(['ssh-keygen', '-q', '-N', '', '-t', 'ed25519', '-f', ca_path])
+    check_output(['ssh-keygen', '-q', '-s', ca_path, '-I', 'bench', key_path + '.pub'])
+    with open(key_path + '-cert.pub', 'r') as cert_file:
+        pubkeys.append(('certificate', cert_file.read()))
+    return pubkeys
+
+def subprocess_fingerprint(pubkey):
+    """
+    Former implementation: temp file + ssh-keygen
+    """
+    with NamedTemporaryFile(mode='w') as tmp_pubkey:
+        tmp_pubkey.write(pubkey)
+        tmp_pubkey.flush()
+        return get_fingerprint(tmp_pubkey.name)
+
+def bench(func, pubkey, iterations):
+    """
+    Returns the mean duration of func(pubkey) in milliseconds
+    """
+    start = perf_counter()
+    for _ in range(iterations):
+        func(pubkey)
+    return (perf_counter() - start) * 1000 / iterations
+
+if __name__ == "__main__":
+    ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    with TemporaryDirectory() as TMP_DIR:
+        PUBKEYS = generate_keys(TMP_DIR)
+    for NAME, PUBKEY in PUBKEYS:
+        if subprocess_fingerprint(PUBKEY) == get_fingerprint_from_string(PUBKEY):
+            print('[OK] %s fingerprint matches ssh-keygen' % NAME)
+        else:
+            print('[FAIL] %s fingerprint differs from ssh-keygen' % NAME)
+        print('     ssh-keygen: %.3f ms, in-process: %.3f ms' % (
+            bench(subprocess_fingerprint, PUBKEY, ITERATIONS),
+            bench(get_fingerprint_from_string, PUBKEY, ITERATIONS)))
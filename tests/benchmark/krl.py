@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+Benchmark a full KRL rebuild:
+one ssh-keygen call per revoked key (before) vs one KRL specification file (after)
+vs the native KRL writer
+
+Usage: python tests/benchmark/krl.py [--sizes 10000,100000] [--legacy-max 10000]
+"""
+
+from argparse import ArgumentParser
+from base64 import b64encode
+from os import urandom
+from os.path import join
+from struct import pack
+from subprocess import check_output
+import sys
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from time import perf_counter
+import tracemalloc
+
+sys.path.insert(0, 'src/server')
+
+# Own library
+from ssh_utils import Authority
+from ssh_utils.krl import write_krl_from_keys
+
+def random_pubkeys(count):
+    """
+    Yields random Ed25519 public keys
+    """
+    key_type = b'ssh-ed25519'
+    for index in range(count):
+        key_blob = pack('>I', len(key_type)) + key_type + pack('>I', 32) + urandom(32)
+        yield 'ssh-ed25519 %s revoked%s' % (b64encode(key_blob).decode(), index)
+
+def legacy_rebuild(ca_ssh, pubkeys):
+    """
+    Former implementation: empty KRL + one ssh-keygen -u per key
+    """
+    ca_ssh.generate_empty_krl()
+    for pubkey in pubkeys:
+        with NamedTemporaryFile(mode='w') as tmp_pubkey:
+            tmp_pubkey.write(pubkey)
+            tmp_pubkey.flush()
+            ca_ssh.update_krl(tmp_pubkey.name)
+
+def bulk_rebuild(ca_ssh, pubkeys):
+    """
+    ssh-keygen implementation, returns the python memory peak in KiB
+    """
+    tracemalloc.start()
+    ca_ssh.generate_krl_from_keys(pubkeys)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak // 1024
+
+def native_rebuild(ca_ssh, pubkeys):
+    """
+    Native implementation, returns the python memory peak in KiB
+    """
+    tracemalloc.start()
+    write_krl_from_keys(ca_ssh.krl, pubkeys)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak // 1024
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser()
+    PARSER.add_argument('--sizes', default='10000,100000', help='Revoked keys counts')
+    PARSER.add_argument(
+        '--legacy-max', type=int, default=10000,
+        help='Do not run the former implementation above this size')
+    ARGS = PARSER.parse_args()
+
+    with TemporaryDirectory() as TMP_DIR:
+        CA_KEY = join(TMP_DIR, 'ca')
+        check_output(['ssh-keygen', '-q', '-N', '', '-t', 'ed25519', '-f', CA_KEY])
+        CA_SSH = Authority(CA_KEY, join(TMP_DIR, 'revoked-keys'))
+        for SIZE in [int(size) for size in ARGS.sizes.split(',')]:
+            START = perf_counter()
+            PEAK = bulk_rebuild(CA_SSH, random_pubkeys(SIZE))
+            print('%s keys, bulk: %.2f s (python memory peak %s KiB)' % (
+                SIZE, perf_counter() - START, PEAK))
+            START = perf_counter()
+            PEAK = native_rebuild(CA_SSH, random_pubkeys(SIZE))
+            print('%s keys, native: %.2f s (python memory peak %s KiB)' % (
+                SIZE, perf_counter() - START, PEAK))
+            if SIZE > ARGS.legacy_max:
+                print('%s keys, per-key: skipped (--legacy-max %s)' % (SIZE, ARGS.legacy_max))
+                continue
+            START = perf_counter()
+            legacy_rebuild(CA_SSH, random_pubkeys(SIZE))
+            print('%s keys, per-key: %.2f s' % (SIZE, perf_counter() - START))
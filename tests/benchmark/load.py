@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+
+"""
+Load test: cassh is started in-process, against a local Postgres and an
+in-process fake LDAP server (tests/benchmark/fakeldap.py), then driven with
+concurrent traffic at fixed rates (open loop, latency is measured from the
+scheduled send time). The result is printed as JSON.
+
+The database is wiped (DELETE FROM USERS, REVOCATION), the tables are created
+if needed: use a database dedicated to benchmarks, never the demo or test one.
+It only runs with --wipe-database. The Postgres port is read by libpq from
+PGPORT. Server access logs are written on stderr.
+
+Usage: python tests/benchmark/load.py --wipe-database [--duration 30] [--users 50]
+           [--rate sign=20,put=1,status=0.2,krl=20,search=1] [--concurrency 64]
+           [--threads 10] [--sign-backend ssh-keygen] [--krl-backend ssh-keygen]
+           [--ldap-latency 0] [--memberof-cache-ttl 0] [--auth-cache-ttl 0]
+           [--output result.json]
+           [--pg-host localhost] [--pg-dbname postgres] [--pg-user postgres]
+           [--pg-password mysecretpassword]
+"""
+
+from argparse import ArgumentParser
+from atexit import register
+from concurrent.futures import ThreadPoolExecutor
+import json
+from math import ceil
+from os.path import join
+import platform
+from shutil import rmtree
+import socket
+from subprocess import check_output, CalledProcessError, DEVNULL
+import sys
+from tempfile import mkdtemp
+from threading import local, Lock, Thread
+from time import perf_counter, sleep, time
+
+# Third party library imports
+from psycopg2 import connect
+from requests import Session
+
+sys.path.insert(0, 'src/server')
+sys.path.insert(0, 'tests/benchmark')
+
+# Own library
+from fakeldap import Directory, FakeLdapServer
+import lib.httpd as httpd
+import lib.tools as tools
+import server as cassh_server
+
+SQL_MODELS = ['src/server/sql/users.sql', 'src/server/sql/revocation.sql']
+LDAP_BASE = 'dc=example,dc=org'
+LDAP_PEOPLE = 'ou=people,dc=example,dc=org'
+ADMIN_CN = 'cn=admin,ou=groups,dc=example,dc=org'
+ADMIN_REALNAME = 'admin@example.org'
+ADMIN_PASSWORD = 'adminpassword'
+DEFAULT_RATES = 'sign=20,put=1,status=0.2,krl=20,search=1'
+
+def letters(index):
+    """
+    Returns a lowercase name for index, usernames only accept [a-z]
+    """
+    name = ''
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        name = chr(ord('a') + rest) + name
+    return name
+
+def free_port():
+    """
+    Returns a free TCP port on localhost
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def generate_key(key_path):
+    """
+    Generate an ed25519 key without passphrase, returns the public key
+    """
+    check_output(['ssh-keygen', '-q', '-N', '', '-t', 'ed25519', '-C', 'load', '-f', key_path])
+    with open(key_path + '.pub', 'r') as pubkey_file:
+        return pubkey_file.read()
+
+def init_database(args):
+    """
+    Create the tables if needed, and empty them
+    """
+    pg_conn = connect("dbname='%s' user='%s' host='%s' password='%s'" % (
+        args.pg_dbname, args.pg_user, args.pg_host, args.pg_password))
+    cur = pg_conn.cursor()
+    cur.execute("SELECT to_regclass('users'), to_regclass('revocation')")
+    if None in cur.fetchone():
+        for sql_model in SQL_MODELS:
+            with open(sql_model, 'r') as sql_model_file:
+                cur.execute(sql_model_file.read())
+    cur.execute('DELETE FROM USERS')
+    cur.execute('DELETE FROM REVOCATION')
+    pg_conn.commit()
+    cur.close()
+    pg_conn.close()
+
+def start_ldap(users, latency):
+    """
+    Start the fake LDAP server, returns its port
+    """
+    directory = Directory(latency=latency)
+    directory.add('cn=cassh,' + LDAP_BASE, {'cn': ['cassh']}, password='cassh')
+    directory.add(
+        'cn=%s,%s' % (ADMIN_REALNAME, LDAP_PEOPLE),
+        {'mail': [ADMIN_REALNAME], 'memberOf': [ADMIN_CN]},
+        password=ADMIN_PASSWORD)
+    for user in users:
+        directory.add(
+            'cn=%s,%s' % (user['realname'], LDAP_PEOPLE),
+            {'mail': [user['realname']], 'memberOf': user['groups']},
+            password=user['password'])
+    ldap_server = FakeLdapServer(('127.0.0.1', 0), directory)
+    Thread(target=ldap_server.serve_forever, daemon=True).start()
+    return ldap_server.server_address[1]
+
+def start_cassh(config):
+    """
+    Start cassh in this process, returns its URL and its server
+    """
+    server_opts = tools.read_config(config)
+    http_server = httpd.make_server(cassh_server.create_app(config), server_opts)
+    http_server.prepare()
+    Thread(target=http_server.serve, daemon=True).start()
+    return 'http://127.0.0.1:%s' % config['main']['port'], http_server
+
+
+class LoadTest():
+    """
+    Traffic generator and latency recorder
+    """
+    def __init__(self, url, users, concurrency):
+        self.url = url
+        self.users = users
+        self.sessions = local()
+        self.lock = Lock()
+        self.counter = 0
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        # scenario => list of latencies, and errors count
+        self.latencies = dict()
+        self.errors = dict()
+
+    def session(self):
+        """
+        Returns the keep-alive HTTP session of this thread
+        """
+        if not hasattr(self.sessions, 'session'):
+            self.sessions.session = Session()
+        return self.sessions.session
+
+    def next_index(self):
+        """
+        Returns a new sequence number
+        """
+        with self.lock:
+            self.counter += 1
+            return self.counter
+
+    def request(self, method, path, payload=None):
+        """
+        Returns (status code, body)
+        """
+        resp = self.session().request(method, self.url + path, data=payload, timeout=60)
+        return resp.status_code, resp.text
+
+    def admin(self, payload=None):
+        """
+        Returns an admin payload
+        """
+        admin_payload = {'realname': ADMIN_REALNAME, 'password': ADMIN_PASSWORD}
+        admin_payload.update(payload or {})
+        return admin_payload
+
+    def sign(self):
+        """
+        Sign the key of a user, returns True if a certificate is returned
+        """
+        user = self.users[self.next_index() % len(self.users)]
+        code, body = self.request('POST', '/client', {
+            'username': user['username'], 'realname': user['realname'],
+            'password': user['password'], 'pubkey': user['pubkey']})
+        return code == 200 and body.startswith('ssh-')
+
+    def put(self):
+        """
+        Add a new key, for a new username
+        """
+        user = self.users[self.next_index() % len(self.users)]
+        code, _ = self.request('PUT', '/client', {
+            'username': 'put' + letters(self.next_index()), 'realname': user['realname'],
+            'password': user['password'], 'pubkey': user['pubkey']})
+        return code == 201
+
+    def status(self):
+        """
+        Status of every user
+        """
+        code, _ = self.request('POST', '/admin/all', self.admin({'status': 'true'}))
+        return code == 200
+
+    def krl(self):
+        """
+        Download the KRL
+        """
+        code, _ = self.request('GET', '/krl')
+        return code == 200
+
+    def search(self):
+        """
+        Principals search
+        """
+        code, _ = self.request(
+            'POST', '/admin/all/principals/search', self.admin({'filter': 'team1,team2'}))
+        return code == 200
+
+    def setup(self):
+        """
+        Add and activate the key of every user
+        """
+        for user in self.users:
+            code, body = self.request('PUT', '/client', {
+                'username': user['username'], 'realname': user['realname'],
+                'password': user['password'], 'pubkey': user['pubkey']})
+            if code != 201:
+                raise RuntimeError('Cannot add %s: %s %s' % (user['username'], code, body))
+            code, body = self.request('POST', '/admin/%s' % user['username'], self.admin())
+            if code != 200:
+                raise RuntimeError('Cannot activate %s: %s %s' % (user['username'], code, body))
+
+    def call(self, name, scheduled):
+        """
+        Run a scenario, record its latency from the scheduled time
+        """
+        try:
+            is_ok = getattr(self, name)()
+        except Exception:
+            is_ok = False
+        latency = perf_counter() - scheduled
+        with self.lock:
+            self.latencies[name].append(latency)
+            if not is_ok:
+                self.errors[name] += 1
+
+    def schedule(self, name, rate, duration):
+        """
+        Submit a scenario rate times per second, during duration seconds
+        """
+        start = perf_counter()
+        for index in range(int(rate * duration)):
+            scheduled = start + index / rate
+            delay = scheduled - perf_counter()
+            if delay > 0:
+                sleep(delay)
+            self.executor.submit(self.call, name, scheduled)
+
+    def run(self, rates, duration):
+        """
+        Run every scenario concurrently, returns the elapsed seconds
+        """
+        for name in rates:
+            self.latencies[name] = list()
+            self.errors[name] = 0
+        start = perf_counter()
+        schedulers = [Thread(target=self.schedule, args=(name, rate, duration))
+                      for name, rate in rates.items() if rate > 0]
+        for scheduler in schedulers:
+            scheduler.start()
+        for scheduler in schedulers:
+            scheduler.join()
+        self.executor.shutdown(wait=True)
+        return perf_counter() - start
+
+
+def percentile(values, ratio):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    if not values:
+        return None
+    return values[max(0, ceil(ratio * len(values)) - 1)]
+
+def summary(latencies, errors, elapsed):
+    """
+    Returns the statistics of a list of latencies, in milliseconds
+    """
+    latencies = sorted(latencies)
+    to_ms = lambda value: None if value is None else round(value * 1000, 2)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 2),
+        'p50_ms': to_ms(percentile(latencies, 0.50)),
+        'p95_ms': to_ms(percentile(latencies, 0.95)),
+        'p99_ms': to_ms(percentile(latencies, 0.99)),
+        'max_ms': to_ms(latencies[-1] if latencies else None),
+    }
+
+def parse_rates(rates):
+    """
+    Returns {scenario: requests per second} of "name=rate,..."
+    """
+    result = dict()
+    for item in rates.split(','):
+        name, rate = item.split('=')
+        if name not in ['sign', 'put', 'status', 'krl', 'search']:
+            raise ValueError('Unknown scenario: %s' % name)
+        result[name] = float(rate)
+    return result
+
+def git_revision():
+    """
+    Returns the current git commit, if any
+    """
+    try:
+        return check_output(['git', 'rev-parse', 'HEAD'], stderr=DEVNULL).decode().strip()
+    except (CalledProcessError, OSError):
+        return None
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser()
+    PARSER.add_argument('--duration', type=float, default=30, help='Seconds of traffic')
+    PARSER.add_argument('--users', type=int, default=50, help='Users with an active key')
+    PARSER.add_argument('--rate', default=DEFAULT_RATES,
+                        help='Requests per second by scenario (sign, put, status, krl, search)')
+    PARSER.add_argument('--concurrency', type=int, default=64, help='Client threads')
+    PARSER.add_argument('--threads', type=int, default=10, help='Server threads')
+    PARSER.add_argument('--sign-backend', default='ssh-keygen', help='ssh-keygen or native')
+    PARSER.add_argument('--krl-backend', default='ssh-keygen', help='ssh-keygen or native')
+    PARSER.add_argument('--ldap-latency', type=float, default=0,
+                        help='Seconds added to each LDAP operation')
+    PARSER.add_argument('--memberof-cache-ttl', type=int, default=0)
+    PARSER.add_argument('--auth-cache-ttl', type=int, default=0)
+    PARSER.add_argument('--pg-host', default='localhost')
+    PARSER.add_argument('--pg-dbname', default='postgres')
+    PARSER.add_argument('--pg-user', default='postgres')
+    PARSER.add_argument('--pg-password', default='mysecretpassword')
+    PARSER.add_argument('--output', help='JSON result file, default to stdout')
+    PARSER.add_argument('--wipe-database', action='store_true',
+                        help='Confirm that the USERS and REVOCATION tables of --pg-dbname '
+                        'can be emptied')
+    ARGS = PARSER.parse_args()
+    if not ARGS.wipe_database:
+        PARSER.error('the USERS and REVOCATION tables of %s are emptied, '
+                     'confirm with --wipe-database' % ARGS.pg_dbname)
+    RATES = parse_rates(ARGS.rate)
+
+    # Removed at exit: the KRL builder thread of cassh keeps using it until then
+    TMP_DIR = mkdtemp()
+    register(rmtree, TMP_DIR, ignore_errors=True)
+    generate_key(join(TMP_DIR, 'ca'))
+    check_output(['ssh-keygen', '-k', '-f', join(TMP_DIR, 'krl')])
+    USERS = [{
+        'username': 'load' + letters(INDEX),
+        'realname': 'load%s@example.org' % INDEX,
+        'password': 'password%s' % INDEX,
+        'pubkey': generate_key(join(TMP_DIR, 'key%s' % INDEX)),
+        'groups': ['cn=team%s,ou=groups,%s' % (INDEX % 10, LDAP_BASE)],
+    } for INDEX in range(ARGS.users)]
+    with open(join(TMP_DIR, 'ldap_mapping.json'), 'w') as MAPPING_FILE:
+        json.dump({'cn=team%s,ou=groups,%s' % (INDEX, LDAP_BASE): ['team%s' % INDEX]
+                   for INDEX in range(10)}, MAPPING_FILE)
+
+    init_database(ARGS)
+    LDAP_PORT = start_ldap(USERS, ARGS.ldap_latency)
+    CONFIG = {
+        'main': {
+            'ca': join(TMP_DIR, 'ca'),
+            'krl': join(TMP_DIR, 'krl'),
+            'port': free_port(),
+            'threads': ARGS.threads,
+            'backlog': 128,
+            'sign_backend': ARGS.sign_backend,
+            'krl_backend': ARGS.krl_backend,
+            'debug': 'False',
+        },
+        'postgres': {
+            'host': ARGS.pg_host,
+            'dbname': ARGS.pg_dbname,
+            'user': ARGS.pg_user,
+            'password': ARGS.pg_password,
+        },
+        'ldap': {
+            'host': '127.0.0.1:%s' % LDAP_PORT,
+            'bind_dn': LDAP_BASE,
+            'username': 'cn=cassh,' + LDAP_BASE,
+            'password': 'cassh',
+            'admin_cn': ADMIN_CN,
+            'filter_realname_key': 'mail',
+            'filter_memberof_key': 'memberOf',
+            'username_prefix': 'cn=',
+            'username_suffix': ',' + LDAP_PEOPLE,
+            'ldap_mapping_path': join(TMP_DIR, 'ldap_mapping.json'),
+            'memberof_cache_ttl': ARGS.memberof_cache_ttl,
+            'auth_cache_ttl': ARGS.auth_cache_ttl,
+        },
+    }
+    CASSH_URL, HTTP_SERVER = start_cassh(CONFIG)
+    LOAD_TEST = LoadTest(CASSH_URL, USERS, ARGS.concurrency)
+    LOAD_TEST.setup()
+    START = time()
+    ELAPSED = LOAD_TEST.run(RATES, ARGS.duration)
+    HTTP_SERVER.stop()
+
+    RESULT = {
+        'version': cassh_server.VERSION,
+        'git_revision': git_revision(),
+        'date': int(START),
+        'python': platform.python_version(),
+        'parameters': {
+            'duration': ARGS.duration,
+            'users': ARGS.users,
+            'rates': RATES,
+            'concurrency': ARGS.concurrency,
+            'threads': ARGS.threads,
+            'sign_backend': ARGS.sign_backend,
+            'krl_backend': ARGS.krl_backend,
+            'ldap_latency': ARGS.ldap_latency,
+            'memberof_cache_ttl': ARGS.memberof_cache_ttl,
+            'auth_cache_ttl': ARGS.auth_cache_ttl,
+        },
+        'elapsed': round(ELAPSED, 3),
+        'scenarios': {
+            NAME: summary(LOAD_TEST.latencies[NAME], LOAD_TEST.errors[NAME], ELAPSED)
+            for NAME in RATES},
+        'total': summary(
+            [LATENCY for LATENCIES in LOAD_TEST.latencies.values() for LATENCY in LATENCIES],
+            sum(LOAD_TEST.errors.values()), ELAPSED),
+    }
+    if ARGS.output:
+        with open(ARGS.output, 'w', encoding='utf-8') as OUTPUT_FILE:
+            json.dump(RESULT, OUTPUT_FILE, indent=4, sort_keys=True)
+    else:
+        print(json.dumps(RESULT, indent=4, sort_keys=True))
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+"""
+Microbenchmarks of the lib.tools functions called at each request or for each
+row of a users listing: data2map, validate_payload, unquote_custom,
+merge_principals, truncate_principals, pretty_ssh_key_hash and sql_to_json.
+
+Row functions run on users tables of 10 to 100k rows. Durations are the best
+of --repeat runs, per call or per row. They are divided by the duration of a
+fixed calibration workload, and compared to the stored baselines
+(tests/benchmark/micro_baseline.json): the exit code is 1 when one of them is
+more than --threshold slower. Save the baselines again (--save) when the
+Python version or the machine changes.
+
+Usage: python tests/benchmark/micro.py [--sizes 10,100,1000,10000,100000]
+           [--repeat 7] [--threshold 0.25] [--filter sql_to_json] [--save]
+"""
+
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+import gc
+from io import BytesIO, StringIO
+import json
+from os.path import exists, join
+import platform
+from random import Random
+from subprocess import check_output
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from urllib.parse import quote_plus
+
+# Third party library imports
+from web import ctx
+
+sys.path.insert(0, 'src/server')
+
+# Own library
+from lib.constants import STATES
+from ssh_utils import get_fingerprint_from_string
+from lib.tools import data2map, merge_principals, pretty_ssh_key_hash, read_config, Tools, \
+    truncate_principals, unquote_custom, validate_payload
+
+BASELINE_PATH = 'tests/benchmark/micro_baseline.json'
+DEFAULT_SIZES = '10,100,1000,10000,100000'
+# Row functions are called on at least this many rows per run
+MIN_ROWS = 10000
+# Payload functions are called this many times per run
+PAYLOAD_CALLS = 10000
+CALIBRATION_LOOPS = 5000
+PUBKEY = 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIE6ZDmPSO9dIKzR0jvc6EDZlq4xxKQs4Zz1C2yx5E4Dh ' \
+    'user@example.org'
+# Keys of the users tables, their SSH_KEY_HASH is computed like Client.PUT does
+KEY_TYPES = [
+    ['-t', 'ed25519'],
+    ['-t', 'rsa', '-b', '4096'],
+    ['-t', 'rsa', '-b', '2048'],
+    ['-t', 'ecdsa', '-b', '256'],
+]
+PAYLOADS = {
+    'client': {
+        'username': 'user',
+        'realname': 'user@example.org',
+        'password': 'p@ssword with spaces',
+        'pubkey': PUBKEY,
+    },
+    'admin': {
+        'realname': 'admin@example.org',
+        'password': 'adminpassword',
+        'status': 'true',
+        'principals': ','.join('principal%s' % index for index in range(20)),
+        'filter': 'team1,team2,team3',
+    },
+}
+
+
+def request_body(payload):
+    """
+    Returns a payload urlencoded as curl does
+    """
+    return '&'.join('%s=%s' % (key, quote_plus(value)) for key, value in payload.items()).encode()
+
+def set_request(body):
+    """
+    Set the request body of web.data()
+    """
+    ctx.env = {'wsgi.input': BytesIO(body), 'CONTENT_LENGTH': str(len(body))}
+    ctx.pop('data', None)
+
+def make_fingerprints(tmp_dir):
+    """
+    Returns the SSH_KEY_HASH of a key of each KEY_TYPES
+    """
+    fingerprints = list()
+    for index, key_type in enumerate(KEY_TYPES):
+        key_path = join(tmp_dir, 'key%s' % index)
+        check_output(['ssh-keygen', '-q', '-N', '', '-f', key_path] + key_type)
+        with open(key_path + '.pub', 'r', encoding='utf-8') as pubkey_file:
+            fingerprints.append(get_fingerprint_from_string(pubkey_file.read()))
+    return fingerprints
+
+def make_users(size, groups, fingerprints, random):
+    """
+    Returns a users table of size rows, as selected by the listings, and the
+    memberOf groups of each realname
+    """
+    rows = list()
+    memberships = dict()
+    for index in range(size):
+        realname = 'user%s@example.org' % index
+        rows.append((
+            'user%s' % index, realname, index % 3, 1650000000 + index,
+            fingerprints[index % len(fingerprints)], PUBKEY, '+1d',
+            ','.join(['user%s' % index] + ['team%s' % random.randrange(50) for _ in range(4)])))
+        memberships[realname] = [group.encode() for group in random.sample(groups, 10)]
+    return rows, memberships
+
+def make_tools(tmp_dir, ldap_mapping, size):
+    """
+    Returns Tools with LDAP enabled, its memberOf cache is large enough for
+    every user
+    """
+    check_output(['ssh-keygen', '-q', '-N', '', '-t', 'ed25519', '-f', join(tmp_dir, 'ca')])
+    check_output(['ssh-keygen', '-k', '-f', join(tmp_dir, 'krl')])
+    with open(join(tmp_dir, 'ldap_mapping.json'), 'w', encoding='utf-8') as mapping_file:
+        json.dump(ldap_mapping, mapping_file)
+    server_opts = read_config({
+        'main': {'ca': join(tmp_dir, 'ca'), 'krl': join(tmp_dir, 'krl'), 'port': 8080},
+        'ldap': {
+            'host': 'localhost', 'bind_dn': 'dc=example,dc=org',
+            'username': 'cn=cassh,dc=example,dc=org', 'password': 'cassh',
+            'admin_cn': 'cn=admin,ou=groups,dc=example,dc=org',
+            'filter_realname_key': 'mail', 'filter_memberof_key': 'memberOf',
+            'ldap_mapping_path': join(tmp_dir, 'ldap_mapping.json'),
+            'memberof_cache_ttl': 3600, 'memberof_cache_size': size,
+        },
+    })
+    return Tools(server_opts, STATES, 'benchmark')
+
+def calibrate():
+    """
+    Fixed pure python workload (string and dict operations)
+    """
+    for index in range(CALIBRATION_LOOPS):
+        values = ('value%s,common,%s' % (index, index % 7)).split(',')
+        ','.join(dict.fromkeys(values))
+
+
+class Benchmarks():
+    """
+    Every benchmark: name => (function running it, operations per run)
+    """
+    def __init__(self, sizes, tools, fingerprints):
+        self.tools = tools
+        self.server_opts = tools.server_opts
+        self.benchmarks = dict()
+        random = Random(42)
+        groups = ['cn=group%s,ou=groups,dc=example,dc=org' % index for index in range(400)]
+        for name, payload in PAYLOADS.items():
+            self.add_payload('data2map[%s]' % name, self.run_data2map, request_body(payload))
+            for key, value in payload.items():
+                if key != 'password':
+                    self.add_payload('validate_payload[%s.%s]' % (name, key),
+                                     self.run_validate_payload, key, quote_plus(value))
+        self.add_payload('unquote_custom[pubkey]', self.run_unquote_custom, quote_plus(PUBKEY))
+        for size in sizes:
+            rows, memberships = make_users(size, groups, fingerprints, random)
+            for realname, list_membership in memberships.items():
+                tools.memberof_cache.set(realname, list_membership)
+            self.add_rows('merge_principals', size, self.run_merge_principals, rows, memberships)
+            self.add_rows(
+                'truncate_principals', size, self.run_truncate_principals, rows, memberships)
+            self.add_rows('pretty_ssh_key_hash', size, self.run_pretty_ssh_key_hash, rows)
+            self.add_rows('sql_to_json', size, self.tools.sql_to_json, rows, True)
+
+    def add_payload(self, name, function, *args):
+        """
+        Add a benchmark of PAYLOAD_CALLS calls
+        """
+        self.benchmarks[name] = (lambda: function(PAYLOAD_CALLS, *args), PAYLOAD_CALLS)
+
+    def add_rows(self, name, size, function, *args):
+        """
+        Add a benchmark on a table of size rows, repeated up to MIN_ROWS rows
+        """
+        loops = max(1, MIN_ROWS // size)
+
+        def run():
+            for _ in range(loops):
+                function(*args)
+        self.benchmarks['%s[%s]' % (name, size)] = (run, loops * size)
+
+    @staticmethod
+    def run_data2map(calls, body):
+        """
+        Parse and validate a request body
+        """
+        for _ in range(calls):
+            set_request(body)
+            data2map()
+
+    @staticmethod
+    def run_validate_payload(calls, key, value):
+        """
+        Validate a payload value
+        """
+        for _ in range(calls):
+            validate_payload(key, value)
+
+    @staticmethod
+    def run_unquote_custom(calls, value):
+        """
+        Unquote a public key
+        """
+        for _ in range(calls):
+            unquote_custom(value)
+
+    def run_merge_principals(self, rows, memberships):
+        """
+        Principals of each user of a listing
+        """
+        for row in rows:
+            merge_principals(row[7], memberships[row[1]], self.server_opts)
+
+    def run_truncate_principals(self, rows, memberships):
+        """
+        Custom principals of each user of a listing
+        """
+        for row in rows:
+            truncate_principals(row[7], memberships[row[1]], self.server_opts)
+
+    @staticmethod
+    def run_pretty_ssh_key_hash(rows):
+        """
+        Key hash of each user of a listing
+        """
+        for row in rows:
+            pretty_ssh_key_hash(row[4])
+
+    def measure(self, name, repeat):
+        """
+        Returns the best duration of an operation in seconds, and the median
+        of its durations relative to calibrate() measured just before, which
+        is compared to the baseline: it is less sensitive to the machine load.
+        The garbage collector is disabled during runs, like timeit does.
+        """
+        function, operations = self.benchmarks[name]
+        durations = list()
+        calibrations = list()
+        for _ in range(repeat):
+            gc.collect()
+            gc.disable()
+            try:
+                start = perf_counter()
+                calibrate()
+                calibrations.append(perf_counter() - start)
+                start = perf_counter()
+                function()
+                durations.append(perf_counter() - start)
+            finally:
+                gc.enable()
+        ratios = sorted(duration / calibration
+                        for duration, calibration in zip(durations, calibrations))
+        return min(durations) / operations, ratios[len(ratios) // 2] / operations
+
+def load_baseline():
+    """
+    Returns the stored baseline, or an empty one
+    """
+    if not exists(BASELINE_PATH):
+        return {'results': {}}
+    with open(BASELINE_PATH, 'r', encoding='utf-8') as baseline_file:
+        return json.load(baseline_file)
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser()
+    PARSER.add_argument('--sizes', default=DEFAULT_SIZES, help='Users table sizes')
+    PARSER.add_argument('--repeat', type=int, default=7, help='Runs of each benchmark')
+    PARSER.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed slowdown against the baseline (0.25 = 25%%)')
+    PARSER.add_argument('--filter', default='', help='Only run benchmarks containing this')
+    PARSER.add_argument('--save', action='store_true', help='Store the results as the baseline')
+    ARGS = PARSER.parse_args()
+    SIZES = [int(SIZE) for SIZE in ARGS.sizes.split(',')]
+
+    with TemporaryDirectory() as TMP_DIR:
+        with redirect_stdout(StringIO()):
+            BENCHMARKS = Benchmarks(SIZES, make_tools(TMP_DIR, {
+                'cn=group%s,ou=groups,dc=example,dc=org' % INDEX: [
+                    'principal%s' % INDEX, 'team%s' % (INDEX % 50)]
+                for INDEX in range(200)}, max(SIZES)), make_fingerprints(TMP_DIR))
+
+    BASELINE = load_baseline()
+    RESULTS = dict()
+    REGRESSIONS = list()
+    for NAME in BENCHMARKS.benchmarks:
+        if ARGS.filter not in NAME:
+            continue
+        DURATION, RESULTS[NAME] = BENCHMARKS.measure(NAME, ARGS.repeat)
+        REFERENCE = BASELINE['results'].get(NAME)
+        if REFERENCE is None:
+            COMPARISON = 'no baseline'
+        else:
+            RATIO = RESULTS[NAME] / REFERENCE
+            COMPARISON = '%+.1f%%' % ((RATIO - 1) * 100)
+            if RATIO > 1 + ARGS.threshold:
+                COMPARISON += ' REGRESSION'
+                REGRESSIONS.append(NAME)
+        print('%-45s %10.2f us  %s' % (NAME, DURATION * 1e6, COMPARISON))
+
+    if ARGS.save:
+        BASELINE['results'].update(RESULTS)
+        BASELINE['python'] = platform.python_version()
+        BASELINE['machine'] = platform.machine()
+        with open(BASELINE_PATH, 'w', encoding='utf-8') as BASELINE_FILE:
+            json.dump(BASELINE, BASELINE_FILE, indent=4, sort_keys=True)
+            BASELINE_FILE.write('\n')
+        print('Baseline saved in %s' % BASELINE_PATH)
+    elif REGRESSIONS:
+        print('[FAIL] More than %d%% slower than the baseline: %s' % (
+            ARGS.threshold * 100, ', '.join(REGRESSIONS)))
+        sys.exit(1)
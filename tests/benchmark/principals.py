@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""
+Benchmark LDAP principals merging of a users listing:
+raw ldap_mapping JSON validated at each call (before) vs compiled at config load (after)
+
+Usage: python tests/benchmark/principals.py [--users 5000] [--groups 20] [--mapping 200]
+"""
+
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from io import StringIO
+from random import sample
+import sys
+from time import perf_counter
+
+sys.path.insert(0, 'src/server')
+
+# Own library
+from lib.tools import compile_ldap_mapping, merge_principals, validate_payload
+
+def legacy_merge_principals(custom_principals, list_membership, server_options):
+    """
+    Former implementation
+    """
+    if not custom_principals:
+        return ''
+    principals = custom_principals.split(',')
+    if not server_options['ldap_mapping']:
+        return ','.join(principals)
+    for user_group_cn in list_membership:
+        user_group_cn_decoded = user_group_cn.decode(errors='ignore')
+        if user_group_cn_decoded not in server_options['ldap_mapping']:
+            continue
+        ldap_mapping_principals = server_options['ldap_mapping'][user_group_cn_decoded]
+        for principal in ldap_mapping_principals:
+            err_msg = validate_payload('principals', principal)
+            if err_msg:
+                print('Error: Invalid LDAP mapping configuration: err={}, principals={}'.format(
+                    err_msg, principal))
+                continue
+            principals.append(principal)
+    principals = list(dict.fromkeys(principals))
+    return ','.join(principals)
+
+def run(merge, users, server_options):
+    """
+    Merge principals of every user, returns the duration in seconds
+    """
+    start = perf_counter()
+    with redirect_stdout(StringIO()):
+        for custom_principals, list_membership in users:
+            merge(custom_principals, list_membership, server_options)
+    return perf_counter() - start
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser()
+    PARSER.add_argument('--users', type=int, default=5000, help='Users count')
+    PARSER.add_argument('--groups', type=int, default=20, help='LDAP groups per user')
+    PARSER.add_argument('--mapping', type=int, default=200, help='Mapped LDAP groups')
+    ARGS = PARSER.parse_args()
+
+    GROUPS = ['cn=group%s,ou=groups,dc=example,dc=org' % index for index in range(ARGS.mapping * 2)]
+    # One invalid principal, reported at each call by the former implementation
+    LDAP_MAPPING = {
+        group: ['principal%s' % index, 'team%s' % (index % 10), 'invalid principal']
+        for index, group in enumerate(GROUPS[:ARGS.mapping])}
+    USERS = [
+        ('user%s,common' % index, [group.encode() for group in sample(GROUPS, ARGS.groups)])
+        for index in range(ARGS.users)]
+
+    with redirect_stdout(StringIO()):
+        COMPILED = compile_ldap_mapping(LDAP_MAPPING)
+        DIFFERENT = [
+            USER[0] for USER in USERS[:100]
+            if legacy_merge_principals(*USER, {'ldap_mapping': LDAP_MAPPING}) != \
+                merge_principals(*USER, {'ldap_mapping': COMPILED})]
+    if DIFFERENT:
+        print('[FAIL] Different principals for %s' % ', '.join(DIFFERENT))
+        sys.exit(1)
+
+    print('%s users, %s groups each, %s mapped groups' % (ARGS.users, ARGS.groups, ARGS.mapping))
+    print('before: %.3f s' % run(legacy_merge_principals, USERS, {'ldap_mapping': LDAP_MAPPING}))
+    print('after: %.3f s' % run(merge_principals, USERS, {'ldap_mapping': COMPILED}))
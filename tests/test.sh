@@ -72,6 +72,25 @@ fi
 . ./tests/test_admin_activate.sh
 . ./tests/test_principals.sh
 . ./tests/test_principals_search.sh
+. ./tests/test_memberof_cache.sh
 . ./tests/test_admin_set.sh
 . ./tests/test_admin_delete.sh
 . ./tests/test_cluster.sh
+
+# Native KRL backend
+if ! python3 tests/test_native_krl.py; then
+    echo "[FAIL ${BASH_SOURCE}:+${LINENO}] Test native KRL"
+fi
+
+# Native signing backend, needs the cryptography package (tests/requirements.txt)
+if ! python3 tests/test_native_cert.py; then
+    echo "[FAIL ${BASH_SOURCE}:+${LINENO}] Test native certificates"
+fi
+
+RESP=$(curl -s "${CASSH_SERVER_URL}"/metrics)
+if echo "${RESP}" | grep -q 'cassh_requests_total{handler="Client",method="POST",code="200",worker="' \
+    && echo "${RESP}" | grep -q 'cassh_stage_duration_seconds_count{stage="sign",worker="'; then
+    echo "[OK] Test metrics"
+else
+    echo "[FAIL ${BASH_SOURCE}:+${LINENO}] Test metrics : ${RESP}"
+fi
@@ -7,3 +7,17 @@ if [[ "${RESP}" == *"OK"* ]]; then
 else
     echo "[FAIL ${BASH_SOURCE}:+${LINENO}] Test cluster status : ${RESP}"
 fi
+
+RESP=$(curl -s -X POST -d '{"username": "toto"}' -H 'X-Cassh-Signature: 0000' "${CASSH_SERVER_URL}"/cluster/revoke)
+if [ "${RESP}" == 'Error: invalid signature.' ]; then
+    echo "[OK] Test cluster revoke with an invalid signature"
+else
+    echo "[FAIL ${BASH_SOURCE}:+${LINENO}] Test cluster revoke with an invalid signature : ${RESP}"
+fi
+
+RESP=$(curl -s -o /dev/null -w '%{http_code}' -X POST -d '{}' -H 'X-Cassh-Signature: 0000' "${CASSH_SERVER_URL}"/cluster/revoke)
+if [ "${RESP}" == '401' ]; then
+    echo "[OK] Test cluster revoke with an invalid signature is unauthorized"
+else
+    echo "[FAIL ${BASH_SOURCE}:+${LINENO}] Test cluster revoke with an invalid signature is unauthorized : ${RESP}"
+fi
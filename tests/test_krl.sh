@@ -20,6 +20,15 @@ PUB_KEY_2_EXAMPLE=$(cat "${KEY_2_EXAMPLE}".pub)
 rm -f /tmp/.revoked-keys
 curl -s "${CASSH_SERVER_URL}"/krl -o /tmp/.revoked-keys
 
+# Conditional request with the ETag of the latest krl
+ETAG=$(curl -s -I "${CASSH_SERVER_URL}"/krl | grep -i '^etag:' | awk '{print $2}' | tr -d '\r')
+RESP=$(curl -s -o /dev/null -w '%{http_code}' -H "If-None-Match: ${ETAG}" "${CASSH_SERVER_URL}"/krl)
+if [ "${RESP}" == '304' ]; then
+    echo "[OK] Test krl not modified"
+else
+    echo "[FAIL ${BASH_SOURCE}:+${LINENO}] Test krl not modified : ${RESP}"
+fi
+
 # Check if USER1 or USER2 is revoked
 RESP_1=$(ssh-keygen -Q -f /tmp/.revoked-keys "${KEY_1_EXAMPLE}".pub | awk '{print $NF}')
 if [ "${RESP_1}" == 'ok' ]; then
@@ -0,0 +1,39 @@
+#!/bin/bash
+# shellcheck disable=SC2128
+
+# Not an admin
+RESP=$(curl -s -X POST -d "realname=${GUEST_B_REALNAME}&password=${GUEST_B_PASSWORD}" "${CASSH_SERVER_URL}"/admin/all/cache/memberof)
+if [ "${RESP}" == 'Error: Not authorized.' ]; then
+    echo "[OK] Test memberof cache as guest"
+else
+    echo "[FAIL ${BASH_SOURCE}:+${LINENO}] Test memberof cache as guest : ${RESP}"
+fi
+
+# Statistics, the admin lookup itself is cached
+RESP=$(curl -s -X POST -d "realname=${SYSADMIN_REALNAME}&password=${SYSADMIN_PASSWORD}" "${CASSH_SERVER_URL}"/admin/all/cache/memberof | jq .size)
+if [ "${RESP}" -ge 1 ] 2>/dev/null; then
+    echo "[OK] Test memberof cache statistics"
+else
+    echo "[FAIL ${BASH_SOURCE}:+${LINENO}] Test memberof cache statistics : ${RESP}"
+fi
+
+RESP=$(curl -s -X POST -d "realname=${SYSADMIN_REALNAME}&password=${SYSADMIN_PASSWORD}&flush=${GUEST_B_REALNAME}" "${CASSH_SERVER_URL}"/admin/all/cache/memberof)
+if [ "${RESP}" == "OK: ${GUEST_B_REALNAME} flushed" ]; then
+    echo "[OK] Test memberof cache flush ${GUEST_B_REALNAME}"
+else
+    echo "[FAIL ${BASH_SOURCE}:+${LINENO}] Test memberof cache flush ${GUEST_B_REALNAME} : ${RESP}"
+fi
+
+RESP=$(curl -s -X POST -d "realname=${SYSADMIN_REALNAME}&password=${SYSADMIN_PASSWORD}&flush=${BADTEXT}" "${CASSH_SERVER_URL}"/admin/all/cache/memberof)
+if [ "${RESP}" == 'Error: invalid flush.' ]; then
+    echo "[OK] Test memberof cache flush with bad value"
+else
+    echo "[FAIL ${BASH_SOURCE}:+${LINENO}] Test memberof cache flush with bad value : ${RESP}"
+fi
+
+RESP=$(curl -s -X POST -d "realname=${SYSADMIN_REALNAME}&password=${SYSADMIN_PASSWORD}&flush=all" "${CASSH_SERVER_URL}"/admin/all/cache/memberof)
+if [[ "${RESP}" == 'OK: '*' entries flushed' ]]; then
+    echo "[OK] Test memberof cache flush all"
+else
+    echo "[FAIL ${BASH_SOURCE}:+${LINENO}] Test memberof cache flush all : ${RESP}"
+fi
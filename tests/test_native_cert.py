@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""
+Check certificates of the native signing backend against the ssh-keygen one,
+with ssh-keygen -L
+
+Usage: python tests/test_native_cert.py (exit code 1 on failure)
+"""
+
+from os.path import join
+from subprocess import check_output
+import sys
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, 'src/server')
+
+# Own library
+from ssh_utils import Authority
+from ssh_utils.cert import NativeAuthority
+
+CA_TYPES = [
+    ['-t', 'rsa', '-b', '4096'],
+    ['-t', 'ecdsa', '-b', '384'],
+    ['-t', 'ed25519'],
+]
+KEY_TYPES = [
+    ['-t', 'rsa', '-b', '2048'],
+    ['-t', 'ecdsa', '-b', '521'],
+    ['-t', 'ed25519'],
+    ['-t', 'dsa'],
+]
+
+def generate_key(key_path, key_type):
+    """
+    Generate a key without passphrase
+    """
+    check_output(['ssh-keygen', '-q', '-N', '', '-C', 'test', '-f', key_path] + key_type)
+
+def list_cert(tmp_dir, cert_contents):
+    """
+    Returns ssh-keygen -L output, without the filename and validity lines
+    """
+    cert_path = join(tmp_dir, 'check-cert.pub')
+    with open(cert_path, 'w') as cert_file:
+        cert_file.write(cert_contents)
+    output = check_output(['ssh-keygen', '-L', '-f', cert_path]).decode('utf-8')
+    return [line.strip() for line in output.splitlines()[1:] if 'Valid:' not in line]
+
+if __name__ == "__main__":
+    FAILURES = 0
+    with TemporaryDirectory() as TMP_DIR:
+        for CA_INDEX, CA_TYPE in enumerate(CA_TYPES):
+            CA_PATH = join(TMP_DIR, 'ca%s' % CA_INDEX)
+            generate_key(CA_PATH, CA_TYPE)
+            REFERENCE = Authority(CA_PATH, join(TMP_DIR, 'krl'))
+            NATIVE = NativeAuthority(CA_PATH, join(TMP_DIR, 'krl'))
+            for KEY_INDEX, KEY_TYPE in enumerate(KEY_TYPES):
+                KEY_PATH = join(TMP_DIR, 'key%s-%s' % (CA_INDEX, KEY_INDEX))
+                generate_key(KEY_PATH, KEY_TYPE)
+                with open(KEY_PATH + '.pub', 'r') as pubkey_file:
+                    PUBKEY = pubkey_file.read()
+                NAME = 'CA %s, key %s' % (' '.join(CA_TYPE[1:]), ' '.join(KEY_TYPE[1:]))
+                EXPECTED = list_cert(TMP_DIR, REFERENCE.sign_public_key(
+                    PUBKEY, 'testuser', '+12h', 'testuser,root'))
+                RESP = list_cert(TMP_DIR, NATIVE.sign_public_key(
+                    PUBKEY, 'testuser', '+12h', 'testuser,root'))
+                if RESP == EXPECTED:
+                    print('[OK] Test native certificate (%s)' % NAME)
+                else:
+                    print('[FAIL] Test native certificate (%s) : %s' % (NAME, RESP))
+                    FAILURES += 1
+    if FAILURES:
+        sys.exit(1)
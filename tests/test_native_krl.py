@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""
+Check the KRL of the native writer against the ssh-keygen one,
+with ssh-keygen -Q
+
+Usage: python tests/test_native_krl.py
+"""
+
+from base64 import b64decode
+from os.path import join
+from subprocess import call, check_output, DEVNULL
+import sys
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, 'src/server')
+
+# Own library
+from ssh_utils import Authority
+from ssh_utils.krl import Krl, read_krl, write_krl_from_keys
+
+KEY_TYPES = [
+    ['-t', 'rsa', '-b', '2048'],
+    ['-t', 'ecdsa', '-b', '256'],
+    ['-t', 'ecdsa', '-b', '521'],
+    ['-t', 'ed25519'],
+    ['-t', 'dsa'],
+]
+
+def generate_key(key_path, key_type):
+    """
+    Generate a key without passphrase
+    """
+    check_output(['ssh-keygen', '-q', '-N', '', '-C', 'test', '-f', key_path] + key_type)
+
+def sign_key(ca_path, key_path, key_id, serial):
+    """
+    Sign a key, returns the certificate path
+    """
+    check_output([
+        'ssh-keygen', '-q', '-s', ca_path, '-I', key_id, '-n', key_id,
+        '-z', str(serial), key_path + '.pub'])
+    return key_path + '-cert.pub'
+
+def is_revoked(krl_path, key_path):
+    """
+    Returns True if ssh-keygen -Q finds the key in the KRL
+    """
+    return call(['ssh-keygen', '-Q', '-f', krl_path, key_path], stdout=DEVNULL) != 0
+
+def check(name, krl_path, expected_krl_path, key_paths):
+    """
+    Compare revoked keys of both KRL, returns True if they match
+    """
+    resp = [is_revoked(krl_path, key_path) for key_path in key_paths]
+    expected = [is_revoked(expected_krl_path, key_path) for key_path in key_paths]
+    if resp == expected and any(resp) and not all(resp):
+        print('[OK] Test native KRL (%s)' % name)
+        return True
+    print('[FAIL] Test native KRL (%s) : %s != %s' % (name, resp, expected))
+    return False
+
+if __name__ == "__main__":
+    FAILURES = 0
+    with TemporaryDirectory() as TMP_DIR:
+        CA_PATH = join(TMP_DIR, 'ca')
+        generate_key(CA_PATH, ['-t', 'ed25519'])
+        KEY_PATHS = list()
+        for KEY_INDEX, KEY_TYPE in enumerate(KEY_TYPES * 2):
+            KEY_PATHS.append(join(TMP_DIR, 'key%s' % KEY_INDEX))
+            generate_key(KEY_PATHS[-1], KEY_TYPE)
+        PUBKEYS = list()
+        for KEY_PATH in KEY_PATHS[::2]:
+            with open(KEY_PATH + '.pub', 'r') as pubkey_file:
+                PUBKEYS.append(pubkey_file.read())
+        PUBKEYS.append('ssh-rsa invalid')
+
+        EXPECTED_KRL = join(TMP_DIR, 'expected.krl')
+        Authority(CA_PATH, EXPECTED_KRL).generate_krl_from_keys(PUBKEYS, version=42)
+        NATIVE_KRL = join(TMP_DIR, 'native.krl')
+        write_krl_from_keys(NATIVE_KRL, PUBKEYS, version=42)
+        if not check('explicit keys', NATIVE_KRL, EXPECTED_KRL, [p + '.pub' for p in KEY_PATHS]):
+            FAILURES += 1
+
+        # Same bytes, except the generation date
+        with open(EXPECTED_KRL, 'rb') as krl_file:
+            EXPECTED = krl_file.read()
+        with open(NATIVE_KRL, 'rb') as krl_file:
+            RESP = krl_file.read()
+        if RESP[:20] + RESP[28:] == EXPECTED[:20] + EXPECTED[28:]:
+            print('[OK] Test native KRL (same bytes as ssh-keygen)')
+        else:
+            print('[FAIL] Test native KRL (same bytes as ssh-keygen)')
+            FAILURES += 1
+
+        # Read back, and append keys like revoke_keys does
+        RESP = Krl.from_bytes(EXPECTED).to_bytes()
+        if RESP[:20] + RESP[28:] == EXPECTED[:20] + EXPECTED[28:]:
+            print('[OK] Test native KRL (read a ssh-keygen KRL)')
+        else:
+            print('[FAIL] Test native KRL (read a ssh-keygen KRL)')
+            FAILURES += 1
+        APPEND_KRL = join(TMP_DIR, 'append.krl')
+        write_krl_from_keys(APPEND_KRL, PUBKEYS[:1], version=41)
+        KRL = read_krl(APPEND_KRL)
+        for PUBKEY in PUBKEYS[1:-1]:
+            KRL.revoke_public_key(PUBKEY)
+        KRL.version = 42
+        KRL.write(APPEND_KRL)
+        if not check('appended keys', APPEND_KRL, EXPECTED_KRL, [p + '.pub' for p in KEY_PATHS]):
+            FAILURES += 1
+
+        HASH_KRL = join(TMP_DIR, 'hash.krl')
+        write_krl_from_keys(HASH_KRL, PUBKEYS, hashed=True)
+        if not check('SHA256 hashes', HASH_KRL, EXPECTED_KRL, [p + '.pub' for p in KEY_PATHS]):
+            FAILURES += 1
+
+        # Certificates, revoked by serial and by key ID
+        CERT_PATHS = [
+            sign_key(CA_PATH, KEY_PATH, 'user%s' % KEY_INDEX, KEY_INDEX + 1)
+            for KEY_INDEX, KEY_PATH in enumerate(KEY_PATHS)]
+        SPEC_PATH = join(TMP_DIR, 'spec')
+        with open(SPEC_PATH, 'w') as spec_file:
+            spec_file.write('serial: 1\nserial: 2\nserial: 7\nid: user4\nid: user9\n')
+        EXPECTED_KRL = join(TMP_DIR, 'expected-cert.krl')
+        check_output(['ssh-keygen', '-k', '-f', EXPECTED_KRL, '-s', CA_PATH + '.pub', SPEC_PATH],
+                     stderr=DEVNULL)
+        with open(CA_PATH + '.pub', 'r') as ca_file:
+            CA_BLOB = b64decode(ca_file.read().split()[1])
+        KRL = Krl()
+        for SERIAL in [1, 2, 7]:
+            KRL.revoke_cert_serial(CA_BLOB, SERIAL)
+        for KEY_ID in ['user4', 'user9']:
+            KRL.revoke_cert_key_id(CA_BLOB, KEY_ID)
+        NATIVE_KRL = join(TMP_DIR, 'native-cert.krl')
+        KRL.write(NATIVE_KRL)
+        if not check('certificates', NATIVE_KRL, EXPECTED_KRL, CERT_PATHS):
+            FAILURES += 1
+    if FAILURES:
+        sys.exit(1)